@@ -14,13 +14,13 @@ from socket import gethostname
 # https://click.palletsprojects.com/en/8.0.x/utils/
 import click
 
-from . import __version__, cs_utils
+from . import __version__, cs_loadgen, cs_replay, cs_utils
 from . import snews_coinc as snews_coinc
-from .database import Database
+from .database import Database, database_path
 from .heartbeat_feedbacks import FeedBack
 
 # Database initialized before any command is called
-db = Database(db_file_path=Path(__file__).parent.parent / "snews_cs.db")
+db = Database(db_file_path=database_path())
 db.initialize_database(sql_schema_path=Path(__file__).parent / "db_schema.sql")
 
 
@@ -30,14 +30,18 @@ db.initialize_database(sql_schema_path=Path(__file__).parent / "db_schema.sql")
     default='/etc/test-config.env',
     show_default='etc/test-config.env',
     help='environment file containing the configurations')
+@click.option('--transport', type=str, default=None,
+    help='transport of the topics: hop, memory or file:DIRECTORY, defaults to SNEWS_TRANSPORT of the env file')
 @click.pass_context
-def main(ctx, env):
+def main(ctx, env, transport):
     """ User interface for snews_pt tools
     """
     base = os.path.dirname(os.path.realpath(__file__))
     env_path = base + env
     ctx.ensure_object(dict)
     cs_utils.set_env(env_path)
+    if transport:
+        os.environ['SNEWS_TRANSPORT'] = transport
     ctx.obj['env'] = env
 
 @main.command()
@@ -45,7 +49,8 @@ def main(ctx, env):
 @click.option('--dropdb/--no-dropdb', default=True, show_default='True', help='Whether to drop the current database')
 @click.option('--email/--no-email', default=True, show_default='True', help='Whether to send emails along with the alert')
 @click.option('--slackbot/--no-slackbot', default=True, show_default='True', help='Whether to send the alert on slack')
-def run_coincidence(firedrill, dropdb, email, slackbot):
+@click.option('--record', type=click.Path(file_okay=False), default=None, help='Record the raw messages in this directory, defaults to RECORD_DIRECTORY of the env file')
+def run_coincidence(firedrill, dropdb, email, slackbot, record):
     """ Initiate Coincidence Decider
     """
 
@@ -54,7 +59,8 @@ def run_coincidence(firedrill, dropdb, email, slackbot):
                                                firedrill_mode=firedrill,
                                                server_tag=HOST,
                                                send_email=email,
-                                               send_slack=slackbot)
+                                               send_slack=slackbot,
+                                               record_directory=record)
     try:
         coinc.run_coincidence()
     except KeyboardInterrupt:
@@ -73,7 +79,42 @@ def run_feedback(verbose):
     click.secho(f'\nInvoking Feedback search, verbose={verbose}\n', fg='white', bg='green')
     feedback()
 
+@main.command()
+@click.argument('recordings', nargs=-1, required=True, type=click.Path(exists=True))
+@click.option('--speed', default=0.0, show_default='0', help='0 replays the messages back to back, otherwise the recorded times are followed this many times faster than real time')
+@click.option('--alerts', type=click.Path(dir_okay=False), default=None, help='Write the published alerts to this file, as JSON lines')
+@click.option('--verbose', '-v', is_flag=True, default=False, help='Show the output of the coincidence system')
+def replay(recordings, speed, alerts, verbose):
+    """ Replay recorded messages (JSON lines, optionally .gz/.bz2/.xz, or the
+    directories of the recorder) without a broker
+    """
+    click.secho(f'\nReplaying {len(recordings)} recording(s), speed={speed or "max"}\n', fg='white', bg='green')
+    report = cs_replay.replay(recordings, speed=speed, quiet=not verbose)
+    click.echo(cs_replay.format_report(report))
+    if alerts:
+        cs_replay.write_alerts(report, alerts)
+
 
+@main.command()
+@click.option('--duration', default=3600.0, show_default=True, help='Simulated seconds of traffic')
+@click.option('--detectors', default=None, type=int, help='Number of heartbeating detectors, all the registered ones by default')
+@click.option('--heartbeat-interval', default=60.0, show_default=True, help='Seconds between the beats of a detector')
+@click.option('--burst-rate', default=12.0, show_default=True, help='Bursts of observations per hour')
+@click.option('--command-rate', default=6.0, show_default=True, help='Remote commands per hour')
+@click.option('--test-fraction', default=0.2, show_default=True, help='Share of the bursts sent as test messages')
+@click.option('--scale', default=1.0, show_default=True, help='Multiplies all the rates')
+@click.option('--speed', default=0.0, show_default='0', help='Simulated seconds per second, 0 injects the messages back to back')
+@click.option('--seed', default=None, type=int, help='Seed of the traffic')
+def loadgen(duration, detectors, heartbeat_interval, burst_rate, command_rate, test_fraction, scale, speed, seed):
+    """ Inject synthetic traffic into an in-process coincidence system and measure it
+    """
+    distributor = cs_replay.ReplayDistributor(server_tag='loadgen')
+    events = cs_loadgen.traffic(duration, detectors=detectors, heartbeat_interval=heartbeat_interval,
+                                burst_rate=burst_rate, command_rate=command_rate,
+                                test_fraction=test_fraction, scale=scale, seed=seed)
+    click.secho(f'\nInjecting {len(events)} messages, speed={speed or "max"}\n', fg='white', bg='green')
+    report = cs_loadgen.run_load(events, speed=speed, distributor=distributor)
+    click.echo(cs_loadgen.format_report(report))
 
 if __name__ == "__main__":
     main()
@@ -8,14 +8,15 @@ Melih Kara
 Sebastian Torres-Lara
 """
 import os, click
-from hop import Stream
 from . import cs_utils
+from .cs_transport import get_transport
 
 class AlertPublisher:
     """ Class to publish SNEWS SuperNova Alerts based on coincidence
 
     """
-    def __init__(self, env_path=None, verbose=True, auth=True, firedrill_mode=True, is_test=False):
+    def __init__(self, env_path=None, verbose=True, auth=True, firedrill_mode=True, is_test=False,
+                 transport=None):
         """
         Alert publisher constructor 
         Parameters
@@ -26,9 +27,12 @@ class AlertPublisher:
             Show alert, defaults to True
         auth: bool
             Use hop-auth credentials, defaults to True
+        transport: Transport
+            transport of the alert topic, defaults to the one of SNEWS_TRANSPORT
         """
         cs_utils.set_env(env_path)
         self.auth = auth
+        self.transport = transport or get_transport()
         self.broker = os.getenv("HOP_BROKER")
         if firedrill_mode:
             self.alert_topic = os.getenv("FIREDRILL_ALERT_TOPIC")
@@ -42,14 +46,14 @@ class AlertPublisher:
 
 
     def __enter__(self):
-        self.stream = Stream(until_eos=True, auth=self.auth).open(self.alert_topic, 'w')
+        self.stream = self.transport.open(self.alert_topic, 'w', until_eos=True, auth=self.auth)
         return self
 
     def __exit__(self, *args):
         self.stream.close()
 
     def send(self, message):
-        """This method will set the sent_time and send the message to the hop broker.
+        """This method will set the sent_time and send the message to the alert topic.
 
         Parameters
         ----------
@@ -68,6 +72,27 @@ class AlertPublisher:
             for k, v in message.items():
                 print(f'{k:<35s}:{v}')
 
+
+class MemoryPublisher(AlertPublisher):
+    """ Publisher that keeps the alerts in a list instead of sending them,
+    for the replays and tests
+
+    """
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('verbose', False)
+        super().__init__(*args, **kwargs)
+        self.sent = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def send(self, message):
+        self.sent.append(message)
+        self.display_message(message)
+
 # Display message prints out the following on the server logs
 #
 # SNEWS_Coincidence_ALERT 2022-09-28T08:21:21.954651
@@ -0,0 +1,196 @@
+"""
+Write-behind archiving of the messages and alerts
+
+The coincidence loop hands every message, alert and cache change to an `ArchiveWriter`,
+a background thread that writes them to the SQL database in batches. Nothing is written
+on the ingest thread, and the writes keep the order in which they were submitted.
+"""
+import atexit
+import os
+import queue
+import threading
+import time
+from collections import Counter
+
+from .core.logging import getLogger
+from .snews_sql import Storage
+
+log = getLogger(__name__)
+
+# marks the end of the queue
+_stop = object()
+
+
+class ArchiveWriter:
+    """Background writer of the SNEWS archive
+
+    Parameters
+    ----------
+    env_path : `str`, optional
+        path to the env file, passed to `Storage`
+    flush_interval : `float`, optional
+        longest time (s) a submitted write waits before it is committed,
+        defaults to the ARCHIVE_FLUSH_INTERVAL env variable, or 1 second
+    flush_size : `int`, optional
+        largest number of writes committed in one transaction,
+        defaults to the ARCHIVE_FLUSH_SIZE env variable, or 100
+    max_queue : `int`, optional
+        size of the queue, the new writes are dropped (and counted) when it is full,
+        defaults to the ARCHIVE_QUEUE_SIZE env variable, or 10000
+
+    """
+
+    def __init__(self, env_path=None, flush_interval=None, flush_size=None, max_queue=None):
+        self.env_path = env_path
+        self.flush_interval = float(
+            flush_interval or os.getenv("ARCHIVE_FLUSH_INTERVAL", "1")
+        )
+        self.flush_size = int(flush_size or os.getenv("ARCHIVE_FLUSH_SIZE", "100"))
+        max_queue = int(max_queue or os.getenv("ARCHIVE_QUEUE_SIZE", "10000"))
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.written = 0
+        self.failed = 0
+        self.dropped = 0
+        # why the writer thread stopped, None while it runs
+        self.error = None
+        self._thread = None
+
+    def start(self):
+        """Start the writer thread, it is flushed and stopped at exit"""
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="snews-archive-writer", daemon=True
+            )
+            self._thread.start()
+            atexit.register(self.close)
+        return self
+
+    def close(self, timeout=None):
+        """Write everything that is still queued and stop the writer thread"""
+        if self._thread is None:
+            return
+        if self._thread.is_alive():
+            self.queue.put(_stop)
+        self._thread.join(timeout)
+        self._thread = None
+        atexit.unregister(self.close)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def submit(self, method, *args):
+        """Queue a call of a `Storage` method, e.g. submit("insert_mgs", message, "COINC").
+        Never waits: the write is dropped when the queue is full or the writer has stopped.
+        """
+        if self.error is None:
+            try:
+                self.queue.put_nowait((method, args))
+                return
+            except queue.Full:
+                pass
+        self.dropped += 1
+        if self.dropped == 1 or self.dropped % 1000 == 0:
+            reason = "queue is full" if self.error is None else f"writer stopped: {self.error}"
+            log.error(f"\t> Archive {reason}, {self.dropped} writes dropped")
+
+    def archive_message(self, message, tier):
+        """Queue a message for the all_mgs table and the archive of its tier"""
+        self.submit("insert_mgs", message, tier)
+
+    def archive_alert(self, alert, tier="COINC"):
+        """Queue a published alert for the alerts table of its tier"""
+        self.submit("insert_alert", alert, tier)
+
+    def archive_coinc_cache(self, changes):
+        """Queue the changes of the coincidence cache, see `Storage.update_coinc_cache`"""
+        if changes:
+            self.submit("update_coinc_cache", changes)
+
+    def _run(self):
+        # the connection belongs to this thread
+        try:
+            storage = Storage(env=self.env_path, drop_db=False)
+        except Exception as e:
+            self.error = e
+            log.critical(f"\t> Archive writer could not open the database, nothing is archived: {e}")
+            return
+        stopping = False
+        while not stopping:
+            try:
+                item = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            pending = []
+            deadline = time.monotonic() + self.flush_interval
+            # gather a batch, until it is full or the oldest write waited long enough
+            while True:
+                if item is _stop:
+                    stopping = True
+                    break
+                pending.append(item)
+                if len(pending) >= self.flush_size:
+                    break
+                wait = deadline - time.monotonic()
+                try:
+                    item = self.queue.get(timeout=wait) if wait > 0 else self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            self._write(storage, pending)
+
+    @staticmethod
+    def _write_batch(storage, pending):
+        with storage.batch():
+            for method, args in pending:
+                getattr(storage, method)(*args)
+
+    def _write(self, storage, pending):
+        if not pending:
+            return
+        try:
+            storage.db.retry(self._write_batch, storage, pending)
+            self.written += len(pending)
+            return
+        except Exception as e:
+            log.error(f"\t> Archive batch of {len(pending)} failed, writing one by one: {e}")
+        # keep everything but the bad writes
+        for method, args in pending:
+            try:
+                storage.db.retry(self._write_batch, storage, [(method, args)])
+                self.written += 1
+            except Exception as e:
+                self.failed += 1
+                log.error(f"\t> Could not archive ({method}): {e}")
+
+
+class MemoryArchive(ArchiveWriter):
+    """Counts the submitted writes instead of writing them, for the replays and tests.
+    Nothing touches the database.
+
+    Parameters
+    ----------
+    keep : `bool`
+        also keep the submitted writes, as (method, args), in `submitted`
+
+    """
+
+    def __init__(self, keep=True):
+        super().__init__(max_queue=1)
+        self.keep = keep
+        self.submitted = []
+        # method -> number of writes
+        self.counts = Counter()
+
+    def start(self):
+        return self
+
+    def close(self, timeout=None):
+        pass
+
+    def submit(self, method, *args):
+        if self.keep:
+            self.submitted.append((method, args))
+        self.counts[method] += 1
+        self.written += 1
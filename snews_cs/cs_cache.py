@@ -0,0 +1,186 @@
+"""
+Columnar storage for the observations held in the coincidence cache
+
+The coincidence logic only ever needs the neutrino time, the detector and the p value of
+an observation. These are kept in compact numpy arrays indexed by a slot number, the full
+message is kept aside so that a DataFrame can still be built when someone wants to look
+at (or store) the cache.
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# Every registered detector has a small integer id
+detector_file = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "etc/detector_properties.json")
+)
+with open(detector_file) as file:
+    detector_codes = {name: props[1] for name, props in json.load(file).items()}
+
+# columns of the DataFrame view, extra message fields are appended after these
+cache_columns = [
+    "id",
+    "detector_name",
+    "received_time",
+    "machine_time_utc",
+    "neutrino_time_utc",
+    "neutrino_time_as_datetime",
+    "p_val",
+    "meta",
+    "sub_group",
+    "neutrino_time_delta",
+]
+# fields that are derived from the cache itself, never stored with the message
+derived_columns = ["neutrino_time_as_datetime", "sub_group", "neutrino_time_delta"]
+
+
+def detector_code(detector_name):
+    """Return the integer code of a detector.
+    Detectors that are not in the detector properties file are given the next free code
+    """
+    if detector_name not in detector_codes:
+        detector_codes[detector_name] = max(detector_codes.values(), default=0) + 1
+    return detector_codes[detector_name]
+
+
+def detector_bits(mask):
+    """Yield the detector codes whose bits are set in a membership bitmask"""
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+def to_nanoseconds(time):
+    """Convert an ISO time string (or datetime64) to int64 nanoseconds since epoch"""
+    return int(np.datetime64(time, "ns").astype(np.int64))
+
+
+class ObservationStore:
+    """Slot based columnar storage of the cached observations
+
+    Each message is in a slot, and `slot_of` gives the latest slot of every detector. An
+    older message of a detector keeps its slot for as long as a sub group still holds it.
+    Freed slots are reused, and the arrays grow by doubling.
+
+    Parameters
+    ----------
+    capacity : `int`
+        initial number of slots
+    track_changes : `bool`
+        keep the changed messages (see `take_changes`), for incremental persistence
+
+    """
+
+    def __init__(self, capacity=32, track_changes=False):
+        self.nu_time = np.zeros(capacity, dtype=np.int64)
+        self.detector = np.full(capacity, -1, dtype=np.int16)
+        self.p_val = np.full(capacity, np.nan, dtype=np.float64)
+        self.records = [None] * capacity
+        self.slot_of = {}  # detector name -> slot
+        self._free = list(range(capacity - 1, -1, -1))
+        # message id -> record, or None if the message left the store
+        self.changes = {} if track_changes else None
+
+    def __len__(self):
+        return len(self.slot_of)
+
+    def __contains__(self, detector_name):
+        return detector_name in self.slot_of
+
+    def _grow(self):
+        old = len(self.records)
+        new = 2 * old
+        self.nu_time = np.resize(self.nu_time, new)
+        self.detector = np.concatenate(
+            [self.detector, np.full(new - old, -1, dtype=np.int16)]
+        )
+        self.p_val = np.concatenate([self.p_val, np.full(new - old, np.nan)])
+        self.records.extend([None] * (new - old))
+        self._free.extend(range(new - 1, old - 1, -1))
+
+    def _write(self, slot, message):
+        record = {k: v for k, v in message.items() if k not in derived_columns}
+        self.records[slot] = record
+        self.nu_time[slot] = to_nanoseconds(record["neutrino_time_utc"])
+        self.detector[slot] = detector_code(record["detector_name"])
+        p_val = record.get("p_val")
+        self.p_val[slot] = np.nan if p_val is None else p_val
+        if self.changes is not None:
+            self.changes[record.get("id")] = record
+
+    def _forget(self, slot):
+        if self.changes is not None:
+            self.changes[self.records[slot].get("id")] = None
+
+    def add(self, message):
+        """Store a new observation and return its slot, it becomes the latest one of
+        its detector"""
+        if not self._free:
+            self._grow()
+        slot = self._free.pop()
+        self._write(slot, message)
+        self.slot_of[message["detector_name"]] = slot
+        return slot
+
+    def remove(self, slot):
+        """Free the given slot"""
+        record = self.records[slot]
+        self._forget(slot)
+        if self.slot_of.get(record["detector_name"]) == slot:
+            del self.slot_of[record["detector_name"]]
+        self.records[slot] = None
+        self.detector[slot] = -1
+        self.p_val[slot] = np.nan
+        self._free.append(slot)
+
+    def take_changes(self):
+        """Return the messages that changed since the last call, and start over
+
+        Returns
+        -------
+        dict
+            message id -> stored record, or None if the message was removed
+
+        """
+        changes, self.changes = self.changes, {}
+        return changes
+
+    def mask_of(self, slots):
+        """Bitmask of the detectors of the given slots, bit `code` set for each detector"""
+        mask = 0
+        for slot in slots:
+            mask |= 1 << int(self.detector[slot])
+        return mask
+
+    def frame(self, groups):
+        """Build a DataFrame view of the cache
+
+        Parameters
+        ----------
+        groups : `dict`
+            sub group tag -> list of slots, sorted by neutrino time
+
+        Returns
+        -------
+        pd.DataFrame
+            one row per (sub group, observation), sorted by sub group and neutrino time
+
+        """
+        rows = []
+        for tag in sorted(groups):
+            slots = groups[tag]
+            initial_time = self.nu_time[slots[0]]
+            for slot in slots:
+                row = dict(self.records[slot])
+                row["neutrino_time_as_datetime"] = np.datetime64(
+                    int(self.nu_time[slot]), "ns"
+                )
+                row["sub_group"] = tag
+                row["neutrino_time_delta"] = (self.nu_time[slot] - initial_time) / 1e9
+                rows.append(row)
+        df = pd.DataFrame(rows)
+        extra = [c for c in df.columns if c not in cache_columns]
+        return df.reindex(columns=cache_columns + extra)
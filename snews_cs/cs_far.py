@@ -0,0 +1,305 @@
+"""
+Lookup tables of the false alarm rate of a coincidence
+
+The combined imitation frequency of r coincident detectors out of n online ones, each
+imitating a supernova signal f times per second, within a window of w seconds is
+
+    R = (C(n, r) + 1) * f^r * w^(r - 1)
+
+The inputs are small integers, so the values are computed once, with exact binomial
+coefficients and in log space (f^r underflows long before n gets large), and looked up
+when an alert is sent. Detectors can be given their own imitation frequency, then C(n, r) f^r
+becomes the sum over the r-subsets of the online detectors of the product of their frequencies.
+"""
+import json
+import math
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+
+from .core.logging import getLogger
+
+log = getLogger(__name__)
+
+seconds_year = 31_556_926
+seconds_week = 604800
+
+detector_file = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "etc/detector_properties.json")
+)
+with open(detector_file) as file:
+    n_registered = len(json.load(file))
+
+
+class FalseAlarmTable:
+    """Combined imitation frequencies of every (online, coincident, window) combination
+
+    Parameters
+    ----------
+    rate : `float`
+        imitation frequency (Hz) of a detector, defaults to once a week
+    rates : `dict`, optional
+        detector name -> its own imitation frequency (Hz)
+    windows : `list`
+        coincidence windows (s) that are tabulated right away, others are added when used
+    max_detectors : `int`, optional
+        largest number of online detectors tabulated, defaults to twice the registered ones
+
+    """
+
+    def __init__(self, rate=1 / seconds_week, rates=None, windows=(10,), max_detectors=None):
+        self.rate = rate
+        self.rates = dict(rates or {})
+        self.max_detectors = max_detectors or 2 * n_registered
+        n = np.arange(self.max_detectors + 1)
+        # log(C(n, r) + 1) for every r <= n, and log(1) = 0 when r > n
+        self._log_comb = np.zeros((len(n), len(n)))
+        for i in n:
+            for r in range(i + 1):
+                self._log_comb[i, r] = math.log(math.comb(int(i), r) + 1)
+        self._tables = {}
+        for window in windows:
+            self.table(window)
+
+    @classmethod
+    def from_env(cls, windows=(10,)):
+        """Table with the imitation frequencies of the env variables: FAR_IMITATION_RATE,
+        imitations per week of a detector (1), and FAR_IMITATION_RATES, an optional JSON
+        file of detector name -> imitations per week
+        """
+        rate = float(os.getenv("FAR_IMITATION_RATE", "1")) / seconds_week
+        rates = {}
+        path = os.getenv("FAR_IMITATION_RATES")
+        if path:
+            with open(path) as file:
+                rates = {k: float(v) / seconds_week for k, v in json.load(file).items()}
+        return cls(rate, rates, windows)
+
+    def table(self, window):
+        """log R of every (n online, r coincident) pair for a window, rows are n"""
+        window = float(window)
+        if window not in self._tables:
+            r = np.arange(self.max_detectors + 1)
+            self._tables[window] = (
+                self._log_comb + r * math.log(self.rate) + (r - 1) * math.log(window)
+            )
+        return self._tables[window]
+
+    def log_frequency(self, n_online, n_coincident, window=10):
+        """log of the combined imitation frequency (Hz), with the default rate for all"""
+        if max(n_online, n_coincident) <= self.max_detectors:
+            return float(self.table(window)[n_online, n_coincident])
+        return (
+            math.log(math.comb(n_online, n_coincident) + 1)
+            + n_coincident * math.log(self.rate)
+            + (n_coincident - 1) * math.log(window)
+        )
+
+    def detector_rate(self, detector):
+        return self.rates.get(detector, self.rate)
+
+    @lru_cache(maxsize=4096)
+    def _log_frequency_of(self, online, coincident, window):
+        # sum over the r-subsets of the product of the frequencies, the elementary
+        # symmetric polynomial e_r, built one detector at a time in log space
+        r = len(coincident)
+        log_e = np.full(r + 1, -np.inf)
+        log_e[0] = 0.0
+        for detector in online:
+            log_f = math.log(self.detector_rate(detector))
+            log_e[1:] = np.logaddexp(log_e[1:], log_e[:-1] + log_f)
+        own = sum(math.log(self.detector_rate(d)) for d in coincident)
+        return float(np.logaddexp(log_e[r], own) + (r - 1) * math.log(window))
+
+    def log_frequency_of(self, online, coincident, window=10):
+        """log of the combined imitation frequency (Hz) of the given coincident detectors,
+        out of the given online detectors, each with its own imitation frequency
+        """
+        online, coincident = tuple(sorted(set(online))), tuple(sorted(coincident))
+        if not any(d in self.rates for d in online + coincident):
+            return self.log_frequency(len(online), len(coincident), window)
+        return self._log_frequency_of(online, coincident, float(window))
+
+    def years_between(self, online, coincident, window=10):
+        """Years between two false alarms, as returned by `cache_false_alarm_rate`"""
+        log_years = math.log(seconds_year) - self.log_frequency_of(online, coincident, window)
+        with np.errstate(over="ignore"):
+            return float(np.exp(log_years))
+
+
+@lru_cache(maxsize=None)
+def default_table():
+    """The table of the imitation frequencies set in the environment"""
+    return FalseAlarmTable.from_env()
+
+
+def _coincidence_tails(starts, ends, p, t0, t1, trials, seed, batch=1 << 17):
+    """Sum over `trials` random times in [t0, t1) of the probability that at least r of
+    the detectors live at that time imitate a signal in the same window, for every r
+
+    Parameters
+    ----------
+    starts, ends : `list` of `np.ndarray`
+        the live intervals (ns) of each detector
+    p : `np.ndarray`
+        probability that each detector imitates a signal within one window
+
+    Returns
+    -------
+    np.ndarray
+        the sums, indexed by r = 0 ... number of detectors
+
+    """
+    rng = np.random.default_rng(seed)
+    n = len(p)
+    total = np.zeros(n + 1)
+    done = 0
+    while done < trials:
+        size = min(batch, trials - done)
+        done += size
+        # sorted, the binary searches then walk the intervals in order
+        times = np.sort(rng.integers(t0, t1, size))
+        live = np.zeros((size, n), dtype=bool)
+        for d in range(n):
+            if len(starts[d]):
+                i = np.searchsorted(starts[d], times, side="right") - 1
+                live[:, d] = (i >= 0) & (ends[d][np.maximum(i, 0)] > times)
+        # most trials share the same live detectors, each set is worked out once
+        if n <= 64:
+            bits = np.left_shift(np.uint64(1), np.arange(n, dtype=np.uint64))
+            sets, counts = np.unique((live * bits).sum(axis=1, dtype=np.uint64), return_counts=True)
+            live = (sets[:, None] & bits) != 0
+        else:
+            sets, counts = np.unique(np.packbits(live, axis=1), axis=0, return_counts=True)
+            live = np.unpackbits(sets, axis=1, count=n).astype(bool)
+        # distribution of the number of imitating detectors, one detector at a time
+        dist = np.zeros((len(sets), n + 1))
+        dist[:, 0] = 1.0
+        for d in range(n):
+            a = (p[d] * live[:, d])[:, None]
+            dist[:, 1:] = dist[:, 1:] * (1 - a) + dist[:, :-1] * a
+            dist[:, :1] *= 1 - a
+        # P(at least r), summed over the trials
+        total += counts @ np.cumsum(dist[:, ::-1], axis=1)[:, ::-1]
+    return total
+
+
+class MonteCarloFar:
+    """False alarm rates of the network estimated from the observed uptime of the detectors
+
+    Each trial picks a random time of the last `lookback` days and takes the detectors that
+    were live then, from the `UptimeIndex`, so that the correlated downtimes are kept.
+    Sampling the imitations as well would almost never give a coincidence, so each trial adds
+    the exact probability of an r-fold coincidence of its live detectors instead. The trials
+    run in batches of numpy arrays, optionally spread over a process pool, and the table is
+    refreshed in a background thread.
+
+    Parameters
+    ----------
+    uptime : `UptimeIndex`
+        the live periods of the detectors
+    table : `FalseAlarmTable`, optional
+        gives the imitation frequency of each detector, defaults to `default_table()`
+    window : `float`
+        the coincidence window (s)
+    trials : `int`, optional
+        trials per refresh, FAR_MC_TRIALS env variable (0, the estimates are off and only
+        the table is used)
+    lookback : `float`, optional
+        days of uptime sampled, FAR_MC_LOOKBACK env variable (7)
+    refresh : `float`, optional
+        seconds between refreshes, FAR_MC_REFRESH env variable (3600)
+    workers : `int`, optional
+        processes running the trials, FAR_MC_WORKERS env variable (1, in this process)
+
+    """
+
+    def __init__(
+        self, uptime, table=None, window=10, trials=None, lookback=None, refresh=None, workers=None
+    ):
+        self.uptime = uptime
+        self.table = table or default_table()
+        self.window = float(window)
+        self.trials = int(os.getenv("FAR_MC_TRIALS", "0") if trials is None else trials)
+        self.lookback = float(lookback or os.getenv("FAR_MC_LOOKBACK", "7"))
+        self.refresh = float(refresh or os.getenv("FAR_MC_REFRESH", "3600"))
+        self.workers = int(workers or os.getenv("FAR_MC_WORKERS", "1"))
+        # years between r-fold false alarms, indexed by r, None until estimated
+        self.years = None
+        self.updated = None
+        # the detectors sampled by the estimate
+        self.detectors = frozenset()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def estimate(self, now=None, seed=None):
+        """Run the trials and update the table, returns it"""
+        now = np.datetime64("now", "ns") if now is None else np.datetime64(now, "ns")
+        t1 = int(now.astype(np.int64))
+        t0 = t1 - int(self.lookback * 86400e9)
+        # a snapshot, the index keeps growing while the trials run
+        intervals = self.uptime.snapshot()
+        detectors = list(intervals)
+        if not detectors or not self.trials:
+            return self.years
+        starts = [intervals[detector][0] for detector in detectors]
+        ends = [intervals[detector][1] for detector in detectors]
+        rates = np.array([self.table.detector_rate(d) for d in detectors])
+        p = -np.expm1(-rates * self.window)
+        seeds = np.random.SeedSequence(seed).spawn(self.workers)
+        chunks = [len(c) for c in np.array_split(np.arange(self.trials), self.workers)]
+        args = [(starts, ends, p, t0, t1, n, seed) for n, seed in zip(chunks, seeds)]
+        if self.workers > 1:
+            with ProcessPoolExecutor(self.workers) as pool:
+                tails = sum(pool.map(_coincidence_tails, *zip(*args)))
+        else:
+            tails = _coincidence_tails(*args[0])
+        frequency = tails / self.trials / self.window
+        with np.errstate(divide="ignore"):
+            # the convention of `cache_false_alarm_rate`
+            years = seconds_year / frequency
+        # swapped together, the readers see the detectors of the years they read
+        self.years, self.detectors = years, frozenset(detectors)
+        self.updated = now
+        return self.years
+
+    def years_between(self, n_coincident, time_window=None, detectors=None):
+        """Years between two false alarms with `n_coincident` detectors, as returned by
+        `cache_false_alarm_rate`, None if it was not estimated, or if the estimate does not
+        apply: another coincidence window, or coincident `detectors` it did not sample.
+        The estimate averages over the detectors that were live in the sampled days, not
+        the ones online now.
+        """
+        years, sampled = self.years, self.detectors
+        if years is None or not 0 < n_coincident < len(years) or not np.isfinite(years[n_coincident]):
+            return None
+        if time_window is not None and float(time_window) != self.window:
+            return None
+        if detectors is not None and not sampled.issuperset(detectors):
+            return None
+        return float(years[n_coincident])
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.estimate()
+            except Exception as e:
+                log.error(f"\t> Monte Carlo false alarm rates failed: {e}")
+            self._stop.wait(self.refresh)
+
+    def start(self):
+        """Refresh the table every `refresh` seconds in a background thread"""
+        if self._thread is None and self.trials:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="snews-far", daemon=True)
+            self._thread.start()
+        return self
+
+    def close(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
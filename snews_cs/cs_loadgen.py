@@ -0,0 +1,336 @@
+"""
+Synthetic load for the coincidence system
+
+`traffic` generates a realistic mix of messages in the order they arrive: every detector
+heartbeating, bursts of CoincidenceTier messages from a few detectors at a time with updates
+and retractions, test-mode bursts, and remote commands. `run_load` injects them into an
+in-process `ReplayDistributor` (no broker, in-memory sinks, its clock follows the simulated
+times) `speed` times faster than real time, and measures the sustained throughput, how long
+the messages wait behind each other (the queueing delay), how long each takes, and how the
+memory of the process grows. Raising the rates (`scale`) or the speed until the delays keep
+growing finds the capacity of the server.
+"""
+import contextlib
+import json
+import os
+import resource
+import time
+import warnings
+from collections import Counter, defaultdict
+
+import numpy as np
+
+from .core.logging import getLogger
+from .cs_replay import ReplayDistributor, percentiles
+
+log = getLogger(__name__)
+
+detector_file = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "etc/detector_properties.json")
+)
+with open(detector_file) as file:
+    registered_detectors = list(json.load(file))
+
+# the commands of the mix, and their share of the command traffic
+command_mix = {
+    "test-connection": 0.4,
+    "Get-Feedback": 0.2,
+    "display-heartbeats": 0.2,
+    "hard-reset": 0.2,  # of the test cache
+}
+
+
+def to_iso(ns):
+    # a plain str, the format checks reject numpy strings
+    return str(np.datetime_as_string(np.datetime64(int(ns), "ns"), unit="ns"))
+
+
+def observation(detector, tag, nu_time, arrival, p_val, is_test):
+    """A CoincidenceTier message, the times in ns"""
+    return {
+        "id": f"{detector}_CoincidenceTier_{tag}",
+        "tier": "CoincidenceTier",
+        "detector_name": detector,
+        "neutrino_time_utc": to_iso(nu_time),
+        "p_val": p_val,
+        "machine_time_utc": to_iso(nu_time),
+        "sent_time_utc": to_iso(arrival - int(0.5e9)),
+        "schema_version": "1.0",
+        "meta": {"is_test": is_test},
+    }
+
+
+def traffic(
+    duration=3600.0,
+    detectors=None,
+    heartbeat_interval=60.0,
+    burst_rate=12.0,
+    burst_size=(2, 6),
+    update_fraction=0.3,
+    retraction_fraction=0.1,
+    test_fraction=0.2,
+    command_rate=6.0,
+    scale=1.0,
+    start=None,
+    seed=None,
+):
+    """A mix of messages over `duration` simulated seconds
+
+    Parameters
+    ----------
+    duration : `float`
+        simulated seconds of traffic
+    detectors : `int` or `list`, optional
+        the detectors, or how many of the registered ones, all of them by default
+    heartbeat_interval : `float`
+        seconds between the beats of a detector
+    burst_rate : `float`
+        bursts of observations per hour, a burst is seen by `burst_size` detectors within
+        one coincidence window
+    burst_size : `tuple`
+        smallest and largest number of detectors in a burst
+    update_fraction, retraction_fraction : `float`
+        chance that a detector of a burst sends an update, a retraction, later on
+    test_fraction : `float`
+        share of the bursts that are test messages
+    command_rate : `float`
+        remote commands per hour
+    scale : `float`
+        multiplies all the rates (beats, bursts and commands)
+    start : `np.datetime64`, optional
+        simulated time of the first message, now by default
+    seed : `int`, optional
+        seed of the random numbers, the same seed gives the same traffic
+
+    Returns
+    -------
+    list
+        (arrival time (ns), kind, message), sorted by arrival time. The kinds are
+        heartbeat, observation, update, retraction, test and command.
+
+    """
+    rng = np.random.default_rng(seed)
+    if detectors is None or isinstance(detectors, int):
+        n = len(registered_detectors) if detectors is None else detectors
+        if n > len(registered_detectors):
+            raise ValueError(
+                f"{n} detectors asked, only {len(registered_detectors)} are registered"
+            )
+        detectors = registered_detectors[:n]
+    detectors = list(detectors)
+    start = np.datetime64("now", "ns") if start is None else np.datetime64(start, "ns")
+    t0 = int(start.astype(np.int64))
+    span = int(duration * 1e9)
+    events = []
+
+    def add(arrival, kind, message):
+        if arrival < t0 + span:
+            events.append((int(arrival), kind, message))
+
+    # every detector beats with some jitter, and is off once in a while
+    interval = heartbeat_interval / scale
+    for detector in detectors:
+        beats = np.arange(rng.uniform(0, interval), duration, interval)
+        beats += rng.normal(0, 0.01 * interval, len(beats))
+        latencies = rng.uniform(0, 2, len(beats))
+        off = rng.random(len(beats)) < 0.02
+        for i, (t, latency) in enumerate(zip(beats, latencies)):
+            arrival = t0 + int(t * 1e9)
+            add(
+                arrival,
+                "heartbeat",
+                {
+                    "id": f"{detector}_Heartbeat_{i}",
+                    "detector_name": detector,
+                    "detector_status": "OFF" if off[i] else "ON",
+                    "sent_time_utc": to_iso(arrival - int(latency * 1e9)),
+                    "meta": {},
+                },
+            )
+
+    # bursts seen by a few detectors, each message a few seconds late
+    n_bursts = rng.poisson(burst_rate * scale * duration / 3600)
+    for burst, t in enumerate(np.sort(rng.uniform(0, duration, n_bursts))):
+        size = min(int(rng.integers(burst_size[0], burst_size[1] + 1)), len(detectors))
+        is_test = bool(rng.random() < test_fraction)
+        for detector in rng.choice(detectors, size, replace=False):
+            detector = str(detector)
+            nu_time = t0 + int((t + rng.uniform(0, 8)) * 1e9)
+            arrival = nu_time + int(rng.uniform(1, 30) * 1e9)
+            p_val = float(rng.uniform(0.01, 0.99))
+            add(
+                arrival,
+                "test" if is_test else "observation",
+                observation(detector, f"{burst}_0", nu_time, arrival, p_val, is_test),
+            )
+            if rng.random() < update_fraction:
+                updated = nu_time + int(rng.normal(0, 0.5) * 1e9)
+                later = arrival + int(rng.uniform(5, 60) * 1e9)
+                p_val = float(rng.uniform(0.01, 0.99))
+                add(
+                    later,
+                    "test" if is_test else "update",
+                    observation(detector, f"{burst}_1", updated, later, p_val, is_test),
+                )
+            if rng.random() < retraction_fraction:
+                later = arrival + int(rng.uniform(60, 120) * 1e9)
+                add(
+                    later,
+                    "test" if is_test else "retraction",
+                    {
+                        "id": f"{detector}_Retraction_{burst}",
+                        "detector_name": detector,
+                        "retract_latest": 1,
+                        "sent_time_utc": to_iso(later),
+                        "meta": {"is_test": is_test},
+                    },
+                )
+
+    # remote commands, the resets only touch the test cache
+    n_commands = rng.poisson(command_rate * scale * duration / 3600)
+    names, shares = list(command_mix), np.array(list(command_mix.values()))
+    for i, t in enumerate(np.sort(rng.uniform(0, duration, n_commands))):
+        command = names[rng.choice(len(names), p=shares / shares.sum())]
+        detector = str(rng.choice(detectors))
+        arrival = t0 + int(t * 1e9)
+        add(
+            arrival,
+            "command",
+            {
+                "id": f"{i}_{command}",
+                "detector_name": detector,
+                "pass": os.getenv("snews_cs_admin_pass", "False"),
+                "email": "",
+                "sent_time_utc": to_iso(arrival),
+                "meta": {"is_test": True},
+            },
+        )
+    events.sort(key=lambda event: event[0])
+    return events
+
+
+def rss():
+    """Resident memory of the process (bytes)"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # the peak, where /proc is not available (kB on Linux, bytes on macOS)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run_load(events, speed=0.0, distributor=None, sample_every=1000, quiet=True):
+    """Inject messages into a distributor, and measure how it keeps up
+
+    A message is due at its simulated arrival time, `speed` times faster than real time,
+    and waits until the messages before it are handled. With `speed` 0 all the messages
+    are due right away, and only the handling times are measured.
+
+    Parameters
+    ----------
+    events : `list`
+        (arrival time (ns), kind, message) in order, as made by `traffic`
+    speed : `float`
+        simulated seconds per second, 0 injects the messages back to back
+    distributor : `ReplayDistributor`, optional
+        a new one by default
+    sample_every : `int`
+        messages between two samples of the memory
+    quiet : `bool`
+        hide the terminal output of the distributor
+
+    Returns
+    -------
+    dict
+        message counts per kind, the throughput (messages/s), the handling and queueing
+        delays (ms) per kind, the memory growth and the alerts that were published
+
+    """
+    distributor = distributor or ReplayDistributor()
+    counts = Counter()
+    service = defaultdict(list)
+    delays = []
+    memory = [(0, rss())]
+    failed = 0
+    if not events:
+        raise ValueError("No messages to inject")
+    first = events[0][0]
+    with contextlib.ExitStack() as stack:
+        if quiet:
+            devnull = stack.enter_context(open(os.devnull, "w"))
+            stack.enter_context(contextlib.redirect_stdout(devnull))
+            stack.enter_context(warnings.catch_warnings())
+            warnings.simplefilter("ignore")
+        started = time.perf_counter()
+        for i, (arrival, kind, message) in enumerate(events, 1):
+            if speed > 0:
+                due = started + (arrival - first) / 1e9 / speed
+                wait = due - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+                delays.append(time.perf_counter() - due)
+            distributor.clock = np.datetime64(arrival, "ns")
+            tic = time.perf_counter()
+            try:
+                distributor.handle_message(message)
+            except Exception as e:
+                log.error(f"\t> Injected {kind} message failed: {e}")
+                failed += 1
+            service[kind].append(time.perf_counter() - tic)
+            counts[kind] += 1
+            if i % sample_every == 0:
+                memory.append((i, rss()))
+        elapsed = time.perf_counter() - started
+    memory.append((len(events), rss()))
+    handled, resident = np.array(memory, dtype=float).T
+    busy = float(sum(sum(times) for times in service.values()))
+    simulated = (events[-1][0] - first) / 1e9
+    return {
+        "messages": len(events),
+        "counts": dict(counts),
+        "failed": failed,
+        "simulated": simulated,
+        "elapsed": elapsed,
+        "busy": busy,
+        # offered load, what was handled per second, and per second of handling
+        "offered": len(events) * speed / simulated if speed > 0 and simulated else np.nan,
+        "throughput": len(events) / elapsed if elapsed else np.nan,
+        "capacity": len(events) / busy if busy else np.nan,
+        "latency_ms": percentiles([t for times in service.values() for t in times]),
+        "latency_ms_by_kind": {kind: percentiles(times) for kind, times in service.items()},
+        "queueing_ms": percentiles(delays),
+        "memory_mb": {
+            "start": resident[0] / 2**20,
+            "end": resident[-1] / 2**20,
+            "peak": resident.max() / 2**20,
+            # least squares slope of the resident memory
+            "per_1000": float(np.polyfit(handled, resident, 1)[0]) * 1000 / 2**20,
+        },
+        "cache_size": len(distributor.coinc_data.store),
+        "alerts": len(distributor.alerts),
+        "test_alerts": len(distributor.test_alerts),
+    }
+
+
+def format_report(report):
+    """The report of `run_load`, as text for the terminal"""
+    latency, queueing, memory = report["latency_ms"], report["queueing_ms"], report["memory_mb"]
+    counts = ", ".join(f"{n} {kind}" for kind, n in sorted(report["counts"].items()))
+    lines = [
+        f"{'Messages':<22}: {report['messages']} ({counts}), {report['failed']} failed",
+        f"{'Simulated / elapsed':<22}: {report['simulated']:.1f} s / {report['elapsed']:.3f} s "
+        f"({report['busy']:.3f} s handling)",
+        f"{'Throughput':<22}: {report['throughput']:.1f} msg/s, offered "
+        f"{report['offered']:.1f} msg/s (capacity {report['capacity']:.1f} msg/s)",
+        f"{'Latency (ms)':<22}: p50 {latency['p50']:.3f}, p90 {latency['p90']:.3f}, "
+        f"p99 {latency['p99']:.3f}, max {latency['max']:.3f}",
+        f"{'Queueing delay (ms)':<22}: p50 {queueing['p50']:.3f}, p90 {queueing['p90']:.3f}, "
+        f"p99 {queueing['p99']:.3f}, max {queueing['max']:.3f}",
+        f"{'Memory (MB)':<22}: {memory['start']:.1f} -> {memory['end']:.1f} "
+        f"(peak {memory['peak']:.1f}, {memory['per_1000']:+.3f} per 1000 messages)",
+        f"{'Cache / alerts':<22}: {report['cache_size']} messages / {report['alerts']} "
+        f"({report['test_alerts']} test)",
+    ]
+    for kind, times in sorted(report["latency_ms_by_kind"].items()):
+        lines.append(f"\t> {kind:<12} p50 {times['p50']:.3f} ms, p99 {times['p99']:.3f} ms")
+    return "\n".join(lines)
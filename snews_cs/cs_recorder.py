@@ -0,0 +1,296 @@
+"""
+Recording of the raw messages consumed by the coincidence system
+
+Every payload read from the stream is appended, with the time it was received and whether
+it could be decoded, to compressed JSON-lines segment files. The ingest loop only puts the
+payload in a queue; a background thread serializes the records and writes them with large
+buffered, sequential writes. A segment is closed and a new one started once it holds
+`max_bytes` (uncompressed) or is `max_age` seconds old. Segments that are still written end
+in ".open", and are renamed when they are closed.
+
+Each line is one record
+    {"received_time_utc": "...", "decoded": true, "error": null,
+     "encoding": "text", "payload": "..."}
+where the payload is the string read from the stream (encoding "text"), base64 of the bytes
+of a pickled message ("base64"), or any other content as JSON ("json"). `cs_replay` reads
+the segments back.
+"""
+import atexit
+import base64
+import bz2
+import glob
+import gzip
+import json
+import lzma
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+from .core.logging import getLogger
+
+log = getLogger(__name__)
+
+# compression -> file extension, and the opener of its files
+extensions = {"gz": ".gz", "bz2": ".bz2", "xz": ".xz", "none": ""}
+openers = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open, ".lzma": lzma.open}
+_compressors = {
+    "gz": lambda raw: gzip.GzipFile(fileobj=raw, mode="wb"),
+    "bz2": lambda raw: bz2.BZ2File(raw, "wb"),
+    "xz": lambda raw: lzma.LZMAFile(raw, "wb"),
+}
+
+# marks the end of the queue
+_stop = object()
+
+
+def open_recording(path):
+    """Open a recording (or any JSON-lines file) as text, decompressed according to its
+    extension
+    """
+    opener = openers.get(os.path.splitext(path)[1], open)
+    return opener(path, "rt", encoding="utf-8")
+
+
+def segments(directory, prefix="snews_cs"):
+    """The closed segments of a directory, oldest first"""
+    paths = glob.glob(os.path.join(directory, f"{prefix}-*.jsonl*"))
+    return sorted(path for path in paths if not path.endswith(".open"))
+
+
+def is_record(line):
+    """Whether a parsed line is a record of the recorder, rather than a bare message"""
+    return isinstance(line, dict) and "payload" in line and "encoding" in line
+
+
+def encode_payload(payload):
+    """(encoding, JSON-able payload) of a raw payload"""
+    if isinstance(payload, str):
+        return "text", payload
+    if isinstance(payload, (bytes, bytearray)):
+        return "base64", base64.b64encode(payload).decode("ascii")
+    return "json", payload
+
+
+def decode_payload(record):
+    """The raw payload of a record, as it was read from the stream"""
+    if record["encoding"] == "base64":
+        return base64.b64decode(record["payload"])
+    return record["payload"]
+
+
+def record_line(received, payload, error=None):
+    """A record, as a line of a segment"""
+    encoding, payload = encode_payload(payload)
+    record = {
+        "received_time_utc": np.datetime_as_string(np.datetime64(received, "ns"), unit="ns"),
+        "decoded": error is None,
+        "error": None if error is None else str(error),
+        "encoding": encoding,
+        "payload": payload,
+    }
+    return json.dumps(record, default=str) + "\n"
+
+
+class MessageRecorder:
+    """Background recorder of the raw messages
+
+    Parameters
+    ----------
+    directory : `str`
+        where the segments are written, created if needed
+    max_bytes : `int`, optional
+        size (uncompressed) at which a segment is closed,
+        defaults to the RECORD_SEGMENT_SIZE env variable (MB), or 64 MB
+    max_age : `float`, optional
+        age (s) at which a segment is closed,
+        defaults to the RECORD_SEGMENT_AGE env variable, or 3600
+    compression : `str`, optional
+        gz, bz2, xz or none, defaults to the RECORD_COMPRESSION env variable, or gz
+    max_queue : `int`, optional
+        records waiting to be written, the new ones are dropped (and counted) when it is
+        full, defaults to the RECORD_QUEUE_SIZE env variable, or 100000
+    flush_interval : `float`
+        longest time (s) a record stays in memory before it is flushed to the file, a
+        crash loses at most that much (the ".open" segment is readable up to the last flush)
+    buffer_size : `int`
+        size of the write buffer of the segment files
+    prefix : `str`
+        start of the segment file names
+
+    """
+
+    def __init__(
+        self,
+        directory,
+        max_bytes=None,
+        max_age=None,
+        compression=None,
+        max_queue=None,
+        flush_interval=1.0,
+        buffer_size=1 << 20,
+        prefix="snews_cs",
+    ):
+        self.directory = directory
+        self.max_bytes = int(max_bytes or float(os.getenv("RECORD_SEGMENT_SIZE", "64")) * 2**20)
+        self.max_age = float(max_age or os.getenv("RECORD_SEGMENT_AGE", "3600"))
+        self.compression = compression or os.getenv("RECORD_COMPRESSION", "gz")
+        if self.compression not in extensions:
+            raise ValueError(f"Unknown compression {self.compression}, use one of {list(extensions)}")
+        max_queue = int(max_queue or os.getenv("RECORD_QUEUE_SIZE", "100000"))
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.flush_interval = flush_interval
+        self.buffer_size = buffer_size
+        self.prefix = prefix
+        self.recorded = 0
+        self.dropped = 0
+        self.closed_segments = []
+        self._sequence = 0
+        self._file = self._raw = self._path = None
+        self._bytes = 0
+        self._opened = self._flushed = None
+        self._thread = None
+
+    @classmethod
+    def from_env(cls, directory=None):
+        """A started recorder writing to `directory`, or the RECORD_DIRECTORY env variable,
+        None if neither is set
+        """
+        directory = directory or os.getenv("RECORD_DIRECTORY", "")
+        if not directory:
+            return None
+        return cls(directory).start()
+
+    def start(self):
+        """Start the writer thread, it is flushed and stopped at exit"""
+        if self._thread is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._thread = threading.Thread(target=self._run, name="snews-recorder", daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+        return self
+
+    def close(self, timeout=None):
+        """Write everything that is still queued, close the segment and stop the thread"""
+        if self._thread is None:
+            return
+        self.queue.put(_stop)
+        self._thread.join(timeout)
+        self._thread = None
+        atexit.unregister(self.close)
+
+    def record(self, message, received, error=None):
+        """Queue a raw message read from the stream
+
+        Parameters
+        ----------
+        message :
+            the message as read, a hop message or its content
+        received : `np.datetime64`
+            the time it was received
+        error : `str` or `Exception`, optional
+            why it could not be decoded, None if it was
+
+        """
+        payload = getattr(message, "content", message)
+        try:
+            self.queue.put_nowait((received, payload, error))
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                log.error(f"\t> Recorder queue is full, {self.dropped} messages not recorded")
+
+    def _segment_name(self):
+        self._sequence += 1
+        stamp = datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+        name = f"{self.prefix}-{stamp}-{self._sequence:04d}.jsonl{extensions[self.compression]}"
+        return os.path.join(self.directory, name)
+
+    def _open_segment(self):
+        self._path = self._segment_name()
+        self._raw = open(self._path + ".open", "wb", buffering=self.buffer_size)
+        compressor = _compressors.get(self.compression)
+        self._file = compressor(self._raw) if compressor else self._raw
+        self._bytes = 0
+        self._opened = self._flushed = time.monotonic()
+
+    def _close_segment(self):
+        if self._file is None:
+            return
+        if self._file is not self._raw:
+            self._file.close()
+        self._raw.close()
+        os.replace(self._path + ".open", self._path)
+        self.closed_segments.append(self._path)
+        self._file = self._raw = None
+        self._bytes = 0
+
+    def _write_chunk(self, lines):
+        if self._file is None:
+            self._open_segment()
+        data = b"".join(lines)
+        self._file.write(data)
+        self._bytes += len(data)
+        self.recorded += len(lines)
+
+    def _write(self, items):
+        # a backlog is split at max_bytes, a segment only goes over it with a single record
+        # larger than max_bytes
+        chunk, size = [], 0
+        for item in items:
+            line = record_line(*item).encode("utf-8")
+            if (chunk or self._bytes) and self._bytes + size + len(line) > self.max_bytes:
+                if chunk:
+                    self._write_chunk(chunk)
+                    chunk, size = [], 0
+                self._close_segment()
+            chunk.append(line)
+            size += len(line)
+        if chunk:
+            self._write_chunk(chunk)
+
+    def _flush_or_rotate(self):
+        if self._file is None:
+            return
+        now = time.monotonic()
+        if self._bytes >= self.max_bytes or now - self._opened >= self.max_age:
+            self._close_segment()
+        elif now - self._flushed >= self.flush_interval:
+            self._file.flush()
+            self._raw.flush()
+            self._flushed = now
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            try:
+                item = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                self._flush_or_rotate()
+                continue
+            pending = []
+            # everything queued so far goes out in one write
+            while True:
+                if item is _stop:
+                    stopping = True
+                    break
+                pending.append(item)
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            recorded = self.recorded
+            try:
+                self._write(pending)
+                self._flush_or_rotate()
+            except Exception as e:
+                lost = len(pending) - (self.recorded - recorded)
+                self.dropped += lost
+                log.error(f"\t> Could not record {lost} messages: {e}")
+        try:
+            self._close_segment()
+        except Exception as e:
+            log.error(f"\t> Could not close the recording {self._path}: {e}")
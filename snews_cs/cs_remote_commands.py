@@ -86,12 +86,9 @@ class Commands:
         default_connection_topic = "kafka://kafka.scimma.org/snews.connection-testing"
         connection_broker = os.getenv("CONNECTION_TEST_TOPIC", default_connection_topic)
 
-        from hop import Stream
-
-        stream = Stream(until_eos=True)
         msg = message.copy()
         msg["meta"]["status"] = "received"
-        with stream.open(connection_broker, "w") as s:
+        with CoincDeciderInstance.transport.open(connection_broker, "w", until_eos=True) as s:
             # insert back with a "received" status
             s.write(JSONBlob(msg))
             log.info(
@@ -238,14 +235,14 @@ class CommandHandler:
         self.username = self.input_message.get("detector_name", "TEST")
         self.entry = f"\n|{self.username}|"
 
-    def check_message_format(self):
-        formatter = SnewsFormat(self.input_message, log=log)
+    def check_message_format(self, now=None):
+        formatter = SnewsFormat(self.input_message, log=log, now=now)
         return formatter()
 
     def handle(self, CoincDeciderInstance):
         log.debug("\t> Handling message..\n")
-        # check if the message in stream has SnewsFormat
-        if not self.check_message_format():
+        # check if the message in stream has SnewsFormat, at the time of the distributor
+        if not self.check_message_format(CoincDeciderInstance.now()):
             log.error("\t> Message not in SnewsFormat! NO-GO")
             return False
         else:
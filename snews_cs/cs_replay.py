@@ -0,0 +1,305 @@
+"""
+Replay of recorded observation streams, without a broker
+
+The messages of a recording (JSON lines, optionally gzip, bz2 or xz compressed), either bare
+messages or the records of the raw payloads written by `cs_recorder`, go through the same
+`CommandHandler.handle` and `deal_with_the_cache` as the live stream. The alerts, emails
+and slack posts go to in-memory sinks, and the archive writes are only counted.
+The clock of the distributor follows the recorded times, so the format checks, the cache
+expiry and the uptime of the detectors see the times of the recording, not the time of
+the replay. The messages run back to back, or paced to their recorded times. The topics the commands
+write to (e.g. the reinserted test-connection messages) are in-memory queues.
+"""
+import contextlib
+import json
+import os
+import time
+import warnings
+from collections import Counter
+
+import numpy as np
+
+from .alert_pub import MemoryPublisher
+from .core.logging import getLogger
+from .cs_archive import MemoryArchive
+from .cs_far import MonteCarloFar
+from .cs_recorder import decode_payload, is_record, open_recording, segments
+from .cs_transport import MemoryTransport
+from .snews_coinc import CoincidenceDistributor
+from .snews_hb import HeartBeat
+
+log = getLogger(__name__)
+
+# commands that reach outside of the process, they are kept instead of executed
+offline_commands = ["Get-Feedback"]
+
+
+def message_time(message):
+    """The time the message was sent, None if it has no (valid) sent_time_utc"""
+    try:
+        return np.datetime64(message["sent_time_utc"], "ns")
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def read_record(record):
+    """The receive time and the message of a record of the recorder, the raw payload is
+    decoded as in the live loop (None if it can not be)
+    """
+    received = np.datetime64(record["received_time_utc"], "ns")
+    try:
+        message = CoincidenceDistributor.decode_content(decode_payload(record))
+    except Exception as e:
+        log.error(f"\t> Recorded payload could not be decoded: {e}")
+        message = None
+    return received, message
+
+
+def read_messages(path):
+    """The messages of a recording, in the recorded order
+
+    Yields
+    ------
+    (np.datetime64 or None, dict or None)
+        the time the message was received (or sent), if known, and the message, None if it
+        is not readable
+
+    """
+    with open_recording(path) as file:
+        line_number = 0
+        try:
+            for line_number, line in enumerate(file, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    message = json.loads(line)
+                except json.JSONDecodeError as e:
+                    log.error(f"\t> {path}:{line_number} is not a JSON message: {e}")
+                    yield None, None
+                    continue
+                if is_record(message):
+                    yield read_record(message)
+                else:
+                    yield message_time(message), message
+        except EOFError:
+            # a segment that was still written, readable up to its last flush
+            log.warning(f"\t> {path} ends after line {line_number}, it was not closed")
+
+
+class ReplayDistributor(CoincidenceDistributor):
+    """A `CoincidenceDistributor` that keeps everything in memory
+
+    The alerts are kept by the publishers (`alert.sent` and `test_alert.sent`), the emails
+    and slack posts that would have gone out in `emails` and `slack_posts`, and the commands
+    that reach outside of the process in `commands`. The topics are in memory
+    (`transport.topics`), and the database is not opened. The heartbeats start from scratch, and the false alarm rates come
+    from the analytic table.
+
+    Parameters
+    ----------
+    env_path : `str`, optional
+        path to env file
+    kwargs :
+        passed to `CoincidenceDistributor`
+
+    """
+
+    def __init__(self, env_path=None, server_tag="replay", send_email=True, transport=None,
+                 **kwargs):
+        # the recorded time of the message being replayed, None follows the system clock
+        self.clock = None
+        self.emails = []
+        self.slack_posts = []
+        self.commands = []
+        super().__init__(
+            env_path=env_path,
+            drop_db=False,
+            server_tag=server_tag,
+            send_email=send_email,
+            transport=transport or MemoryTransport(),
+            **kwargs,
+        )
+
+    def make_storage(self, drop_db=False):
+        return None
+
+    def make_publisher(self, **kwargs):
+        return MemoryPublisher(**kwargs)
+
+    def make_archive(self, env_path=None):
+        return MemoryArchive(keep=False)
+
+    def make_heartbeat(self, env_path=None, firedrill_mode=True):
+        return HeartBeat(
+            env_path=env_path,
+            firedrill_mode=firedrill_mode,
+            archive=self.archive,
+            restore=False,
+            share=False,
+            clock=self.now,
+        )
+
+    def make_far(self):
+        return MonteCarloFar(self.heartbeat.uptime, window=self.coinc_threshold, trials=0)
+
+    def make_recorder(self, directory=None):
+        return None
+
+    def now(self):
+        if self.clock is None:
+            return super().now()
+        return self.clock
+
+    def notify(self, alert_data, alert):
+        if self.send_email:
+            self.emails.append(alert)
+        if self.send_slack:
+            self.slack_posts.append(alert_data)
+
+    def handle_message(self, snews_message):
+        command = str(snews_message.get("id", "")).split("_")
+        if len(command) > 1 and command[1] in offline_commands:
+            self.commands.append(snews_message)
+            return False
+        return super().handle_message(snews_message)
+
+    @property
+    def alerts(self):
+        return self.alert.sent
+
+    @property
+    def test_alerts(self):
+        return self.test_alert.sent
+
+
+def percentiles(latencies):
+    """p50, p90, p99, max and mean of the latencies (s), in ms"""
+    if not len(latencies):
+        return {key: np.nan for key in ["p50", "p90", "p99", "max", "mean"]}
+    latencies = np.asarray(latencies) * 1e3
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+    return {
+        "p50": float(p50),
+        "p90": float(p90),
+        "p99": float(p99),
+        "max": float(latencies.max()),
+        "mean": float(latencies.mean()),
+    }
+
+
+def replay(paths, speed=0.0, distributor=None, env_path=None, quiet=True):
+    """Push the messages of recordings through a `ReplayDistributor`
+
+    Parameters
+    ----------
+    paths : `list` of `str`
+        the recordings, replayed one after the other, a directory stands for the closed
+        segments of the recorder in it
+    speed : `float`
+        0 runs the messages back to back, otherwise the recorded times are followed
+        `speed` times faster than real time (1 is real time)
+    distributor : `ReplayDistributor`, optional
+        the distributor to replay into, a new one by default
+    env_path : `str`, optional
+        path to env file, for a new distributor
+    quiet : `bool`
+        hide the terminal output of the distributor
+
+    Returns
+    -------
+    dict
+        the message counts, the throughput (messages/s), the latencies (ms) of the
+        messages, and the alerts that were published
+
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    paths = [p for path in paths for p in (segments(path) if os.path.isdir(path) else [path])]
+    distributor = distributor or ReplayDistributor(env_path=env_path)
+    counts = Counter()
+    latencies = []
+    first_time = first_wall = None
+    with contextlib.ExitStack() as stack:
+        if quiet:
+            devnull = stack.enter_context(open(os.devnull, "w"))
+            stack.enter_context(contextlib.redirect_stdout(devnull))
+            stack.enter_context(warnings.catch_warnings())
+            warnings.simplefilter("ignore")
+        started = time.perf_counter()
+        for path in paths:
+            for received, message in read_messages(path):
+                counts["messages"] += 1
+                if message is None:
+                    counts["unreadable"] += 1
+                    continue
+                if received is not None:
+                    distributor.clock = received
+                    if speed > 0:
+                        if first_time is None:
+                            first_time, first_wall = received, time.perf_counter()
+                        offset = (received - first_time) / np.timedelta64(1, "s") / speed
+                        wait = first_wall + offset - time.perf_counter()
+                        if wait > 0:
+                            time.sleep(wait)
+                tic = time.perf_counter()
+                try:
+                    cached = distributor.handle_message(message)
+                except Exception as e:
+                    log.error(f"\t> Replayed message failed: {e}\n{message}")
+                    counts["failed"] += 1
+                    continue
+                latencies.append(time.perf_counter() - tic)
+                counts["cached" if cached else "not_cached"] += 1
+        elapsed = time.perf_counter() - started
+    busy = float(np.sum(latencies))
+    return {
+        "messages": counts["messages"],
+        "cached": counts["cached"],
+        "not_cached": counts["not_cached"],
+        "unreadable": counts["unreadable"],
+        "failed": counts["failed"],
+        "elapsed": elapsed,
+        "busy": busy,
+        # messages per second of the replay, and per second spent handling them
+        "throughput": len(latencies) / elapsed if elapsed else np.nan,
+        "capacity": len(latencies) / busy if busy else np.nan,
+        "latency_ms": percentiles(latencies),
+        "alerts": list(distributor.alerts),
+        "test_alerts": list(distributor.test_alerts),
+        "emails": len(distributor.emails),
+        "slack_posts": len(distributor.slack_posts),
+        "commands": len(distributor.commands),
+        "archived": dict(distributor.archive.counts),
+    }
+
+
+def format_report(report):
+    """The report of `replay`, as text for the terminal"""
+    latency = report["latency_ms"]
+    lines = [
+        f"{'Messages':<22}: {report['messages']} ({report['cached']} cached, "
+        f"{report['not_cached']} not cached, {report['unreadable']} unreadable, "
+        f"{report['failed']} failed)",
+        f"{'Elapsed':<22}: {report['elapsed']:.3f} s ({report['busy']:.3f} s handling)",
+        f"{'Throughput':<22}: {report['throughput']:.1f} msg/s "
+        f"(capacity {report['capacity']:.1f} msg/s)",
+        f"{'Latency (ms)':<22}: p50 {latency['p50']:.3f}, p90 {latency['p90']:.3f}, "
+        f"p99 {latency['p99']:.3f}, max {latency['max']:.3f}",
+        f"{'Alerts':<22}: {len(report['alerts'])} ({len(report['test_alerts'])} test)",
+        f"{'Emails / slack posts':<22}: {report['emails']} / {report['slack_posts']}",
+        f"{'Offline commands':<22}: {report['commands']}",
+    ]
+    for alert in report["alerts"] + report["test_alerts"]:
+        lines.append(
+            f"\t> {alert['alert_type']:<20} {', '.join(alert['detector_names'])} "
+            f"(false alarm: {alert['False Alarm Prob']})"
+        )
+    return "\n".join(lines)
+
+
+def write_alerts(report, path):
+    """Write the alerts of a `replay` report to a file, as JSON lines"""
+    with open(path, "w") as file:
+        for alert in report["alerts"] + report["test_alerts"]:
+            file.write(json.dumps(alert, default=str) + "\n")
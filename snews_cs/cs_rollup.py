@@ -0,0 +1,193 @@
+"""
+Rollups of the heartbeats, for the long term history of the detectors
+
+The raw beats are deleted after a few days (HB_DELETE_AFTER). Before they are, they are
+aggregated per detector into minute, hour and day buckets. A bucket only keeps sums, extrema
+and a histogram of the (integer second) latencies, so buckets that were rolled up in several
+parts merge exactly, and the statistics are computed when the buckets are read.
+The minute and hour buckets are deleted in turn once they are older than their retention
+(HB_ROLLUP_MINUTE_DAYS, HB_ROLLUP_HOUR_DAYS), the day buckets are kept.
+"""
+import json
+import os
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+# resolution -> table, and the pandas frequency of its buckets
+rollup_tables = {
+    "minute": "heartbeat_rollup_minute",
+    "hour": "heartbeat_rollup_hour",
+    "day": "heartbeat_rollup_day",
+}
+bucket_frequency = {"minute": "min", "hour": "h", "day": "D"}
+resolutions = list(rollup_tables)
+
+rollup_columns = [
+    "detector",
+    "bucket_start",
+    "count",
+    "on_count",
+    "latency_min",
+    "latency_max",
+    "latency_sum",
+    "latency_histogram",
+    "interval_min",
+    "interval_max",
+    "interval_sum",
+    "interval_sumsq",
+]
+# how the stored columns of two parts of a bucket combine
+_merge = {
+    "count": "sum",
+    "on_count": "sum",
+    "latency_min": "min",
+    "latency_max": "max",
+    "latency_sum": "sum",
+    "interval_min": "min",
+    "interval_max": "max",
+    "interval_sum": "sum",
+    "interval_sumsq": "sum",
+}
+
+
+def aggregate(beats, resolution):
+    """Roll raw beats (rows of cached_heartbeats) up into the buckets of a resolution
+
+    Returns
+    -------
+    pd.DataFrame
+        one row of `rollup_columns` per detector and bucket, the histograms as Counters
+
+    """
+    if not len(beats):
+        return pd.DataFrame(columns=rollup_columns)
+    received = pd.to_datetime(beats["received_time_utc"], format="ISO8601")
+    df = pd.DataFrame(
+        {
+            "detector": beats["detector"].to_numpy(),
+            "bucket_start": received.dt.floor(bucket_frequency[resolution]).to_numpy(),
+            "on": (beats["status"].str.upper() == "ON").to_numpy(),
+            "latency": beats["latency"].to_numpy(dtype=np.int64),
+            "interval": beats["time_after_last"].to_numpy(dtype=float),
+        }
+    )
+    df["interval_sq"] = df["interval"] ** 2
+    keys = ["detector", "bucket_start"]
+    rolled = df.groupby(keys).agg(
+        count=("on", "size"),
+        on_count=("on", "sum"),
+        latency_min=("latency", "min"),
+        latency_max=("latency", "max"),
+        latency_sum=("latency", "sum"),
+        interval_min=("interval", "min"),
+        interval_max=("interval", "max"),
+        interval_sum=("interval", "sum"),
+        interval_sumsq=("interval_sq", "sum"),
+    )
+    histograms = {}
+    for (detector, start, latency), n in df.groupby([*keys, "latency"]).size().items():
+        histograms.setdefault((detector, start), Counter())[int(latency)] = int(n)
+    rolled["latency_histogram"] = [histograms[key] for key in rolled.index]
+    return rolled.reset_index()[rollup_columns]
+
+
+def combine(*parts):
+    """Merge rolled up parts, the rows that belong to the same bucket are added up"""
+    parts = [part for part in parts if len(part)]
+    if not parts:
+        return pd.DataFrame(columns=rollup_columns)
+    parts = pd.concat(parts, ignore_index=True)
+    keys = ["detector", "bucket_start"]
+    grouped = parts.groupby(keys)
+    merged = grouped.agg(_merge)
+    merged["latency_histogram"] = grouped["latency_histogram"].agg(
+        lambda histograms: sum(histograms, Counter())
+    )
+    return merged.reset_index()[rollup_columns]
+
+
+def to_rows(rolled, time_format):
+    """Tuples of `rollup_columns` values for the database"""
+    rolled = rolled.copy()
+    rolled["bucket_start"] = pd.to_datetime(rolled["bucket_start"]).dt.strftime(time_format)
+    rolled["latency_histogram"] = [
+        json.dumps({str(k): v for k, v in sorted(h.items())})
+        for h in rolled["latency_histogram"]
+    ]
+    return list(rolled.itertuples(index=False, name=None))
+
+
+def from_rows(rows):
+    """DataFrame of `rollup_columns` from database rows, the histograms as Counters"""
+    rolled = pd.DataFrame(rows, columns=rollup_columns)
+    rolled["bucket_start"] = pd.to_datetime(rolled["bucket_start"], format="ISO8601")
+    rolled["latency_histogram"] = [
+        Counter({int(k): v for k, v in json.loads(h).items()})
+        for h in rolled["latency_histogram"]
+    ]
+    return rolled
+
+
+def quantile(histogram, q):
+    """Quantile of the latencies counted in a histogram (the lowest latency that has at
+    least a fraction `q` of the beats at or below it)
+    """
+    if not histogram:
+        return np.nan
+    latencies = np.array(sorted(histogram))
+    counts = np.cumsum([histogram[k] for k in latencies])
+    return float(latencies[np.searchsorted(counts, q * counts[-1])])
+
+
+def summarize(rolled):
+    """The statistics of each bucket: count, ON/OFF fractions, latency min/mean/max/p95
+    and interval mean/std/min/max
+    """
+    def column(name):
+        return rolled[name].to_numpy(dtype=float)
+
+    count = column("count")
+    with np.errstate(invalid="ignore", divide="ignore"):
+        interval_mean = column("interval_sum") / count
+        variance = (column("interval_sumsq") - count * interval_mean**2) / (count - 1)
+        return pd.DataFrame(
+            {
+                "detector": rolled["detector"].to_numpy(dtype=object),
+                "bucket_start": pd.to_datetime(rolled["bucket_start"]).to_numpy(),
+                "count": count.astype(np.int64),
+                "on_fraction": column("on_count") / count,
+                "off_fraction": 1 - column("on_count") / count,
+                "latency_min": column("latency_min"),
+                "latency_mean": column("latency_sum") / count,
+                "latency_max": column("latency_max"),
+                "latency_p95": [quantile(h, 0.95) for h in rolled["latency_histogram"]],
+                "interval_mean": interval_mean,
+                "interval_std": np.sqrt(np.clip(variance, 0, None)),
+                "interval_min": column("interval_min"),
+                "interval_max": column("interval_max"),
+            }
+        )
+
+
+def retention():
+    """resolution -> days its buckets are kept before the raw beats that are deleted,
+    from the HB_ROLLUP_MINUTE_DAYS and HB_ROLLUP_HOUR_DAYS env variables (the day buckets
+    are kept)
+    """
+    return {
+        "minute": float(os.getenv("HB_ROLLUP_MINUTE_DAYS", "30")),
+        "hour": float(os.getenv("HB_ROLLUP_HOUR_DAYS", "730")),
+    }
+
+
+def pick_resolution(start, end, max_buckets=2000):
+    """The finest resolution that keeps a detector under `max_buckets` buckets in [start, end]"""
+    if start is None or end is None:
+        return "hour"
+    span = pd.Timestamp(end) - pd.Timestamp(start)
+    for resolution in ["minute", "hour"]:
+        if span / pd.Timedelta(1, bucket_frequency[resolution]) <= max_buckets:
+            return resolution
+    return "day"
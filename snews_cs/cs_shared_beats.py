@@ -0,0 +1,279 @@
+"""
+Heartbeats shared between processes through a memory-mapped file
+
+The coincidence process (`HeartBeat`) writes every beat it receives into a file of fixed
+per-detector rings, the feedback process (`FeedBack`) maps the same file and reads the new
+beats from memory, without a round trip to the database. The database keeps the durable
+history of the beats.
+
+There is a single writer and any number of readers, and no locks. Each detector slot has a
+sequence number that is odd while the writer changes the slot. A reader copies what it needs
+and starts over if the sequence number was odd, or changed in the meantime.
+"""
+import mmap
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from .core.logging import getLogger
+
+log = getLogger(__name__)
+
+magic = b"SNEWSHB1"
+header_dtype = np.dtype(
+    [
+        ("magic", "S8"),
+        ("slots", "<u4"),
+        ("capacity", "<u4"),
+        ("total", "<u8"),  # beats written to all the slots
+    ]
+)
+beat_dtype = np.dtype(
+    [
+        ("received", "<i8"),  # ns since epoch
+        ("stamped", "<i8"),
+        ("latency", "<i8"),
+        ("interval", "<f8"),
+        ("status", "S8"),
+    ]
+)
+
+
+def slot_dtype(capacity):
+    return np.dtype(
+        [
+            ("detector", "S32"),
+            ("sequence", "<u8"),  # odd while the slot is written
+            ("count", "<u8"),  # beats written to the slot so far
+            ("beats", beat_dtype, (capacity,)),
+        ]
+    )
+
+
+def run_directory():
+    """Where the files shared between the processes are, the SNEWS_RUN_DIR env variable,
+    or snews_cs in the temporary directory of the system
+    """
+    return os.getenv("SNEWS_RUN_DIR") or os.path.join(tempfile.gettempdir(), "snews_cs")
+
+
+def default_path():
+    """The file of the shared beats, from the HB_SHARED_BEATS env variable.
+    Relative paths are under the run directory, sharing is off if it is not set.
+    """
+    path = os.getenv("HB_SHARED_BEATS", "")
+    return os.path.join(run_directory(), path) if path else None
+
+
+class SharedBeats:
+    """Per-detector rings of the latest beats in a memory-mapped file
+
+    Use `SharedBeats.writer` in the process that receives the beats, and
+    `SharedBeats.reader` in the processes that follow them.
+
+    Parameters
+    ----------
+    path : `str`
+        the file
+    writable : `bool`
+        map the file for writing, only one process should do so
+    slots : `int`
+        number of detectors the file can hold, when it is created
+    capacity : `int`
+        number of beats kept per detector, when it is created
+
+    """
+
+    def __init__(self, path, writable=False, slots=64, capacity=1024):
+        self.path = path
+        self.writable = writable
+        if writable and not self._valid(path, slots, capacity):
+            self._create(path, slots, capacity)
+        with open(path, "r+b" if writable else "rb") as file:
+            self._map = mmap.mmap(
+                file.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ
+            )
+            self._inode = os.fstat(file.fileno()).st_ino
+        self.header = np.frombuffer(self._map, dtype=header_dtype, count=1)
+        if self.header["magic"][0] != magic:
+            raise ValueError(f"{path} is not a shared heartbeat file")
+        self.slots = int(self.header["slots"][0])
+        self.capacity = int(self.header["capacity"][0])
+        self.table = np.frombuffer(
+            self._map,
+            dtype=slot_dtype(self.capacity),
+            count=self.slots,
+            offset=header_dtype.itemsize,
+        )
+        self._slot_of = {}  # detector name -> slot
+        # reader: detector name -> number of its beats already read
+        self._cursor = {}
+        self._total = None
+
+    @classmethod
+    def writer(cls, path=None, **kwargs):
+        """Map the file for writing, None if sharing is turned off or not possible"""
+        path = path or default_path()
+        if path is None:
+            return None
+        try:
+            return cls(path, writable=True, **kwargs)
+        except (OSError, ValueError) as e:
+            log.error(f"\t> Heartbeats are not shared, could not map {path}: {e}")
+            return None
+
+    @classmethod
+    def reader(cls, path=None):
+        """Map the file for reading, None if it does not exist (yet)"""
+        path = path or default_path()
+        if path is None or not os.path.exists(path):
+            return None
+        try:
+            return cls(path)
+        except (OSError, ValueError) as e:
+            log.debug(f"\t> Could not map the shared heartbeats {path}: {e}")
+            return None
+
+    @staticmethod
+    def _valid(path, slots, capacity):
+        try:
+            header = np.fromfile(path, dtype=header_dtype, count=1)
+        except (OSError, ValueError):
+            return False
+        size = header_dtype.itemsize + slots * slot_dtype(capacity).itemsize
+        return (
+            len(header) == 1
+            and header["magic"][0] == magic
+            and header["slots"][0] == slots
+            and header["capacity"][0] == capacity
+            and os.path.getsize(path) == size
+        )
+
+    @staticmethod
+    def _create(path, slots, capacity):
+        # written aside and moved in place, readers never see a partial file
+        size = header_dtype.itemsize + slots * slot_dtype(capacity).itemsize
+        header = np.zeros(1, dtype=header_dtype)
+        header["magic"], header["slots"], header["capacity"] = magic, slots, capacity
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as file:
+            file.truncate(size)
+            file.write(header.tobytes())
+        os.replace(tmp, path)
+
+    def close(self):
+        self.header = self.table = None
+        self._map.close()
+
+    def stale(self):
+        """Whether the file was replaced (or removed) since it was mapped"""
+        try:
+            return os.stat(self.path).st_ino != self._inode
+        except OSError:
+            return True
+
+    def _slot(self, detector):
+        slot = self._slot_of.get(detector)
+        if slot is not None:
+            return slot
+        names = self.table["detector"]
+        name = detector.encode()
+        found = np.flatnonzero(names == name)
+        if len(found):
+            slot = int(found[0])
+        else:
+            free = np.flatnonzero(names == b"")
+            if not len(free):
+                raise ValueError(f"No free slot left for {detector} in {self.path}")
+            slot = int(free[0])
+            sequence = self.table["sequence"]
+            sequence[slot] += 1
+            names[slot] = name
+            self.table["count"][slot] = 0
+            sequence[slot] += 1
+        self._slot_of[detector] = slot
+        return slot
+
+    def write(self, detector, received, stamped, latency, interval, status):
+        """Add a beat to the ring of the detector, overwriting its oldest beat when full"""
+        slot = self._slot(detector)
+        sequence = self.table["sequence"]
+        count = self.table["count"]
+        sequence[slot] += 1
+        n = int(count[slot])
+        self.table["beats"][slot, n % self.capacity] = (
+            np.datetime64(received, "ns").astype(np.int64),
+            np.datetime64(stamped, "ns").astype(np.int64),
+            latency,
+            interval,
+            status.encode(),
+        )
+        count[slot] = n + 1
+        sequence[slot] += 1
+        self.header["total"] += 1
+
+    def changed(self):
+        """Whether beats were written since the last `read_new`"""
+        return self._total != int(self.header["total"][0])
+
+    def _read_slot(self, slot, retries=1000):
+        sequence = self.table["sequence"]
+        for _ in range(retries):
+            before = int(sequence[slot])
+            if before & 1:
+                time.sleep(0)
+                continue
+            detector = self.table["detector"][slot].decode()
+            count = int(self.table["count"][slot])
+            read = self._cursor.get(detector, 0)
+            if read > count:
+                # the writer started the slot over
+                read = 0
+            first = max(read, count - self.capacity)
+            beats = self.table["beats"][slot, np.arange(first, count) % self.capacity]
+            if int(sequence[slot]) == before:
+                if first > read:
+                    log.warning(f"\t> Missed {first - read} shared beats of {detector}")
+                return detector, count, beats
+        raise TimeoutError(f"Slot {slot} of {self.path} kept changing while read")
+
+    def read_new(self):
+        """The beats written since the last call, as rows of the cached_heartbeats table
+        (without id), oldest first for each detector
+        """
+        total = int(self.header["total"][0])
+        frames = []
+        if total != self._total:
+            for slot in np.flatnonzero(self.table["detector"] != b""):
+                detector, count, beats = self._read_slot(slot)
+                self._cursor[detector] = count
+                if len(beats):
+                    frames.append(
+                        pd.DataFrame(
+                            {
+                                "received_time_utc": beats["received"].astype("datetime64[ns]"),
+                                "detector": detector,
+                                "stamped_time_utc": beats["stamped"].astype("datetime64[ns]"),
+                                "latency": beats["latency"],
+                                "time_after_last": beats["interval"],
+                                "status": beats["status"].astype("U8"),
+                            }
+                        )
+                    )
+            self._total = total
+        if not frames:
+            return pd.DataFrame(
+                {
+                    "received_time_utc": np.array([], dtype="datetime64[ns]"),
+                    "detector": np.array([], dtype=object),
+                    "stamped_time_utc": np.array([], dtype="datetime64[ns]"),
+                    "latency": np.array([], dtype=np.int64),
+                    "time_after_last": np.array([], dtype=float),
+                    "status": np.array([], dtype=object),
+                }
+            )
+        return pd.concat(frames, ignore_index=True)
@@ -1,15 +1,30 @@
-import numpy as np
+import pandas as pd
 import math
 
+from .cs_far import default_table
+from .cs_uptime import UptimeIndex
+
 def ncr(n, r):
-    f = math.factorial
-    # if the HB cache is empty, n-r returns negative number for which factorial is not defined
-    # as a temporary fix, let's return 0
+    # if the HB cache is empty, n-r is negative, there is no such combination
     if n-r < 0:
         return 0
-    return int(f(n) / f(r) / f(n - r))
+    return math.comb(n, r)
+
+def online_detectors(cache_sub_list, hb_cache):
+    """ The detectors that were online during the neutrino times of a sub group,
+        from the uptime index (or the unique detectors of a heartbeat DataFrame).
+        The detectors of the sub group are online by definition.
+    """
+    coincident = set(cache_sub_list['detector_name'])
+    if isinstance(hb_cache, UptimeIndex):
+        nu_times = pd.to_datetime(cache_sub_list['neutrino_time_utc'], format="ISO8601")
+        live = hb_cache.live_during(nu_times.min().to_datetime64(), nu_times.max().to_datetime64())
+    else:
+        live = hb_cache['detector'].unique()
+    return coincident.union(live)
+
 
-def cache_false_alarm_rate(cache_sub_list, hb_cache):
+def cache_false_alarm_rate(cache_sub_list, hb_cache, time_window=10, table=None, monte_carlo=None):
     """ Assume false alarm rate of 1 per week
         returns the combined false alarm rate in years
         meaning; if there are 8 active detectors, each with false alarm rate of 1/week
@@ -21,17 +36,20 @@ def cache_false_alarm_rate(cache_sub_list, hb_cache):
 
             R_{combined} = C(n,r)+1 \times F_{im, d1} * F_{im, d2} ... * F_{im, dn} \times δt^{r-1}
 
+        The frequencies are looked up in a precomputed `cs_far.FalseAlarmTable`
+        (by default the one of the FAR_IMITATION_RATE(S) env variables)
+        If a `cs_far.MonteCarloFar` is given, and has an estimate for the time window and
+        the coincident detectors, its estimate is used.
     """
-    seconds_year = 31_556_926
-    seconds_week = 604800
-    single_imitation_freq = 1 / seconds_week  # 1/week in seconds
-    online_detectors = len(hb_cache.Detector.unique())            # n
-    coincident_detectors = len(cache_sub_list['detector_name'])   # r
-    time_window = 10  # seconds
-    combinations = ncr(online_detectors, coincident_detectors)
-    combined_imitation_freq = (combinations + 1) * np.power(single_imitation_freq, coincident_detectors) * np.power(
-        time_window, coincident_detectors - 1)
-    comb_Fim_year = combined_imitation_freq / seconds_year
-    return 1/comb_Fim_year
+    if monte_carlo is not None:
+        years = monte_carlo.years_between(
+            len(cache_sub_list['detector_name']), time_window, cache_sub_list['detector_name']
+        )
+        if years is not None:
+            return years
+    table = table or default_table()
+    online = online_detectors(cache_sub_list, hb_cache)               # n
+    coincident_detectors = list(cache_sub_list['detector_name'])      # r
+    return table.years_between(online, coincident_detectors, time_window)
 
 
@@ -0,0 +1,263 @@
+"""
+Transports of the SNEWS topics
+
+The coincidence loop, the alert publishers and the connection tests open their topics
+through a `Transport` instead of constructing `hop.Stream` themselves. A transport opens
+a topic for reading ("r") or writing ("w") like `hop.Stream.open`: the stream is a context
+manager, it is iterated to read and has `write` and `close`. The messages read have their
+payload in `content`, as the hop messages do.
+
+    hop               Kafka topics through hop-client (the default)
+    memory            in-process queues, one per topic
+    file:DIRECTORY    a JSON-lines file per topic, in the record format of `cs_recorder`
+
+The transport is chosen by the SNEWS_TRANSPORT env variable, or `snews_cs --transport`.
+Files of the file transport can be replayed with `snews_cs replay`.
+"""
+import abc
+import json
+import os
+import queue
+import re
+import threading
+import time
+from functools import lru_cache
+
+import numpy as np
+from hop import Stream
+
+from .cs_recorder import decode_payload, record_line
+
+# marks the end of a memory topic
+_end = object()
+
+
+class Envelope:
+    """A message read from a memory or file topic, the payload is in `content`"""
+
+    __slots__ = ("content",)
+
+    def __init__(self, content):
+        self.content = content
+
+    def __repr__(self):
+        return f"Envelope({self.content!r})"
+
+
+def payload_of(message):
+    """What goes on the wire: the string or bytes of a message, dicts (e.g. the alerts
+    and JSONBlob contents) as JSON
+    """
+    payload = getattr(message, "content", message)
+    if isinstance(payload, (str, bytes)):
+        return payload
+    return json.dumps(payload, default=str)
+
+
+class Transport(abc.ABC):
+    """Opens the streams of the topics"""
+
+    # whether a read topic that ends is opened again (broker disconnects), otherwise the
+    # end of the topic is the end of the input
+    reconnect = False
+
+    @abc.abstractmethod
+    def open(self, topic, mode="r", until_eos=False, **kwargs):
+        """Open a topic
+
+        Parameters
+        ----------
+        topic : `str`
+            the topic, e.g. kafka://kafka.scimma.org/snews.experiments-test
+        mode : `str`
+            "r" to read, "w" to write
+        until_eos : `bool`
+            stop reading at the end of the topic, instead of waiting for new messages
+        kwargs :
+            options of the transport, e.g. `auth` of hop
+
+        """
+
+
+class HopTransport(Transport):
+    """Kafka topics through hop-client
+
+    Parameters
+    ----------
+    auth : `bool`
+        use the hop-auth credentials, unless `open` is given its own
+
+    """
+
+    reconnect = True
+
+    def __init__(self, auth=True):
+        self.auth = auth
+
+    def open(self, topic, mode="r", until_eos=False, auth=None, **kwargs):
+        auth = self.auth if auth is None else auth
+        return Stream(until_eos=until_eos, auth=auth).open(topic, mode)
+
+
+class MemoryStream:
+    def __init__(self, topic_queue, mode, until_eos):
+        self.queue = topic_queue
+        self.mode = mode
+        self.until_eos = until_eos
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        pass
+
+    def write(self, message):
+        self.queue.put(payload_of(message))
+
+    def __iter__(self):
+        while True:
+            try:
+                payload = self.queue.get_nowait() if self.until_eos else self.queue.get()
+            except queue.Empty:
+                return
+            if payload is _end:
+                return
+            yield Envelope(payload)
+
+
+class MemoryTransport(Transport):
+    """In-process topics, each a queue. A message goes to one of the readers of its topic.
+
+    Parameters
+    ----------
+    maxsize : `int`
+        messages a topic holds, writing waits when it is full (0 for no limit)
+
+    """
+
+    def __init__(self, maxsize=0):
+        self.maxsize = maxsize
+        self.topics = {}
+        self._lock = threading.Lock()
+
+    def queue(self, topic):
+        """The queue of a topic"""
+        with self._lock:
+            if topic not in self.topics:
+                self.topics[topic] = queue.Queue(self.maxsize)
+            return self.topics[topic]
+
+    def open(self, topic, mode="r", until_eos=False, **kwargs):
+        return MemoryStream(self.queue(topic), mode, until_eos)
+
+    def end(self, topic):
+        """End the topic, its reader stops once it has read what was written before"""
+        self.queue(topic).put(_end)
+
+    def pending(self, topic):
+        """The payloads written to a topic and not read yet"""
+        with self.queue(topic).mutex:
+            return [p for p in self.queue(topic).queue if p is not _end]
+
+
+class FileStream:
+    def __init__(self, path, mode, follow, poll_interval):
+        self.path = path
+        self.mode = mode
+        self.follow = follow
+        self.poll_interval = poll_interval
+        self._file = None
+        if mode == "w":
+            self._file = open(path, "a", encoding="utf-8")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def write(self, message):
+        # a line at a time, the readers of the file see complete records
+        self._file.write(record_line(np.datetime64("now", "ns"), payload_of(message)))
+        self._file.flush()
+
+    def __iter__(self):
+        while self.follow and not os.path.exists(self.path):
+            time.sleep(self.poll_interval)
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, encoding="utf-8") as file:
+            self._file = file
+            partial = ""
+            while True:
+                line = file.readline()
+                if not line.endswith("\n"):
+                    # the end of the file, maybe in the middle of a line being written
+                    partial += line
+                    if not self.follow:
+                        return
+                    time.sleep(self.poll_interval)
+                    continue
+                line, partial = partial + line, ""
+                if line.strip():
+                    yield Envelope(decode_payload(json.loads(line)))
+
+
+class FileTransport(Transport):
+    """Topics in local files, one JSON-lines file per topic, in the record format of
+    `cs_recorder` (so `snews_cs replay` reads them)
+
+    Parameters
+    ----------
+    directory : `str`
+        where the files of the topics are, created if needed
+    follow : `bool`
+        keep reading the files as they grow, instead of stopping at their end
+    poll_interval : `float`
+        seconds between two looks at a file that has no new line
+
+    """
+
+    def __init__(self, directory, follow=False, poll_interval=0.1):
+        self.directory = directory
+        self.follow = follow
+        self.poll_interval = poll_interval
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, topic):
+        """The file of a topic, named after the last part of its URL"""
+        name = topic.rstrip("/").rsplit("/", 1)[-1] or "default"
+        return os.path.join(self.directory, re.sub(r"[^\w.-]", "_", name) + ".jsonl")
+
+    def open(self, topic, mode="r", until_eos=False, **kwargs):
+        return FileStream(
+            self.path(topic), mode, self.follow and not until_eos, self.poll_interval
+        )
+
+
+@lru_cache(maxsize=None)
+def _transport(spec):
+    kind, _, argument = spec.partition(":")
+    if kind == "hop":
+        return HopTransport()
+    if kind == "memory":
+        return MemoryTransport()
+    if kind == "file":
+        return FileTransport(argument or "snews_cs_topics")
+    raise ValueError(f"Unknown transport {spec}, use hop, memory or file:DIRECTORY")
+
+
+def get_transport(spec=None):
+    """The transport of a spec (hop, memory or file:DIRECTORY), by default the one of the
+    SNEWS_TRANSPORT env variable, or hop. The same spec gives the same transport, so the
+    parts of a process share its topics.
+    """
+    return _transport(spec or os.getenv("SNEWS_TRANSPORT") or "hop")
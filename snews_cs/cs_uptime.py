@@ -0,0 +1,156 @@
+"""
+Index of the periods in which each detector was online
+
+A detector is live from an ON heartbeat until its next beat is overdue (the `tolerance`
+after the beat), or until it reports OFF. The live periods of a detector are kept as
+sorted, disjoint intervals, so "which detectors were live at T" and "how many were live
+during [T0, T1]" take a binary search per detector. The index is changed by the ingest
+thread and read by the false alarm thread, `snapshot` copies it consistently.
+"""
+import threading
+from bisect import bisect_left, bisect_right
+
+import numpy as np
+
+
+def to_ns(time):
+    return int(np.datetime64(time, "ns").astype(np.int64))
+
+
+class UptimeIndex:
+    """Live intervals of each detector, built from their heartbeats
+
+    Parameters
+    ----------
+    tolerance : `float`
+        seconds a detector stays live after an ON beat, unless a beat gives its own
+
+    """
+
+    def __init__(self, tolerance=300.0):
+        self.tolerance = tolerance
+        # detector -> sorted starts and ends (ns) of its disjoint live intervals
+        self.starts = {}
+        self.ends = {}
+        self._last_beat = {}
+        # held while the intervals change, and while they are copied
+        self.lock = threading.Lock()
+
+    def __contains__(self, detector):
+        return detector in self.starts
+
+    @property
+    def detectors(self):
+        return list(self.starts)
+
+    def intervals(self, detector):
+        """The live intervals of a detector, as (start, end) datetimes"""
+        return [
+            (np.datetime64(start, "ns"), np.datetime64(end, "ns"))
+            for start, end in zip(self.starts.get(detector, []), self.ends.get(detector, []))
+        ]
+
+    def add(self, detector, time, status, tolerance=None):
+        """Add a beat, beats of a detector are expected in the order they were received"""
+        with self.lock:
+            self._add(detector, to_ns(time), status, tolerance)
+
+    def _add(self, detector, time, status, tolerance):
+        starts = self.starts.setdefault(detector, [])
+        ends = self.ends.setdefault(detector, [])
+        if time < self._last_beat.get(detector, time):
+            # too late to change the index without rebuilding it
+            return
+        self._last_beat[detector] = time
+        if str(status).upper() != "ON":
+            # a detector that reports OFF is not live from then on
+            if ends and ends[-1] > time:
+                ends[-1] = time
+                if ends[-1] <= starts[-1]:
+                    starts.pop()
+                    ends.pop()
+            return
+        tolerance = self.tolerance if tolerance is None else tolerance
+        end = time + int(tolerance * 1e9)
+        if ends and ends[-1] >= time:
+            ends[-1] = max(ends[-1], end)
+        else:
+            starts.append(time)
+            ends.append(end)
+
+    @classmethod
+    def from_beats(cls, beats, tolerance=300.0):
+        """Build the index from a DataFrame of heartbeats (the cached_heartbeats columns)
+
+        Parameters
+        ----------
+        beats : `pd.DataFrame`
+            the beats, in any order
+        tolerance : `float` or `dict`
+            seconds a detector stays live after an ON beat, or detector -> seconds
+            (detectors that are missing get the default)
+
+        """
+        default = tolerance if np.isscalar(tolerance) else 300.0
+        index = cls(default)
+        for detector, group in beats.groupby("detector"):
+            group = group.sort_values("received_time_utc", kind="stable")
+            times = group["received_time_utc"].to_numpy(dtype="datetime64[ns]").astype(np.int64)
+            on = (group["status"].str.upper() == "ON").to_numpy()
+            tol = default if np.isscalar(tolerance) else tolerance.get(detector, default)
+            # an ON beat is live until the tolerance runs out, or the next OFF beat
+            off_times = np.where(on, np.iinfo(np.int64).max, times)
+            next_off = np.minimum.accumulate(off_times[::-1])[::-1]
+            next_off = np.append(next_off[1:], np.iinfo(np.int64).max)
+            starts = times[on]
+            ends = np.minimum(times + int(tol * 1e9), next_off)[on]
+            # the ends never decrease, an interval that starts after the previous end is new
+            keep = starts < ends
+            starts, ends = starts[keep], ends[keep]
+            new = np.ones(len(starts), dtype=bool)
+            new[1:] = starts[1:] > ends[:-1]
+            first = np.flatnonzero(new)
+            last = np.append(first[1:], len(starts)) - 1
+            index.starts[detector] = starts[first].tolist()
+            index.ends[detector] = ends[last].tolist()
+            index._last_beat[detector] = int(times[-1])
+        return index
+
+    def snapshot(self):
+        """A consistent copy of the intervals, detector -> (starts, ends) as int64 (ns)"""
+        with self.lock:
+            return {
+                detector: (
+                    np.array(self.starts[detector], dtype=np.int64),
+                    np.array(self.ends[detector], dtype=np.int64),
+                )
+                for detector in self.starts
+            }
+
+    def is_live(self, detector, time):
+        """Whether the detector was live at the given time"""
+        time = to_ns(time)
+        starts = self.starts.get(detector, [])
+        i = bisect_right(starts, time) - 1
+        return i >= 0 and self.ends[detector][i] > time
+
+    def live_at(self, time):
+        """The detectors that were live at the given time"""
+        return [detector for detector in self.starts if self.is_live(detector, time)]
+
+    def live_during(self, start, end):
+        """The detectors that were live at some point in [start, end]"""
+        start, end = to_ns(start), to_ns(end)
+        live = []
+        for detector, ends in self.ends.items():
+            # the first interval that ends after the start
+            i = bisect_left(ends, start + 1)
+            if i < len(ends) and self.starts[detector][i] <= end:
+                live.append(detector)
+        return live
+
+    def live_count(self, start, end=None):
+        """Number of detectors live at `start`, or at some point in [start, end]"""
+        if end is None:
+            return len(self.live_at(start))
+        return len(self.live_during(start, end))
@@ -1,3 +1,7 @@
+import os
+import sqlite3
+import threading
+import time
 from pathlib import Path
 
 from sqlalchemy import create_engine
@@ -9,14 +13,117 @@ log = getLogger(__name__)
 db_file_path = Path(__file__).parent.parent / "snews_cs.db"
 
 
+def database_path():
+    """The database file, the SNEWS_DB_FILE env variable, or snews_cs.db next to the package"""
+    return Path(os.getenv("SNEWS_DB_FILE") or db_file_path)
+
+
+# how long (s) a connection waits for a lock before giving up, and how often a locked
+# write is retried after that
+busy_timeout = 30.0
+lock_retries = 5
+# prepared statements kept per connection, keyed by their SQL text
+cached_statements = 256
+
+# one shared entry per database file, see `_SharedFile`
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+class _SharedFile:
+    """The engine and the per-thread connections of a single database file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.engine = create_engine(f"sqlite:///{path}", creator=self.connect)
+        self.local = threading.local()
+
+    def connect(self):
+        connection = sqlite3.connect(
+            self.path,
+            timeout=busy_timeout,
+            cached_statements=cached_statements,
+            check_same_thread=False,
+        )
+        # WAL lets the readers go on while a writer commits, and never blocks the writer
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute(f"PRAGMA busy_timeout={int(busy_timeout * 1000)}")
+        return connection
+
+    def thread_connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = self.local.connection = self.connect()
+            self.local.cursor = connection.cursor()
+        return connection
+
+
+def _shared_file(path):
+    key = str(Path(path).resolve())
+    with _registry_lock:
+        if key not in _registry:
+            _registry[key] = _SharedFile(key)
+        return _registry[key]
+
+
+def is_locked(error):
+    """Whether an exception is SQLite telling that the database is busy"""
+    return isinstance(error, sqlite3.OperationalError) and (
+        "locked" in str(error) or "busy" in str(error)
+    )
+
+
 class Database():
+    """
+    Access to a SQLite database file.
+
+    All the `Database` instances of a file share one SQLAlchemy engine, and each thread
+    gets its own connection (and cursor) to the file. The connections use WAL journaling
+    and wait up to `busy_timeout` seconds for locks.
+    """
+
     def __init__(self, db_file_path: Path | str) -> None:
         self.db_file_path = db_file_path
-        self.engine = create_engine(f"sqlite:///{self.db_file_path}")
-        self.connection = self.engine.raw_connection()
-        self.cursor = self.connection.cursor()
+        self._shared = _shared_file(db_file_path)
+        self.engine = self._shared.engine
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """The connection of the calling thread"""
+        return self._shared.thread_connection()
 
-        pass
+    @property
+    def cursor(self) -> sqlite3.Cursor:
+        """The cursor of the calling thread"""
+        self._shared.thread_connection()
+        return self._shared.local.cursor
+
+    def close(self) -> None:
+        """
+        Closes the connection of the calling thread, a new one is opened when needed.
+        """
+        local = self._shared.local
+        connection = getattr(local, "connection", None)
+        if connection is not None:
+            connection.close()
+            local.connection = local.cursor = None
+
+    def retry(self, write, *args, retries=None, **kwargs):
+        """
+        Runs `write(*args, **kwargs)`, and runs it again (after a rollback) if the database
+        stayed locked for longer than the busy timeout.
+        """
+        retries = lock_retries if retries is None else retries
+        for attempt in range(retries + 1):
+            try:
+                return write(*args, **kwargs)
+            except sqlite3.OperationalError as e:
+                if not is_locked(e) or attempt == retries:
+                    raise
+                self.connection.rollback()
+                log.error(f"\t> Database is locked, retrying ({attempt + 1}/{retries}): {e}")
+                time.sleep(0.1 * 2**attempt)
 
     def initialize_database(self, sql_schema_path: Path | str) -> None:
         """
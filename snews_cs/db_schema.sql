@@ -48,6 +48,20 @@ CREATE TABLE IF NOT EXISTS coincidence_tier_archive (
     expiration TEXT
 );
 
+-- the messages in the coincidence cache, follows the cache (the archive above keeps them all)
+CREATE TABLE IF NOT EXISTS coincidence_tier_cache (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    message_id TEXT,
+    schema_version REAL,
+    detector_name TEXT,
+    p_val REAL,
+    neutrino_time_utc TEXT,
+    sent_time_utc TEXT,
+    machine_time_utc TEXT,
+    meta TEXT,
+    expiration TEXT
+);
+
 CREATE TABLE IF NOT EXISTS coincidence_tier_alerts (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     message_id TEXT,
@@ -71,3 +85,85 @@ CREATE TABLE IF NOT EXISTS cached_heartbeats (
     time_after_last BIGINT,
     status TEXT
 );
+
+-- heartbeats aggregated per detector and minute, hour or day, before they are deleted
+CREATE TABLE IF NOT EXISTS heartbeat_rollup_minute (
+    detector TEXT,
+    bucket_start DATETIME,
+    count INTEGER,
+    on_count INTEGER,
+    latency_min BIGINT,
+    latency_max BIGINT,
+    latency_sum BIGINT,
+    latency_histogram TEXT,
+    interval_min REAL,
+    interval_max REAL,
+    interval_sum REAL,
+    interval_sumsq REAL,
+    PRIMARY KEY (detector, bucket_start)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS heartbeat_rollup_hour (
+    detector TEXT,
+    bucket_start DATETIME,
+    count INTEGER,
+    on_count INTEGER,
+    latency_min BIGINT,
+    latency_max BIGINT,
+    latency_sum BIGINT,
+    latency_histogram TEXT,
+    interval_min REAL,
+    interval_max REAL,
+    interval_sum REAL,
+    interval_sumsq REAL,
+    PRIMARY KEY (detector, bucket_start)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS heartbeat_rollup_day (
+    detector TEXT,
+    bucket_start DATETIME,
+    count INTEGER,
+    on_count INTEGER,
+    latency_min BIGINT,
+    latency_max BIGINT,
+    latency_sum BIGINT,
+    latency_histogram TEXT,
+    interval_min REAL,
+    interval_max REAL,
+    interval_sum REAL,
+    interval_sumsq REAL,
+    PRIMARY KEY (detector, bucket_start)
+) WITHOUT ROWID;
+
+-- lookups by message id (retract, update), expiry and time range queries
+CREATE INDEX IF NOT EXISTS idx_all_mgs_message_id ON all_mgs (message_id);
+CREATE INDEX IF NOT EXISTS idx_all_mgs_expiration ON all_mgs (expiration);
+CREATE INDEX IF NOT EXISTS idx_all_mgs_received_time ON all_mgs (received_time);
+
+CREATE INDEX IF NOT EXISTS idx_sig_tier_message_id ON sig_tier_archive (message_id);
+CREATE INDEX IF NOT EXISTS idx_sig_tier_expiration ON sig_tier_archive (expiration);
+CREATE INDEX IF NOT EXISTS idx_sig_tier_sent_time ON sig_tier_archive (sent_time_utc);
+CREATE INDEX IF NOT EXISTS idx_sig_tier_detector_time ON sig_tier_archive (detector_name, sent_time_utc);
+
+CREATE INDEX IF NOT EXISTS idx_time_tier_message_id ON time_tier_archive (message_id);
+CREATE INDEX IF NOT EXISTS idx_time_tier_expiration ON time_tier_archive (expiration);
+CREATE INDEX IF NOT EXISTS idx_time_tier_sent_time ON time_tier_archive (sent_time_utc);
+CREATE INDEX IF NOT EXISTS idx_time_tier_detector_time ON time_tier_archive (detector_name, sent_time_utc);
+
+CREATE INDEX IF NOT EXISTS idx_coinc_tier_message_id ON coincidence_tier_archive (message_id);
+CREATE INDEX IF NOT EXISTS idx_coinc_tier_expiration ON coincidence_tier_archive (expiration);
+CREATE INDEX IF NOT EXISTS idx_coinc_tier_sent_time ON coincidence_tier_archive (sent_time_utc);
+CREATE INDEX IF NOT EXISTS idx_coinc_tier_detector_time ON coincidence_tier_archive (detector_name, sent_time_utc);
+CREATE INDEX IF NOT EXISTS idx_coinc_tier_neutrino_time ON coincidence_tier_archive (neutrino_time_utc);
+
+CREATE INDEX IF NOT EXISTS idx_coinc_cache_message_id ON coincidence_tier_cache (message_id);
+
+CREATE INDEX IF NOT EXISTS idx_coinc_alerts_message_id ON coincidence_tier_alerts (message_id);
+CREATE INDEX IF NOT EXISTS idx_coinc_alerts_sent_time ON coincidence_tier_alerts (sent_time_utc);
+
+CREATE INDEX IF NOT EXISTS idx_heartbeats_received_time ON cached_heartbeats (received_time_utc);
+CREATE INDEX IF NOT EXISTS idx_heartbeats_detector_time ON cached_heartbeats (detector, received_time_utc);
+
+CREATE INDEX IF NOT EXISTS idx_rollup_minute_time ON heartbeat_rollup_minute (bucket_start);
+CREATE INDEX IF NOT EXISTS idx_rollup_hour_time ON heartbeat_rollup_hour (bucket_start);
+CREATE INDEX IF NOT EXISTS idx_rollup_day_time ON heartbeat_rollup_day (bucket_start);
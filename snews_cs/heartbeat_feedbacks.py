@@ -1,8 +1,8 @@
+import heapq
 import json
 import os
+import time
 from datetime import UTC, datetime, timedelta
-from pathlib import Path
-from time import sleep
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -10,8 +10,10 @@ import pandas as pd
 
 from .core.logging import getLogger
 from .cs_email import send_feedback_mail, send_warning_mail
-from .database import Database
-from .snews_hb import beats_path
+from .cs_shared_beats import SharedBeats
+from .database import Database, database_path
+from .snews_hb import DetectorStats, beats_path
+from .snews_sql import heartbeat_columns, heartbeat_time_format
 
 # from sqlalchemy import create_engine
 
@@ -38,16 +40,67 @@ def vprint(inp, _bool):
     print(inp) if _bool else None
 
 
-# SQLite database for the cached heartbeats
-cache_db = Database(db_file_path=Path(__file__).parent.parent / "snews_cs.db")
-cache_engine = cache_db.engine
-cache_df = None
+def cache_db():
+    """The SQLite database of the cached heartbeats"""
+    return Database(db_file_path=database_path())
+
+
+def utc_now():
+    """Current UTC time as a numpy datetime (us precision)"""
+    return np.datetime64(datetime.now(UTC).replace(tzinfo=None), "us")
+
+
+class DeadlineScheduler:
+    """Priority queue of the time each detector is due to be checked.
+    A detector has at most one deadline, scheduling it again replaces the previous one.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._deadline = {}  # detector -> its current deadline
+
+    def __len__(self):
+        return len(self._deadline)
+
+    def schedule(self, detector, deadline):
+        self._deadline[detector] = deadline
+        heapq.heappush(self._heap, (deadline, detector))
+
+    def cancel(self, detector):
+        self._deadline.pop(detector, None)
+
+    def _drop_stale(self):
+        # entries that were replaced or cancelled stay in the heap until they surface
+        while self._heap and self._deadline.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def next_deadline(self):
+        """The earliest deadline, None if nothing is scheduled"""
+        self._drop_stale()
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now):
+        """Remove and return the detectors whose deadline is not after `now`"""
+        due = []
+        while self.next_deadline() is not None and self._heap[0][0] <= now:
+            _, detector = heapq.heappop(self._heap)
+            del self._deadline[detector]
+            due.append(detector)
+        return due
 
 
 class FeedBack:
-    """Once every minute, check the HB of each detector.
+    """Check the HB of each detector when it is due.
     If the last heartbeat is from longer than usual, send an email
     Once every user-defined time interval, send a plot with latency and frequency statistics
+
+    Each detector is due when its next beat is overdue (last beat + mean + 3 sigma of its
+    recent intervals, see `DetectorStats.overdue_after`).
+    The loop sleeps until the earliest of these deadlines, and looks for new beats at least
+    every `poll_interval` seconds (the beats arrive in the coincidence process, so there is
+    nothing in this process to wake the loop up earlier). When the coincidence
+    process shares its beats (see `SharedBeats`), they are read from memory every
+    `shared_poll_interval` seconds instead, and the database is only read at start.
     """
 
     def __init__(self, verbose=False):
@@ -55,93 +108,174 @@ class FeedBack:
         self.last_feedback_time = dict()
         for k in self.detectors:
             self.last_feedback_time[k] = np.datetime64("2022-01-01")
+        # running statistics of the recent beats of each detector, reset after a warning
+        self.stats = dict()
+        self.stats_alpha = float(os.getenv("HB_STATS_ALPHA", "0.1"))
+        self.stats_window = int(os.getenv("HB_STATS_WINDOW", "256"))
         self.day_in_min = 1440
         self.running_min = 0
         self.db_found = False
         self.verbose = verbose
+        # when each detector is next due to be checked
+        self.scheduler = DeadlineScheduler()
+        self.poll_interval = float(os.getenv("HB_POLL_INTERVAL", "10"))  # seconds
+        # largest id of the cached_heartbeats rows read so far
+        self.watermark = 0
+        self.shared = None
+        self.shared_poll_interval = float(os.getenv("HB_SHARED_POLL_INTERVAL", "1"))
         log.info("\t> Heartbeat tracking initiated.")
 
     def __call__(self):
-        """Continuously run and check expected heartbeats every minute
+        """Continuously run and check the detectors when their next heartbeat is overdue
         Also, check if the detectors requested feedbacks
         create and send feedbacks with the desired time intervals
         """
+        next_cleanup = utc_now()
         while True:
-            # run every minute
-            sleep(1)
-            # The database is continuosly updated, read it every minute
-            # it will wait until it finds a database
-            df = self.dataframe_from_db_table()
-            self.control(df)  # check if a detector is taking longer than usual (mean+3*sigma>)
-            self.running_min += 1
-            vprint(f"[DEBUG] >>>>> Running minute: {self.running_min}", self.verbose)
-
-            if (self.running_min % 60) == 0:
-                self.running_min = 0  # reset the counter
+            # The beats are continuosly updated, look for new ones
+            df = self.read_beats()
+            if df is not None:
+                self.update_schedule(self.ingest(df))
+            # check only the detectors that are due (mean+3*sigma> since their last beat)
+            self.check_due(utc_now())
+
+            now = utc_now()
+            if now >= next_cleanup:
+                next_cleanup = now + np.timedelta64(1, "h")
                 delete_old_figures()
-
-    def dataframe_from_db_table(self):
-        """Try to read the database, if it is empty (or does not exist) wait"""
-        cache_df = pd.read_sql_table(
-            "cached_heartbeats",
-            cache_engine,
-            parse_dates=[
-                "received_time_utc",
-                "stamped_time_utc",
-            ],
-        )
-
-        return cache_df
-
-    def control(self, df):
-        """Check the current cache, check if any detector
-        missed a beat
-
+            # sleep until the next deadline, or the next poll
+            timeout = self.poll_interval if self.shared is None else self.shared_poll_interval
+            deadline = self.scheduler.next_deadline()
+            if deadline is not None:
+                timeout = min(timeout, max((deadline - now) / np.timedelta64(1, "s"), 0))
+            time.sleep(timeout)
+            vprint(f"[DEBUG] >>>>> {len(self.scheduler)} detectors scheduled", self.verbose)
+
+    def deadline(self, detector):
+        """Time when the next beat of the detector is overdue, None if not known yet"""
+        stats = self.stats.get(detector)
+        # the same estimate as the warning, from the recent intervals
+        wait = None if stats is None else stats.overdue_after()
+        if wait is None:
+            return None
+        return stats.last_received + np.timedelta64(int(np.ceil(wait * 1e6)), "us")
+
+    def update_schedule(self, detectors):
+        """Reschedule the given detectors, after their beats changed"""
+        for detector in detectors:
+            deadline = self.deadline(detector)
+            if deadline is None:
+                self.scheduler.cancel(detector)
+            else:
+                self.scheduler.schedule(detector, deadline)
+
+    def check_due(self, now):
+        """Check the detectors whose deadline has passed"""
+        for detector in self.scheduler.pop_due(now):
+            stats = self.stats[detector]
+            self.check_missed_beats(stats, detector)
+            if self.last_feedback_time.get(detector) != stats.last_received:
+                # not warned (e.g. the clock was just short of the deadline), look again
+                self.scheduler.schedule(detector, now + np.timedelta64(1, "s"))
+
+    def ingest(self, df):
+        """Update the statistics of each detector with its beats from the last 24 hours
+        that were not seen before, returns the detectors that had new beats
         """
         # get the heartbeats of this detector from last 24 hours
-        current_time_utc = np.datetime64("now", "us")  # 's' for second precision
+        current_time_utc = utc_now()
         hearbeats_past_24h = df[
             df["received_time_utc"] > current_time_utc - np.timedelta64(24, "h")
-        ].sort_values("received_time_utc")
-
-        for detector in hearbeats_past_24h["detector"].unique():
-            detector_df = hearbeats_past_24h.query("detector==@detector")
-            # For a given detector, if already sent an email,
-            # ignore the beats before that email. Otherwise, the same cause would ruin the
-            # statistics.
-            after_last_hb = self.last_feedback_time[detector]
-            detector_df = detector_df[detector_df["received_time_utc"] > after_last_hb]
-            detector_df.sort_values("received_time_utc", inplace=True)
-
-            if len(detector_df) < 5:
-                vprint(
-                    f"[DEBUG] >>>>> len {len(detector_df)} Not enough!", self.verbose
-                )
-                continue
-            # check if a heartbeat is skipped
-            self.check_missed_beats(detector_df, detector)
-
-    def check_missed_beats(self, df, detector):
-        """Check if a heartbeat is skipped"""
+        ]
+
+        # only the beats that were not seen before update the statistics
+        last_seen = pd.Series(
+            {detector: stats.last_received for detector, stats in self.stats.items()},
+            dtype="datetime64[ns]",
+        )
+        seen_until = hearbeats_past_24h["detector"].map(last_seen)
+        new = hearbeats_past_24h[
+            seen_until.isna() | (hearbeats_past_24h["received_time_utc"] > seen_until)
+        ]
+        # one pass over the new beats, grouped by detector
+        new = new.sort_values(["detector", "received_time_utc"], kind="stable")
+        detectors, starts = np.unique(new["detector"].to_numpy(), return_index=True)
+        ends = np.append(starts[1:], len(new))
+        received = new["received_time_utc"].to_numpy()
+        latency = new["latency"].to_numpy(dtype=float)
+        interval = new["time_after_last"].to_numpy(dtype=float)
+        for detector, start, end in zip(detectors, starts, ends):
+            if detector not in self.stats:
+                self.stats[detector] = DetectorStats(self.stats_alpha, self.stats_window)
+            self.stats[detector].update_many(
+                received[start:end], latency[start:end], interval[start:end]
+            )
+        return list(detectors)
+
+    def new_beats(self):
+        """Read the beats that were added to the database since the last call,
+        i.e. the rows with an id above the watermark. If the table was emptied or rebuilt,
+        it is read again from the start.
+        """
+        try:
+            last_id = cache_db().cursor.execute(
+                "SELECT MAX(id) FROM cached_heartbeats"
+            ).fetchone()[0]
+        except Exception as e:
+            # no table (with an id) yet
+            vprint(f"[DEBUG] >>>>> No heartbeats to read: {e}", self.verbose)
+            return pd.DataFrame(columns=["id", *heartbeat_columns])
+        if last_id is None or last_id < self.watermark:
+            self.watermark = 0
+        df = pd.read_sql_query(
+            "SELECT * FROM cached_heartbeats WHERE id > ? ORDER BY id",
+            cache_db().connection,
+            params=(self.watermark,),
+        )
+        for column in ["received_time_utc", "stamped_time_utc"]:
+            df[column] = pd.to_datetime(df[column], format="ISO8601")
+        if len(df):
+            self.watermark = int(df["id"].iloc[-1])
+        return df
+
+    def read_beats(self):
+        """The new beats, from the shared file of the coincidence process if there is one,
+        otherwise from the database. None if the shared file did not change.
+        """
+        if self.shared is not None and not self.shared.stale():
+            return self.shared.read_new() if self.shared.changed() else None
+        # (re)map the shared file, the history before it comes from the database
+        self.shared = SharedBeats.reader()
+        df = self.new_beats().drop(columns="id")
+        if self.shared is not None:
+            df = pd.concat([df, self.shared.read_new()], ignore_index=True)
+            df.drop_duplicates(["detector", "received_time_utc"], inplace=True)
+        return df
+
+    def check_missed_beats(self, stats, detector):
+        """Check if a heartbeat is skipped, from the running statistics of the detector"""
         vprint("\n[DEBUG] >>>>> Checking if beat skipped", self.verbose)
 
-        mean = df["time_after_last"].mean()
-        std = df["time_after_last"].std()
+        wait = stats.overdue_after()
+        if wait is None:
+            return None
+        mean = stats.interval.mean
+        std = stats.interval.std()
 
-        last_hb_time_utc = df["received_time_utc"].values[-1]
+        last_hb_time_utc = stats.last_received
 
-        seconds_since_lasthb = (np.datetime64("now") - last_hb_time_utc) / np.timedelta64(1, "s")
+        seconds_since_lasthb = (utc_now() - last_hb_time_utc) / np.timedelta64(1, "s")
 
         vprint(
-            f"[DEBUG] >>>>> mean:{mean:.2f}, std:{std:.2f}, trigger at {mean + 3 * std:.2f}",
+            f"[DEBUG] >>>>> mean:{mean:.2f}, std:{std:.2f}, trigger at {wait:.2f}",
             self.verbose,
         )
         vprint(
             f"[DEBUG] >>>>> Delay since last: {seconds_since_lasthb:.2f}", self.verbose
         )
 
-        if seconds_since_lasthb > (mean + 3 * std):
-            if last_hb_time_utc == self.last_feedback_time[detector]:
+        if seconds_since_lasthb > wait:
+            if last_hb_time_utc == self.last_feedback_time.get(detector):
                 return None
 
             expected_hb_time_utc = np.datetime_as_string(
@@ -162,6 +296,7 @@ class FeedBack:
             # send warning to detector
             send_warning_mail(detector, text)
             self.last_feedback_time[detector] = last_hb_time_utc
+            stats.reset()
         return None
 
     # TODO: Implement this
@@ -172,17 +307,27 @@ class FeedBack:
         pass
 
 
+def recent_beats(detector, hours=24, now=None):
+    """The stored beats of a detector received in the last `hours`, oldest first"""
+    now = utc_now() if now is None else now
+    since = pd.Timestamp(now - np.timedelta64(int(hours * 3600), "s"))
+    df = pd.read_sql_query(
+        "SELECT * FROM cached_heartbeats WHERE detector = ? AND received_time_utc > ? "
+        "ORDER BY received_time_utc",
+        cache_db().connection,
+        params=(detector, since.strftime(heartbeat_time_format)),
+    )
+    for column in ["received_time_utc", "stamped_time_utc"]:
+        df[column] = pd.to_datetime(df[column], format="ISO8601")
+    return df
+
+
 def check_frequencies_and_send_mail(detector, given_contact=None):
-    """Create a plot with latency and heartbeat frequencies
+    """Create a plot with latency and heartbeat frequencies of the last 24 hours
     and send it via emails
     """
-    # df = pd.read_csv(mirror_csv, parse_dates=['Received Times'], )
-    df = pd.read_sql_table(
-        "cached_heartbeats",
-        cache_engine,
-        parse_dates=["received_time_utc", "stamped_time_utc"],
-    )
-    df.query("detector==@detector", inplace=True)
+    # the stored beats are kept for days (HB_DELETE_AFTER), the report covers one
+    df = recent_beats(detector, hours=24)
     now_str = datetime.now(UTC).strftime("%Y-%m-%d_%HH%MM")
     mean = np.mean(df["time_after_last"])
     std = np.std(df["time_after_last"])
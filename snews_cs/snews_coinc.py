@@ -1,3 +1,4 @@
+import bisect
 import json
 import os
 import pickle
@@ -9,16 +10,19 @@ from datetime import datetime
 import adc.errors
 import click
 import numpy as np
-import pandas as pd
-from hop import Stream
 
 from . import cs_utils, snews_bot
 from .alert_pub import AlertPublisher
+from .cs_archive import ArchiveWriter
 from .core.logging import getLogger
 from .cs_alert_schema import CoincidenceTierAlert
+from .cs_cache import ObservationStore, detector_bits, detector_code, to_nanoseconds
 from .cs_email import send_email
+from .cs_far import MonteCarloFar
+from .cs_recorder import MessageRecorder
 from .cs_remote_commands import CommandHandler
 from .cs_stats import cache_false_alarm_rate
+from .cs_transport import get_transport
 from .snews_hb import HeartBeat
 from .snews_sql import Storage
 
@@ -47,31 +51,127 @@ class CacheManager:
     """
     This class handles all the incoming data to the SNEWS CS Cache,
     adding messages, organizing sub-groups, retractions and updating cache entries
+
+    The observations live in an `ObservationStore` (compact columnar arrays) and are kept
+    sorted by neutrino time. A new message joins every sub-group whose initial message is
+    at most `coincidence_window` seconds earlier. If there is none, it forms the sub-groups
+    of the messages up to one coincidence window before and after it, unless they are
+    already held by another sub-group. Both are found with binary searches, over the initial
+    times of the sub-groups and over the times of the messages.
+    Each sub-group also keeps a bitmask of its detectors (bit = detector code), and each
+    detector the set of sub-groups it is in, so membership checks never scan the cache.
+    A DataFrame view of the cache is only built when `cache` is accessed.
     """
 
-    def __init__(self):
-        # define the col names of the cache df
-        self.cache = pd.DataFrame(
-            columns=[
-                "id",
-                "detector_name",
-                "received_time",
-                "machine_time_utc",
-                "neutrino_time_utc",
-                "neutrino_time_as_datetime",
-                "p_val",
-                "meta",
-                "sub_group",
-                "neutrino_time_delta",
-            ]
-        )
+    def __init__(self, coincidence_window=10.0, track_changes=False):
+        # with track_changes the store keeps the changed messages, for the archive
+        self.store = ObservationStore(track_changes=track_changes)
+        # sub group tag -> list of slots in the store, sorted by neutrino time
+        self.sub_groups = {}
+        # sub group tag -> bitmask of its detectors, and detector code -> sub group tags
+        self.sub_group_mask = {}
+        self.detector_groups = {}
+        self.window = int(coincidence_window * 1e9)  # in ns, same unit as the store
+        # all slots sorted by neutrino time, and their times for the binary searches
+        self._order = []
+        self._times = []
+        # (initial time, tag) of the sub groups, sorted, and the sub groups of each slot
+        self._initials = []
+        self._initial_of = {}
+        self._groups_of = {}
+        # the first message of an empty cache is in sub group 0, the others form the
+        # sub groups (tag, tag + 1) before and after them
+        self._next_tag = 1
+        self._view = None
         # keep track of updated sub groups
         self.updated = []
+        # sub groups changed by the last operation -> their message count (0 if dropped)
+        self.changed_groups = {}
+        # expiry metrics, messages and sub groups dropped because they got too old
+        self.expired_messages = 0
+        self.expired_sub_groups = 0
         self.msg_state = None
         # this dict is used to store the current state of each sub group in the cache,
         # UPDATE, COINCIDENT, None, RETRACTION.
         self.sub_group_state = {}
 
+    @property
+    def cache(self):
+        """DataFrame view of the cache, only rebuilt after the cache has changed"""
+        if self._view is None:
+            self._view = self.store.frame(self.sub_groups)
+        return self._view
+
+    def sub_group_frame(self, sub_group_tag):
+        """DataFrame view of a single sub group"""
+        return self.store.frame({sub_group_tag: self.sub_groups[sub_group_tag]})
+
+    def group_size(self, sub_group_tag):
+        """Number of messages in the given sub group"""
+        return len(self.sub_groups.get(sub_group_tag, ()))
+
+    def _set_members(self, sub_group_tag, members):
+        """Set the members of a sub group, and keep the membership indexes in sync"""
+        if sub_group_tag in self.sub_groups:
+            self._drop_group(sub_group_tag)
+        members = sorted(members, key=self._position)
+        mask = self.store.mask_of(members)
+        self.sub_groups[sub_group_tag] = members
+        self.sub_group_mask[sub_group_tag] = mask
+        for code in detector_bits(mask):
+            self.detector_groups.setdefault(code, set()).add(sub_group_tag)
+        for slot in members:
+            self._groups_of.setdefault(slot, set()).add(sub_group_tag)
+        initial = (self._time_of(members[0]), sub_group_tag)
+        bisect.insort(self._initials, initial)
+        self._initial_of[sub_group_tag] = initial
+
+    def _drop_group(self, sub_group_tag):
+        """Remove a sub group, returns its detector bitmask"""
+        for slot in self.sub_groups.pop(sub_group_tag):
+            self._groups_of[slot].discard(sub_group_tag)
+        mask = self.sub_group_mask.pop(sub_group_tag)
+        for code in detector_bits(mask):
+            self.detector_groups[code].discard(sub_group_tag)
+        initial = self._initial_of.pop(sub_group_tag)
+        del self._initials[bisect.bisect_left(self._initials, initial)]
+        return mask
+
+    def _code_of(self, slot):
+        return int(self.store.detector[slot])
+
+    def _time_of(self, slot):
+        return int(self.store.nu_time[slot])
+
+    def _position(self, slot):
+        """Index of the slot in the time ordered list"""
+        i = bisect.bisect_left(self._times, self._time_of(slot))
+        while self._order[i] != slot:
+            i += 1
+        return i
+
+    def _insert(self, message):
+        """Store a message and place it in the time ordered list, returns its slot"""
+        slot = self.store.add(message)
+        nu_time = self._time_of(slot)
+        i = bisect.bisect_right(self._times, nu_time)
+        self._times.insert(i, nu_time)
+        self._order.insert(i, slot)
+        return slot
+
+    def _remove(self, slot):
+        """Take a slot out of the time ordered list and free it, it must not be in a
+        sub group anymore"""
+        i = self._position(slot)
+        del self._times[i]
+        del self._order[i]
+        self._groups_of.pop(slot, None)
+        self.store.remove(slot)
+
+    def _in_cache(self, detector_name):
+        """Whether a sub group holds a message of the detector"""
+        return bool(self.detector_groups.get(detector_code(detector_name)))
+
     def add_to_cache(self, message):
         """
         Takes in SNEWS message and checks if it is a retraction, update or new addition to cache.
@@ -87,19 +187,17 @@ class CacheManager:
             print("RETRACTING MESSAGE FROM")
             self.cache_retraction(retraction_message=message)
             return None  # break if message is meant for retraction
+        self.changed_groups = {}
         message["neutrino_time_as_datetime"] = np.datetime64(
             message["neutrino_time_utc"]
         )
         # update
-        if message["detector_name"] in self.cache["detector_name"].to_list():
+        if self._in_cache(message["detector_name"]):
             self._update_message(message)
         # regular add
         else:
             self._manage_cache(message)
-            self.cache = self.cache.sort_values(
-                by=["sub_group", "neutrino_time_delta"], ignore_index=True
-            )
-            self.cache = self.cache.reset_index(drop=True)
+        self._view = None
 
     def _manage_cache(self, message):
         """
@@ -116,21 +214,20 @@ class CacheManager:
         """
 
         # if the cache is empty add the message to cache, declare state of sub group 0 as INITIAL
-        if len(self.cache) == 0:
+        if not self._order:
             print("Initial Message!!")
-            message["neutrino_time_delta"] = 0
-            message["sub_group"] = 0
+            self._set_members(0, [self._insert(message)])
             self.sub_group_state[0] = "INITIAL"
-            self.cache = pd.DataFrame([message])
+            self.changed_groups[0] = 1
         # if the cache is not empty, check if the message is coincident with other sub groups
         else:
             self._check_coinc_in_subgroups(message)
 
     def _check_coinc_in_subgroups(self, message):
-        """This method either:
-
-            A)Adds Message to an existing sub-group, if coincident with the initial signal
+        """This method places a new message in the time ordered cache, and either:
 
+            A) Adds the message to the existing sub-groups whose initial message is
+            at most one coincidence window earlier
 
             B) If NOT coincident with any sub groups it creates two new sub groups,
             setting the message as their initial time.
@@ -145,92 +242,43 @@ class CacheManager:
             SNEWS message
 
         """
-        # grab the current sub group tags
-        sub_group_tags = self.cache["sub_group"].unique()
-        #  this boolean declares whether if the message is not coincident
-        is_coinc = False
-        for tag in sub_group_tags:
-
-            # query the cache, select the current sub group
-            sub_cache = self.cache.query("sub_group==@tag")
-            #  reset the index, for the sake of keeping things organized
-            sub_cache = sub_cache.reset_index(drop=True)
-            # select the initial nu time of the sub group
-            sub_ini_t = sub_cache["neutrino_time_as_datetime"].min()
-            #  make the nu time delta series
-            delta = np_datetime_delta_sec(
-                t_2=message["neutrino_time_as_datetime"], t_1=sub_ini_t
-            )
-            #  if the message's nu time is within the coincidence window
-            if 0 < delta <= 10.0:
-                # to the message add the corresponding sub group and nu time delta
-                message["sub_group"] = tag
-                message["neutrino_time_delta"] = delta
-                # turn the message into a pd df, this is for concatenating it to the cache
-                temp = pd.DataFrame([message])
-                # concat the message df to the cahce
-                self.cache = pd.concat([self.cache, temp], ignore_index=True)
-                #  set the message as coinc
-                is_coinc = True
-                #  declare the state the sub group to COINC_MSG
-                self.sub_group_state[tag] = "COINC_MSG"
-
-        # if the message is not coincident with any of the sub groups create a new sub group
-        if not is_coinc:
-            # set the message's nu time, as the initial nu time
-            new_ini_t = message["neutrino_time_as_datetime"]
-            # create the sub group tag
-            new_sub_tag = len(sub_group_tags)
-            #  turn the message into a df
-            message_as_cache = pd.DataFrame([message])
-            #  create a temp cache concat the message
-            temp_cache = pd.concat([self.cache, message_as_cache], ignore_index=True)
-            #  drop dublicates of detector name and nu time
-            temp_cache = temp_cache.drop_duplicates(
-                subset=["detector_name", "neutrino_time_utc"]
-            )
-            # create  a new time delta
-            temp_cache["neutrino_time_delta"] = np_datetime_delta_sec(
-                t_1=new_ini_t, t_2=temp_cache["neutrino_time_as_datetime"]
-            )
-            # Make two subgroup one for early signal and post
-            new_sub_group_early = temp_cache.query("-10 <= neutrino_time_delta <= 0")
-            new_sub_group_post = temp_cache.query("0 <= neutrino_time_delta <= 10.0")
-            # drop old sub-group col or pandas will scream at you
-            new_sub_group_post = new_sub_group_post.drop(columns="sub_group", axis=0)
-            new_sub_group_early = new_sub_group_early.drop(columns="sub_group", axis=0)
-            # make new sub-group tag
-            new_sub_group_early["sub_group"] = new_sub_tag
-            new_sub_group_post["sub_group"] = int(new_sub_tag + 1)
-            # sort sub-group by nu time
-            new_sub_group_early = new_sub_group_early.sort_values(
-                by="neutrino_time_as_datetime"
-            )
-            new_sub_group_post = new_sub_group_post.sort_values(
-                by="neutrino_time_as_datetime"
-            )
-            # check if new sub groups are the same:
-            # if so, drop the later one
-            if (
-                new_sub_group_early["id"].to_list()
-                == new_sub_group_post["id"].to_list()
-            ):
-                new_sub_group_post = new_sub_group_post.drop(
-                    columns="sub_group", axis=0
-                )
-                new_sub_group_post["sub_group"] = new_sub_tag
-                self._organize_cache(sub_cache=new_sub_group_post)
-            #  organize the cache
-            else:
-                self._organize_cache(sub_cache=new_sub_group_post)
-                self._organize_cache(sub_cache=new_sub_group_early)
+        slot = self._insert(message)
+        nu_time = self._time_of(slot)
+        # the sub groups that started at most one coincidence window earlier
+        lo = bisect.bisect_left(self._initials, (nu_time - self.window,))
+        hi = bisect.bisect_left(self._initials, (nu_time,))
+        coincident = [tag for _, tag in self._initials[lo:hi]]
+        for tag in coincident:
+            self._set_members(tag, self.sub_groups[tag] + [slot])
+            #  declare the state the sub group to COINC_MSG
+            self.sub_group_state[tag] = "COINC_MSG"
+            self.changed_groups[tag] = self.group_size(tag)
+        if coincident:
+            return
+
+        # the messages up to one coincidence window before, and after the new one
+        first = bisect.bisect_left(self._times, nu_time - self.window)
+        start = bisect.bisect_left(self._times, nu_time)
+        end = bisect.bisect_right(self._times, nu_time)
+        last = bisect.bisect_right(self._times, nu_time + self.window)
+        early, post = self._order[first:end], self._order[start:last]
+        new_sub_tag = self._next_tag
+        self._next_tag += 2
+        # if the new sub groups are the same, only keep one
+        if (first, end) == (start, last):
+            self._organize_cache(new_sub_tag, post)
+        else:
+            self._organize_cache(new_sub_tag + 1, post)
+            self._organize_cache(new_sub_tag, early)
+
+    def _check_for_redundancies(self, members):
+        """Checks if a new sub group is redundant; a single message that is already in
+        a sub group, or detectors that are all in one of the sub groups
 
-    def _check_for_redundancies(self, sub_cache):
-        """Checks if sub cache is redundant
         Parameters
         ----------
-        sub_cache : dataframe
-            New sub group
+        members : list
+            slots of the new sub group
 
         Returns
         -------
@@ -239,86 +287,43 @@ class CacheManager:
             False if sub cache is unique
 
         """
-        # create a series of the ids in the sub group
-        ids = sub_cache["id"]
-
-        # if this sub group only contains a single message and the detector name is already
-        # present in the cache return True
-        if (
-            len(sub_cache) == 1
-            and sub_cache["id"].to_list()[0] in self.cache["id"].to_list()
-        ):
+        if len(members) == 1 and self._groups_of.get(members[0]):
             return True
-        #  loop through the other sub group tags
-        for sub_tag in self.cache["sub_group"].unique():
-            # save the other sub groups as a df
-            other_sub = self.cache.query("sub_group == @sub_tag")
-            # check if the current sub group's ids are in the other sub group
-            check_ids = ids.isin(other_sub["id"])
-            # if the ids are in the other sub group, return True
-            if check_ids.eq(True).all():
+        mask = self.store.mask_of(members)
+        # only the sub groups of one of its detectors can hold all of them, and they must
+        # hold the same messages (a sub group can have an earlier message of a detector)
+        for sub_tag in self.detector_groups.get(self._code_of(members[0]), ()):
+            if mask & ~self.sub_group_mask[sub_tag] == 0 and set(members) <= set(
+                self.sub_groups[sub_tag]
+            ):
                 return True
         return False
 
-    def _organize_cache(self, sub_cache):
-        """
-        This method makes sure that the nu_delta_times are not negative,
-        recalculates new deltas using the proper initial time
+    def _organize_cache(self, sub_group_tag, members):
+        """Add a new sub group, unless it is redundant
 
         Parameters
         ----------
-        sub_cache : dataframe
-            Sub group
+        sub_group_tag : int
+            tag of the new sub group
+        members : list
+            slots of the new sub group, sorted by neutrino time
 
         """
-        #  if the sub is redundant then return out of the
-        if self._check_for_redundancies(sub_cache):
+        if self._check_for_redundancies(members):
             return
-        # for the sake of keeping things organized reset the index of the sub group
-        sub_cache = sub_cache.reset_index(drop=True)
-        # if the initial nu time is negative then fix it by passing the sub group to fix_deltas
-        if sub_cache["neutrino_time_delta"][0] < 0:
-            sub_cache = self._fix_deltas(sub_df=sub_cache)
-        if len(sub_cache) > 1:
+        self._set_members(sub_group_tag, members)
+        if len(members) > 1:
             #  set the state of the sub group to COINC_MSG_STAGGERED
-            self.sub_group_state[sub_cache["sub_group"][0]] = "COINC_MSG_STAGGERED"
+            self.sub_group_state[sub_group_tag] = "COINC_MSG_STAGGERED"
         else:
-            self.sub_group_state[sub_cache["sub_group"][0]] = None
-        # concat to the cache
-        self.cache = pd.concat([self.cache, sub_cache], ignore_index=True)
-        #  sort the values of the cache by their sub group and nu time ( ascending order)
-        self.cache = self.cache.sort_values(
-            by=["sub_group", "neutrino_time_as_datetime"]
-        ).reset_index(drop=True)
-
-    def _fix_deltas(self, sub_df):
-        """
-        This method fixes the deltas of the sub group by resetting the initial nu time
-        Parameters
-        ----------
-        sub_df : Dataframe
-            Sub cache
-
-        Returns
-        -------
-        sub_df : Dataframe
-            Sub cache with fixed nu time deltas
-
-        """
-        #  find the new initial nu time
-        initial_time = sub_df["neutrino_time_as_datetime"].min()
-        #  drop the old delta col
-        sub_df = sub_df.drop(columns="neutrino_time_delta", axis=0)
-        #  make the new delta col
-        sub_df["neutrino_time_delta"] = np_datetime_delta_sec(
-            t_1=initial_time, t_2=sub_df["neutrino_time_as_datetime"]
-        )
-        #  sort the nu times by ascending order
-        sub_df = sub_df.sort_values(by=["neutrino_time_as_datetime"])
-        return sub_df
+            self.sub_group_state[sub_group_tag] = None
+        self.changed_groups[sub_group_tag] = len(members)
 
     def _update_message(self, message):
         """If triggered this method updates the p_val and neutrino time of a detector in cache.
+        The message is only replaced in the sub groups whose initial message is within one
+        coincidence window of the update, the other sub groups keep the earlier message.
 
         Parameters
         ----------
@@ -335,57 +340,42 @@ class CacheManager:
         # announce that an update is happening
         update_message = f"\t> UPDATING MESSAGE FROM: {update_detector}"
         log.info(update_message)
-        # get indices of where the detector name is present
-        detector_ind = self.cache.query(
-            "detector_name==@update_detector"
-        ).index.to_list()
-        #  loop through the indices
-        for ind in detector_ind:
-            # get the sub tag
-            sub_tag = self.cache["sub_group"][ind]
+        code = detector_code(update_detector)
+        nu_time = to_nanoseconds(message["neutrino_time_utc"])
+        sub_tags = sorted(self.detector_groups[code])
+        replaced = []
+        for sub_tag in sub_tags:
             #  declare the state of the sub group as UPDATE
             self.sub_group_state[sub_tag] = "UPDATE"
-            #  get the initial nu time of the sub group
-            initial_time = self.cache.query("sub_group==@sub_tag")[
-                "neutrino_time_as_datetime"
-            ].min()
             # ignore update if the updated message is outside the coincident window
-            if (
-                abs(
-                    np_datetime_delta_sec(
-                        t_2=message["neutrino_time_as_datetime"], t_1=initial_time
-                    )
-                )
-                > 10.0
-            ):
-                continue
-            # update the message if it is coincident with the current sub group
-            else:
-                #  find the ind to be updated and replace its contents with
-                for key in message.keys():
-                    self.cache.at[ind, key] = message[key]
-                self.cache.at[ind, "neutrino_time_delta"] = np_datetime_delta_sec(
-                    t_2=message["neutrino_time_as_datetime"], t_1=initial_time
-                )
-                # append the updated list
-                self.updated.append(self.cache["sub_group"][ind])
-
-        # if there are any updated sub groups reorganize them
-        if len(self.updated) != 0:
-            # loop through updated sub group list
-            for sub_tag in self.updated:
-                #  make a sub group df
-                sub_df = self.cache.query("sub_group == @sub_tag")
-                # dump the unorganized subgroup
-                self.cache = self.cache.query("sub_group != @sub_tag")
-                # fix deltas of updated sub group
-                sub_df = self._fix_deltas(sub_df)
-                # concat the organized sub group with the rest of the cache
-                self.cache = pd.concat([self.cache, sub_df], ignore_index=True)
-                #  sort the values of the cache by sub group nu time
-                self.cache = self.cache.sort_values(
-                    by=["sub_group", "neutrino_time_as_datetime"]
-                ).reset_index(drop=True)
+            initial_time = self._initial_of[sub_tag][0]
+            if abs(nu_time - initial_time) <= self.window:
+                replaced.append(sub_tag)
+        if replaced:
+            self._replace(message, code, replaced)
+        for sub_tag in sub_tags:
+            self.changed_groups[sub_tag] = self.group_size(sub_tag)
+
+    def _replace(self, message, code, replaced):
+        """Put an update in the place of the earlier messages of its detector, in the
+        given sub groups"""
+        # take the earlier messages out of these sub groups, free the ones no other
+        # sub group holds, then put the update in their place
+        kept, earlier = {}, set()
+        for sub_tag in replaced:
+            members = self.sub_groups[sub_tag]
+            kept[sub_tag] = [s for s in members if self._code_of(s) != code]
+            earlier.update(s for s in members if self._code_of(s) == code)
+        for slot in earlier:
+            if self._groups_of[slot] <= set(replaced):
+                for sub_tag in list(self._groups_of[slot]):
+                    self._drop_group(sub_tag)
+                self._remove(slot)
+        slot = self._insert(message)
+        for sub_tag in replaced:
+            self._set_members(sub_tag, kept[sub_tag] + [slot])
+            # append the updated list
+            self.updated.append(sub_tag)
 
     def cache_retraction(self, retraction_message):
         """
@@ -400,35 +390,69 @@ class CacheManager:
 
         """
 
+        self.changed_groups = {}
         retracted_name = retraction_message["detector_name"]
-        self.cache = self.cache.query("detector_name!=@retracted_name")
-        logstr = retracted_name
-        # in case retracted message was an initial
-        if len(self.cache) == 0:
-            return 0
-        for sub_tag in self.cache["sub_group"].unique():
-            self.sub_group_state[sub_tag] = "RETRACTION"
-            other_sub = self.cache.query("sub_group == @sub_tag")
-            if other_sub["neutrino_time_delta"].min() != 0.0:
-                if len(other_sub) == 1:
-                    other_sub = other_sub.drop(columns=["neutrino_time_delta"])
-                    other_sub["neutrino_time_delta"] = [0]
-
-                else:
-                    # set new initial nu time
-                    new_initial_time = other_sub["neutrino_time_as_datetime"].min()
-                    # drop the old delta
-                    other_sub = other_sub.drop(columns=["neutrino_time_delta"])
-                    #  make new delta
-                    other_sub["neutrino_time_delta"] = np_datetime_delta_sec(
-                        t_2=other_sub["neutrino_time_as_datetime"], t_1=new_initial_time
-                    )
-                # concat retracted sub group to the cache
-                self.cache = self.cache.query("sub_group!=@sub_tag")
-                self.cache = pd.concat([self.cache, other_sub], ignore_index=True)
-                self.cache = self.cache.sort_values(by="neutrino_time_utc").reset_index()
+        code = detector_code(retracted_name)
+        affected = sorted(self.detector_groups.get(code, ()))
+        slots = {
+            slot
+            for sub_tag in affected
+            for slot in self.sub_groups[sub_tag]
+            if self._code_of(slot) == code
+        }
+        for slot in slots:
+            self._discard(slot)
+        for sub_tag in affected:
+            if sub_tag in self.sub_groups:
+                self.sub_group_state[sub_tag] = "RETRACTION"
             # log retraction to log file
-            log.info(f"\t> Retracted {logstr} from sub-group {sub_tag}")
+            log.info(f"\t> Retracted {retracted_name} from sub-group {sub_tag}")
+        self._view = None
+
+    def _discard(self, slot):
+        """Take the message in the given slot out of the cache, the sub groups that
+        are left empty are dropped"""
+        for sub_tag in sorted(self._groups_of.get(slot, ())):
+            members = [s for s in self.sub_groups[sub_tag] if s != slot]
+            if members:
+                self._set_members(sub_tag, members)
+            else:
+                self._drop_group(sub_tag)
+                self.sub_group_state.pop(sub_tag, None)
+            self.changed_groups[sub_tag] = len(members)
+        self._remove(slot)
+
+    def expire(self, cutoff):
+        """Drop the messages whose neutrino time is older than the cutoff.
+        The time ordered cache is the priority queue; the oldest message is always first.
+        The sub groups changed by the expiry are in `changed_groups` but they get no state,
+        expiry never triggers an alert.
+
+        Parameters
+        ----------
+        cutoff : int
+            neutrino time (ns) before which messages are expired
+
+        Returns
+        -------
+        int
+            number of expired messages
+
+        """
+        self.changed_groups = {}
+        expired = 0
+        while self._times and self._times[0] < cutoff:
+            self._discard(self._order[0])
+            expired += 1
+        for sub_tag, count in self.changed_groups.items():
+            if count:
+                self.sub_group_state[sub_tag] = None
+            else:
+                self.expired_sub_groups += 1
+        self.expired_messages += expired
+        if expired:
+            self._view = None
+        return expired
 
 
 class CoincidenceDistributor:
@@ -443,6 +467,8 @@ class CoincidenceDistributor:
         send_email=False,
         send_slack=True,
         show_table=False,
+        record_directory=None,
+        transport=None,
     ):
         """This class is in charge of sending alerts to SNEWS when CS is triggered
 
@@ -452,6 +478,12 @@ class CoincidenceDistributor:
             path to env file, defaults to '/etc/test-config.env'
         send_slack: `bool`
             Whether to send alerts on slack
+        record_directory : `str`, optional
+            record the raw messages to segment files in this directory, defaults to the
+            RECORD_DIRECTORY env variable (not recorded if neither is set)
+        transport : `Transport`, optional
+            transport of the observation and alert topics, defaults to the one of the
+            SNEWS_TRANSPORT env variable (see cs_transport)
 
         """
         log.debug("Initializing CoincDecider\n")
@@ -463,7 +495,7 @@ class CoincidenceDistributor:
         # name of your sever, used for alerts
         self.server_tag = server_tag
         # initialize local MongoDB
-        self.storage = Storage(drop_db=drop_db)
+        self.storage = self.make_storage(drop_db)
         # declare topic type, used for alerts
         self.topic_type = "CoincidenceTier"
         #  from the env var get the coinc thresh, 10sec
@@ -475,8 +507,9 @@ class CoincidenceDistributor:
         self.max_retriable_errors = 20
         self.exit_on_error = False  # True
         self.initial_set = False
-        self.alert = AlertPublisher(env_path=env_path, firedrill_mode=firedrill_mode)
-        self.test_alert = AlertPublisher(
+        self.transport = transport or get_transport()
+        self.alert = self.make_publisher(env_path=env_path, firedrill_mode=firedrill_mode)
+        self.test_alert = self.make_publisher(
             env_path=env_path, is_test=True
         )  # overwrites with connection test topic
         if firedrill_mode:
@@ -488,15 +521,65 @@ class CoincidenceDistributor:
         self.alert_schema = CoincidenceTierAlert(env_path)
         # handle heartbeat
         self.store_heartbeat = bool(os.getenv("STORE_HEARTBEAT", "True"))
-        self.heartbeat = HeartBeat(env_path=env_path, firedrill_mode=firedrill_mode)
 
         self.stash_time = 86400
-        self.coinc_data = CacheManager()
-        self.test_coinc_data = CacheManager()  # a separate cache for testing
+        self.coinc_data = CacheManager(
+            coincidence_window=self.coinc_threshold, track_changes=True
+        )
+        # messages, alerts and cache changes are archived by a background writer
+        self.archive = self.make_archive(env_path)
+        # the archived cache follows the changes of the cache, start from an empty one
+        self.archive.submit("clear_coinc_cache")
+        self.heartbeat = self.make_heartbeat(env_path, firedrill_mode)
+        # false alarm rates from the observed uptime, refreshed in the background once the
+        # coincidence system runs
+        self.far = self.make_far()
+        # the raw messages, as they were read from the stream, written in the background
+        self.recorder = self.make_recorder(record_directory)
+        # a separate cache for testing
+        self.test_coinc_data = CacheManager(coincidence_window=self.coinc_threshold)
         self.message_count = {}
         self.test_message_count = {}
         # don't use a storage for the test cache
 
+    # The parts that reach outside of the process, replaced by the offline runs (see cs_replay)
+    def make_storage(self, drop_db=False):
+        return Storage(drop_db=drop_db)
+
+    def make_publisher(self, **kwargs):
+        """The publisher of the alerts, kwargs are passed to `AlertPublisher`"""
+        return AlertPublisher(transport=self.transport, **kwargs)
+
+    def make_archive(self, env_path=None):
+        return ArchiveWriter(env_path=env_path).start()
+
+    def make_heartbeat(self, env_path=None, firedrill_mode=True):
+        return HeartBeat(
+            env_path=env_path,
+            firedrill_mode=firedrill_mode,
+            archive=self.archive,
+            share=True,
+            clock=self.now,
+            storage=self.storage,
+        )
+
+    def make_far(self):
+        return MonteCarloFar(self.heartbeat.uptime, window=self.coinc_threshold)
+
+    def make_recorder(self, directory=None):
+        return MessageRecorder.from_env(directory)
+
+    def now(self):
+        """The current (UTC) time, the clock of the cache expiry and of the received times"""
+        return np.datetime64(datetime.utcnow(), "ns")
+
+    def notify(self, alert_data, alert):
+        """Send a published alert by email and on slack, if they are turned on"""
+        if self.send_email:
+            send_email(alert)
+        if self.send_slack:
+            snews_bot.send_table(alert_data, alert, is_test=True, topic=self.observation_topic)
+
     def clear_cache(self, is_test=False):
         """When a reset cache is passed, recreate the
         CoincidenceDataHandler instance
@@ -505,10 +588,15 @@ class CoincidenceDistributor:
         if not is_test:
             log.info("\t > [RESET] Resetting the cache.")
             del self.coinc_data
-            self.coinc_data = CacheManager()
+            self.coinc_data = CacheManager(
+                coincidence_window=self.coinc_threshold, track_changes=True
+            )
+            self.message_count = {}
+            self.archive.submit("clear_coinc_cache")
         else:
             del self.test_coinc_data
-            self.test_coinc_data = CacheManager()
+            self.test_coinc_data = CacheManager(coincidence_window=self.coinc_threshold)
+            self.test_message_count = {}
 
     # ----------------------------------------------------------------------------------------------------------------
     def display_table(self, is_test=False):
@@ -525,15 +613,16 @@ class CoincidenceDistributor:
             cache_data = self.coinc_data
         else:
             cache_data = self.test_coinc_data
-        for sub_list in cache_data.cache["sub_group"].unique():
-            sub_df = cache_data.cache.query(f"sub_group=={sub_list}")
+        for sub_list in sorted(cache_data.sub_groups):
+            sub_df = cache_data.sub_group_frame(sub_list)
             sub_df = sub_df.drop(
                 columns=[
                     "meta",
                     "machine_time_utc",
                     "schema_version",
                     "neutrino_time_as_datetime",
-                ]
+                ],
+                errors="ignore",
             )
             sub_df = sub_df.sort_values(by=["neutrino_time_utc"])
             # snews_bot.send_table(sub_df) # no need to print the table on the server.
@@ -543,16 +632,19 @@ class CoincidenceDistributor:
 
     def send_alert(self, sub_group_tag, alert_type, is_test=False):
         if not is_test:
-            sub_df = self.coinc_data.cache.query("sub_group==@sub_group_tag")
+            sub_df = self.coinc_data.sub_group_frame(sub_group_tag)
             try:
                 false_alarm_prob = cache_false_alarm_rate(
-                    cache_sub_list=sub_df, hb_cache=self.heartbeat.cache_df
+                    cache_sub_list=sub_df,
+                    hb_cache=self.heartbeat.uptime,
+                    time_window=self.coinc_threshold,
+                    monte_carlo=self.far,
                 )
             except Exception:
                 false_alarm_prob = "(couldn't compute)"
             alert_publisher = self.alert
         else:
-            sub_df = self.test_coinc_data.cache.query("sub_group==@sub_group_tag")
+            sub_df = self.test_coinc_data.sub_group_frame(sub_group_tag)
             false_alarm_prob = "N/A"
             alert_publisher = self.test_alert
 
@@ -578,17 +670,14 @@ class CoincidenceDistributor:
             pub.send(alert)
             # only check to see if email or slack should be sent if the alert is not a test alert
             if not is_test:
-                if self.send_email:
-                    send_email(alert)
-                if self.send_slack:
-                    snews_bot.send_table(
-                        alert_data, alert, is_test=True, topic=self.observation_topic
-                    )
+                self.archive.archive_alert(alert, "COINC")
+                self.notify(alert_data, alert)
 
     # ------------------------------------------------------------------------------------------------------------------
     def alert_decider(self, is_test=False):
         """
         This method will publish an alert every time a new detector submits an observation message.
+        Only the sub groups changed by the last message are checked.
         """
         click.secho(f'{"=" * 100}', fg="bright_red")
 
@@ -612,20 +701,23 @@ class CoincidenceDistributor:
                 sub_group_tag=sub_group_tag, alert_type=state, is_test=is_test
             )
 
-        for sub_group_tag, state in cache_data.sub_group_state.items():
+        for sub_group_tag, message_count in cache_data.changed_groups.items():
             print(f"CHECKING FOR ALERTS IN SUB GROUP: {sub_group_tag}")
+            # dropped sub groups have no state
+            state = cache_data.sub_group_state.get(sub_group_tag)
+            # sub groups that were just formed (e.g. by an update that moved a message)
+            # had no messages before
+            previous_count = _message_count.get(sub_group_tag, 0)
 
             if state is None:
                 print(f"NO ALERTS IN SUB GROUP: {sub_group_tag}")
                 continue
 
-            message_count = len(cache_data.cache.query("sub_group==@sub_group_tag"))
-
             if state == "COINC_MSG_STAGGERED":
                 publish_alert(sub_group_tag, state, "COINCIDENT DETECTOR..")
 
             elif (
-                state == "RETRACTION" and message_count < _message_count[sub_group_tag]
+                state == "RETRACTION" and message_count < previous_count
             ):
                 publish_alert(sub_group_tag, state, "RETRACTION HAS BEEN MADE")
 
@@ -640,7 +732,7 @@ class CoincidenceDistributor:
                 )
                 click.secho(f'{"=" * 100}', fg="bright_red")
 
-            elif state == "UPDATE" and message_count == _message_count[sub_group_tag]:
+            elif state == "UPDATE" and message_count == previous_count:
                 click.secho(
                     f'SUB GROUP {sub_group_tag}: {"A MESSAGE HAS BEEN UPDATED".upper():^100}',
                     bg="bright_green",
@@ -653,9 +745,40 @@ class CoincidenceDistributor:
                     )
                     log.debug(f"\t> {log_info} An alert is updated!")
 
-            elif state == "COINC_MSG" and message_count > _message_count[sub_group_tag]:
+            elif state == "COINC_MSG" and message_count > previous_count:
                 publish_alert(sub_group_tag, state, "NEW COINCIDENT DETECTOR..")
 
+    def _reset_changed(self, cache_data, message_count):
+        """Remember the message count of the sub groups changed by the last message,
+        and reset their states
+        """
+        for sub_group_tag, count in cache_data.changed_groups.items():
+            if count:
+                message_count[sub_group_tag] = count
+                cache_data.sub_group_state[sub_group_tag] = None
+            else:
+                message_count.pop(sub_group_tag, None)
+        cache_data.changed_groups = {}
+
+    def expire_cache(self):
+        """Drop the messages that are older than `cache_expiration` from the main cache.
+        The sub groups they leave behind are counted again silently, no alert is sent.
+        The test cache is never expired, test messages can have any neutrino time.
+        """
+        cutoff = self.now() - np.timedelta64(
+            self.cache_expiration, "s"
+        )
+        expired = self.coinc_data.expire(int(cutoff.astype(np.int64)))
+        if expired:
+            dropped = sum(1 for count in self.coinc_data.changed_groups.values() if not count)
+            log.info(
+                f"\t> Expired {expired} messages and {dropped} sub-groups from the cache "
+                f"(total: {self.coinc_data.expired_messages} messages, "
+                f"{self.coinc_data.expired_sub_groups} sub-groups)"
+            )
+        self._reset_changed(self.coinc_data, self.message_count)
+        return expired
+
     # ------------------------------------------------------------------------------------------------------------------
     def deal_with_the_cache(self, snews_message):
         """Check if the message is a test or not, then add it to the cache and run the alert decider
@@ -678,20 +801,17 @@ class CoincidenceDistributor:
             is_test = False
 
         if not is_test:
+            self.expire_cache()
             self.coinc_data.add_to_cache(message=snews_message)
             # run the search
             self.alert_decider(is_test=is_test)
-            # update message count
-            for sub_group_tag in self.coinc_data.cache["sub_group"].unique():
-                self.message_count[sub_group_tag] = len(
-                    self.coinc_data.cache.query("sub_group==@sub_group_tag")
-                )
-                self.coinc_data.sub_group_state[sub_group_tag] = None
+            # update message count of the changed sub groups
+            self._reset_changed(self.coinc_data, self.message_count)
 
             self.coinc_data.updated = []
             # do not have a storage for the tests
             if not is_test:
-                self.storage.insert_coinc_cache(self.coinc_data.cache)
+                self.archive.archive_coinc_cache(self.coinc_data.store.take_changes())
             sys.stdout.flush()
             self.coinc_data.updated = []
             if self.show_table:
@@ -700,12 +820,8 @@ class CoincidenceDistributor:
             self.test_coinc_data.add_to_cache(message=snews_message)
             # run the search
             self.alert_decider(is_test=is_test)
-            # update message count
-            for sub_group_tag in self.test_coinc_data.cache["sub_group"].unique():
-                self.test_message_count[sub_group_tag] = len(
-                    self.test_coinc_data.cache.query("sub_group==@sub_group_tag")
-                )
-                self.test_coinc_data.sub_group_state[sub_group_tag] = None
+            # update message count of the changed sub groups
+            self._reset_changed(self.test_coinc_data, self.test_message_count)
             self.test_coinc_data.updated = []
             # do not have a storage for the tests
             sys.stdout.flush()
@@ -714,10 +830,85 @@ class CoincidenceDistributor:
                 self.display_table("test")  # don't display on the server
 
     # -------------------------------------------------------------------------------------------------------------------
+    @staticmethod
+    def decode_message(snews_message):
+        """Unpack a message read from the stream into a dict, None if it is not parsable"""
+        # the hop messages (and the transports) hold the payload in content, the older hop
+        # versions give the payload itself
+        snews_message = getattr(snews_message, "content", snews_message)
+        return CoincidenceDistributor.decode_content(snews_message)
+
+    @staticmethod
+    def decode_content(snews_message):
+        """Unpack the content of a message, pickled (bytes) or JSON (str), None otherwise"""
+        if type(snews_message) is bytes:
+            snews_message = pickle.loads(snews_message)
+            return snews_message.model_dump()
+        elif type(snews_message) is str:
+            return json.loads(snews_message)
+        log.error("Message is not parsable:")
+        log.error(snews_message)
+        return None
+
+    def receive(self, snews_message):
+        """Decode a message read from the stream, and record it if there is a recorder"""
+        if self.recorder is None:
+            return self.decode_message(snews_message)
+        received = self.now()
+        try:
+            decoded = self.decode_message(snews_message)
+        except Exception as e:
+            self.recorder.record(snews_message, received, error=e)
+            raise
+        self.recorder.record(
+            snews_message, received, error=None if decoded is not None else "not parsable"
+        )
+        return decoded
+
+    def close(self):
+        """Stop the background threads, what they still have queued is written"""
+        self.far.close()
+        if self.recorder is not None:
+            self.recorder.close()
+        self.archive.close()
+
+    def handle_message(self, snews_message):
+        """Run a decoded message through the command handler and, if it is an observation
+        (or a retraction), through the cache and the alert decider
+
+        Returns
+        -------
+        bool
+            whether the message went to the cache
+        """
+        handler = CommandHandler(snews_message)
+        # if a coincidence tier message (or retraction) run through the logic
+        if not handler.handle(self):
+            return False
+        snews_message["received_time"] = np.datetime_as_string(self.now(), unit="ns")
+        # print info on the servers terminal, (important info is logged)
+        terminal_output = click.style(f'{"-" * 57}\n', fg="bright_blue")
+        terminal_output += click.style(
+            f'{"Coincidence Tier Message Received":^57}\n',
+            fg="bright_blue",
+        )
+        terminal_output += click.style(
+            f"\t>{snews_message['detector_name']}{snews_message['received_time']}",
+            fg="bright_blue",
+        )
+        click.secho(terminal_output)
+        # archive the observations, the test messages are not stored
+        if handler.command_name == "CoincidenceTier" and not handler.is_test:
+            self.archive.archive_message(snews_message, "COINC")
+        # add to cache
+        # if actual observation, use coincidence cache, else if testing use test cache
+        self.deal_with_the_cache(snews_message)
+        return True
+
     def run_coincidence(self):
         """
         As the name states this method runs the coincidence system.
-        Starts by subscribing to the hop observation_topic.
+        Starts by subscribing to the observation_topic, through the transport.
 
         * If a CoincidenceTier message is received then it is passed to _check_coincidence.
         * other commands include "test-connection", "test-scenarios",
@@ -727,68 +918,30 @@ class CoincidenceDistributor:
         Reconnect logic and retryable errors thanks to Spencer Nelson (https://github.com/spenczar)
         https://github.com/scimma/hop-client/issues/140
 
+        The topics of the transports that do not reconnect (memory, file) are read up to
+        their end, then the system stops.
+
         """
         fatal_error = True
+        ended = False
+        self.far.start()
 
         while True:
             try:
-                stream = Stream(until_eos=False)
-                with stream.open(self.observation_topic, "r") as s:
+                with self.transport.open(self.observation_topic, "r") as s:
                     click.secho(
                         f"{datetime.utcnow().isoformat()} (re)Initializing Coincidence System for "
                         f"{self.observation_topic}\n"
                     )
                     for snews_message in s:
-                        # check for the hop version
-                        try:
-                            snews_message = snews_message.content
-                        except Exception as e:
-                            log.error(
-                                f"A message with older hop version is found. {e}\n{snews_message}"
-                            )
-                            snews_message = snews_message
-
-                        # Unpack the message
-                        if type(snews_message) is bytes:
-                            snews_message = pickle.loads(snews_message)
-                            snews_message = snews_message.model_dump()
-                        elif type(snews_message) is str:
-                            snews_message = json.loads(snews_message)
-                        else:
-                            log.error("Message is not parsable:")
-                            log.error(snews_message)
-                            continue
-
-                        # handle the input message
-                        handler = CommandHandler(snews_message)
-                        # if a coincidence tier message (or retraction) run through the logic
-                        if handler.handle(self):
-                            snews_message["received_time"] = np.datetime_as_string(
-                                np.datetime64(datetime.utcnow().isoformat()), unit="ns"
-                            )
-                            # print info on the servers terminal, (important info is logged)
-                            terminal_output = click.style(
-                                f'{"-" * 57}\n', fg="bright_blue"
-                            )
-                            terminal_output += click.style(
-                                f'{"Coincidence Tier Message Received":^57}\n',
-                                fg="bright_blue",
-                            )
-                            terminal_output += click.style(
-                                "\t>"
-                                f"{snews_message['detector_name']}"
-                                f"{snews_message['received_time']}",
-                                fg="bright_blue",
-                            )
-                            click.secho(terminal_output)
-                            # add to cache
-                            # if actual observation, use coincidence cache, else if testing use
-                            # test cache
-                            self.deal_with_the_cache(snews_message)
+                        snews_message = self.receive(snews_message)
+                        if snews_message is not None:
+                            self.handle_message(snews_message)
 
                         # for each read message reduce the retriable err count
                         if self.retriable_error_count > 1:
                             self.retriable_error_count -= 1
+                ended = not self.transport.reconnect
 
             # handle a keyboard interrupt (ctrl+c)
             except KeyboardInterrupt:
@@ -796,6 +949,7 @@ class CoincidenceDistributor:
                 log.error("(2) Caught a keyboard interrupt. Exiting.\n")
                 fatal_error = True
                 self.exit_on_error = True
+                self.close()
                 sys.exit(0)
 
             # if there is a KafkaException, check if retriable
@@ -832,7 +986,8 @@ class CoincidenceDistributor:
 
             finally:
                 # if we are breaking on errors and there is a fatal error, break
-                if self.exit_on_error and fatal_error:
+                if ended or (self.exit_on_error and fatal_error):
+                    self.close()
                     break
                 # otherwise continue by re-initiating
                 continue
@@ -29,8 +29,10 @@ class SnewsFormat:
 
     """
 
-    def __init__(self, message, log=None):
+    def __init__(self, message, log=None, now=None):
         self.message = message
+        # the times are checked against this (UTC) time, defaults to the current time
+        self.now = now
         self.message_keys = message.keys()
         self.log = log or log_default
         self.bypass = (
@@ -162,7 +164,7 @@ class SnewsFormat:
             self.log.debug("\t> display-heartbeat is passed. Skipping format check.")
             self.bypass = True
 
-        elif [self.message["tier"].value in ["TimeTier", "SigTier", "CoincidenceTier"]]:
+        elif self.tier() in ["TimeTier", "SigTier", "CoincidenceTier"]:
             self.log.debug("\t> Tier message Passed. Checking times.")
 
         else:
@@ -171,6 +173,11 @@ class SnewsFormat:
         self.log.info(f"\t> Message type : {self.message['id']} valid.")
         return True
 
+    def tier(self):
+        """Name of the tier, an enum in the unpickled messages and a string in the JSON ones"""
+        tier = self.message.get("tier")
+        return getattr(tier, "value", tier)
+
     def check_detector_status(self):
         """if id is for heartbeat,
         check detector status field and neutrino time
@@ -222,8 +229,7 @@ class SnewsFormat:
                 "\t> neutrino_time is checked for is_test=True, not checking time interval."
             )
             return True
-        now_datetime = datetime.utcnow()
-        now_datetime64 = np.datetime64(now_datetime)
+        now_datetime64 = np.datetime64(datetime.utcnow() if self.now is None else self.now)
         time_delta = dateobj - now_datetime64
         total_seconds = time_delta / np.timedelta64(1, "s")
 
@@ -5,16 +5,18 @@ This a module to handle all heartbeat related work
 
 import json
 import os
+from collections import deque
 from datetime import UTC, datetime
-from pathlib import Path
 
 import numpy as np
 import pandas as pd
 from sqlalchemy import create_engine
 
 from .core.logging import getLogger
+from .cs_shared_beats import SharedBeats
+from .cs_uptime import UptimeIndex
 from .cs_utils import make_beat_directory, set_env
-from .database import Database
+from .snews_sql import Storage, heartbeat_columns, heartbeat_time_format
 
 log = getLogger(__name__)
 
@@ -34,6 +36,11 @@ beats_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "../beats")
 # How many times a day can server log these heartbeats, (what is the livetime of server)
 
 
+def utc_now():
+    """The current UTC time, as a np.datetime64 (ns)"""
+    return np.datetime64(datetime.now(UTC).replace(tzinfo=None), "ns")
+
+
 def sanity_checks(message):
     """check if the message will crash the server
     Check  the following
@@ -73,108 +80,427 @@ def sanity_checks(message):
     return True
 
 
+class RunningStats:
+    """Statistics of a stream of values, updated in O(1) per value:
+    the mean, variance and quantiles of the last `window` values (a sliding Welford
+    update, so old values age out), and an exponentially weighted moving average.
+
+    Parameters
+    ----------
+    alpha : `float`
+        weight of a new value in the moving average
+    window : `int`
+        number of recent values used for the mean, variance and quantiles
+
+    """
+
+    def __init__(self, alpha=0.1, window=256):
+        self.alpha = alpha
+        self.recent = deque(maxlen=window)
+        self.reset()
+
+    def reset(self):
+        """Forget all values seen so far"""
+        self.count = 0  # all values seen since the last reset
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.ewma = None
+        self.recent.clear()
+
+    def update(self, value):
+        value = float(value)
+        self.count += 1
+        if len(self.recent) == self.recent.maxlen:
+            # the oldest value leaves the window
+            old = self.recent[0]
+            n = len(self.recent) - 1
+            delta = old - self.mean
+            self.mean = self.mean - delta / n if n else 0.0
+            self._m2 = max(self._m2 - delta * (old - self.mean), 0.0)
+        self.recent.append(value)
+        delta = value - self.mean
+        self.mean += delta / len(self.recent)
+        self._m2 += delta * (value - self.mean)
+        if self.count % self.recent.maxlen == 0:
+            # once per window, drop the rounding errors of the removals
+            self._refresh()
+        self.ewma = value if self.ewma is None else self.ewma + self.alpha * (value - self.ewma)
+
+    def update_many(self, values):
+        """Same as calling `update` for each value, with numpy"""
+        values = np.asarray(values, dtype=float)
+        n = len(values)
+        if n == 0:
+            return
+        self.count += n
+        self.recent.extend(values[-self.recent.maxlen:].tolist())
+        self._refresh()
+        rest = values
+        if self.ewma is None:
+            self.ewma, rest = values[0], values[1:]
+        if len(rest):
+            keep = 1 - self.alpha
+            weights = keep ** np.arange(len(rest) - 1, -1, -1)
+            self.ewma = keep ** len(rest) * self.ewma + self.alpha * weights @ rest
+
+    def _refresh(self):
+        window = np.fromiter(self.recent, float, len(self.recent))
+        self.mean = window.mean()
+        self._m2 = ((window - self.mean) ** 2).sum()
+
+    def variance(self, ddof=1):
+        if len(self.recent) <= ddof:
+            return np.nan
+        return self._m2 / (len(self.recent) - ddof)
+
+    def std(self, ddof=1):
+        return np.sqrt(self.variance(ddof))
+
+    def quantile(self, q):
+        """Quantile(s) of the recent values"""
+        if not self.recent:
+            return np.nan
+        return np.quantile(np.fromiter(self.recent, float, len(self.recent)), q)
+
+
+class DetectorStats:
+    """Running statistics of the heartbeat intervals and latencies of a detector"""
+
+    def __init__(self, alpha=0.1, window=256):
+        self.interval = RunningStats(alpha, window)
+        self.latency = RunningStats(alpha, window)
+        self.last_received = None
+
+    def update(self, received, latency, interval):
+        self.interval.update(interval)
+        self.latency.update(latency)
+        self.last_received = received
+
+    def update_many(self, received, latency, interval):
+        """Add a batch of beats, in the order they were received"""
+        if len(received):
+            self.interval.update_many(interval)
+            self.latency.update_many(latency)
+            self.last_received = received[-1]
+
+    def reset(self):
+        """Start the statistics over, e.g. after a warning was sent for this detector.
+        The time of the last beat is kept.
+        """
+        self.interval.reset()
+        self.latency.reset()
+
+    @property
+    def count(self):
+        return self.interval.count
+
+    def overdue_after(self, min_beats=5):
+        """Seconds after the last beat when the next one is overdue, the mean + 3 sigma of
+        the recent intervals. None until `min_beats` beats were seen.
+        """
+        if self.count < min_beats:
+            return None
+        return self.interval.mean + 3 * self.interval.std()
+
+
+class BeatRing:
+    """Ring buffer of the beats of one detector, in the order they arrived.
+    When it is full it grows by doubling, the old beats leave through `drop_before`.
+    Once it holds `max_capacity` beats, a new beat overwrites the oldest one instead.
+
+    Parameters
+    ----------
+    capacity : `int`
+        initial number of beats
+    max_capacity : `int`, optional
+        most beats kept, no limit if not given
+
+    """
+
+    columns = ("received", "stamped", "latency", "interval", "status")
+
+    def __init__(self, capacity, max_capacity=None):
+        if max_capacity is not None:
+            capacity = min(capacity, max_capacity)
+        self.received = np.zeros(capacity, dtype="datetime64[ns]")
+        self.stamped = np.zeros(capacity, dtype="datetime64[ns]")
+        self.latency = np.zeros(capacity, dtype=np.int64)
+        self.interval = np.zeros(capacity, dtype=np.float64)
+        self.status = np.zeros(capacity, dtype="U8")
+        self.capacity = capacity
+        self.max_capacity = max_capacity
+        self.start = 0  # index of the oldest beat
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def last_received(self):
+        """Received time of the latest beat"""
+        return self.received[(self.start + self.count - 1) % self.capacity]
+
+    def _grow(self):
+        new = 2 * self.capacity
+        if self.max_capacity is not None:
+            new = min(new, self.max_capacity)
+        for name in self.columns:
+            column = getattr(self, name)
+            grown = np.zeros(new, dtype=column.dtype)
+            grown[:self.count] = self._ordered(column)
+            setattr(self, name, grown)
+        self.capacity = new
+        self.start = 0
+
+    def append(self, received, stamped, latency, interval, status):
+        if self.count == self.capacity and (
+            self.max_capacity is None or self.capacity < self.max_capacity
+        ):
+            self._grow()
+        i = (self.start + self.count) % self.capacity
+        self.received[i] = received
+        self.stamped[i] = stamped
+        self.latency[i] = latency
+        self.interval[i] = interval
+        self.status[i] = status
+        if self.count < self.capacity:
+            self.count += 1
+        else:
+            self.start = (self.start + 1) % self.capacity
+
+    def drop_before(self, cutoff):
+        """Drop the beats received before the cutoff, returns how many were dropped"""
+        dropped = 0
+        while self.count and self.received[self.start] < cutoff:
+            self.start = (self.start + 1) % self.capacity
+            self.count -= 1
+            dropped += 1
+        return dropped
+
+    def _ordered(self, column):
+        end = self.start + self.count
+        if end <= self.capacity:
+            return column[self.start:end]
+        return np.concatenate([column[self.start:], column[:end - self.capacity]])
+
+    def frame(self, detector):
+        """DataFrame of the beats, oldest first"""
+        return pd.DataFrame(
+            {
+                "received_time_utc": self._ordered(self.received),
+                "detector": detector,
+                "stamped_time_utc": self._ordered(self.stamped),
+                "latency": self._ordered(self.latency),
+                "time_after_last": self._ordered(self.interval),
+                "status": self._ordered(self.status),
+            }
+        )
+
+
 class HeartBeat:
     """Class to handle heartbeat message stream"""
 
-    def __init__(self, env_path=None, store=True, firedrill_mode=True):
+    def __init__(
+        self,
+        env_path=None,
+        store=True,
+        firedrill_mode=True,
+        archive=None,
+        restore=True,
+        share=False,
+        clock=None,
+        storage=None,
+    ):
         """
         :param store: `bool`
+        :param archive: `ArchiveWriter`, if given the beats are written by it in the
+            background, otherwise they are written right away
+        :param restore: `bool`, start from the beats stored in the database
+        :param share: `bool`, map the latest beats to a file for the feedback process,
+            if HB_SHARED_BEATS names one
+        :param clock: callable returning the current UTC time as a np.datetime64,
+            gives the received time of the beats, defaults to the system clock
+        :param storage: `Storage`, the database of the beats, opened if needed (no archive,
+            or restore) and not given
         """
         log.info("\t> Heartbeat Instance is created.")
         set_env(env_path)
         self.store = store
 
         self.delete_after = float(os.getenv("HB_DELETE_AFTER", "7"))  # days
+        # old beats are deleted from the database at most this often (seconds)
+        self.prune_interval = float(os.getenv("HB_PRUNE_INTERVAL", "60"))
+        self._last_prune = None
 
         if firedrill_mode:
             self.heartbeat_topic = os.getenv("FIREDRILL_OBSERVATION_TOPIC")
         else:
             self.heartbeat_topic = os.getenv("OBSERVATION_TOPIC")
 
-        self.column_names = [
-            "received_time_utc",
-            "detector",
-            "stamped_time_utc",
-            "latency",
-            "time_after_last",
-            "status",
-        ]
-
-        # Update the alert cache
-        self.cache_engine = Database(
-            db_file_path=Path(__file__).parent.parent / "snews_cs.db"
-        ).engine
-        self.cache_df = None
-
-        try:
-            # Try reading cached data from SQL DB
-            self.cache_df = pd.read_sql_table(
-                "cached_heartbeats",
-                self.cache_engine,
-                parse_dates=["received_time_utc", "stamped_time_utc"],
+        self.column_names = list(heartbeat_columns)
+
+        # the beats are appended to the cached_heartbeats table
+        self.archive = archive
+        self.storage = storage
+        if self.storage is None and (archive is None or restore):
+            self.storage = Storage(env=env_path, drop_db=False)
+        self.cache_engine = None if self.storage is None else self.storage.db.engine
+        # detector name -> its beats of the last `delete_after` days, the rings grow as
+        # needed, HB_RING_SIZE caps the beats kept per detector
+        self.ring_size = 1024
+        max_size = os.getenv("HB_RING_SIZE")
+        self.max_ring_size = int(max_size) if max_size else None
+        self.beats = {}
+        # detector name -> running statistics of its beats
+        self.stats = {}
+        self.stats_alpha = float(os.getenv("HB_STATS_ALPHA", "0.1"))
+        self.stats_window = int(os.getenv("HB_STATS_WINDOW", "256"))
+        self._view = None
+        # rows not written to the database yet
+        self._pending = []
+        # the latest beats, mapped to a file for the feedback process
+        self.shared = SharedBeats.writer() if share else None
+        self.clock = clock or utc_now
+        # seconds a detector is live after an ON beat, until its cadence is known
+        self.uptime_tolerance = float(os.getenv("HB_UPTIME_TOLERANCE", "300"))
+
+        stored = pd.DataFrame(columns=self.column_names)
+        if restore:
+            try:
+                # Try reading cached data from SQL DB
+                stored = pd.read_sql_table(
+                    "cached_heartbeats",
+                    self.cache_engine,
+                    parse_dates=["received_time_utc", "stamped_time_utc"],
+                ).sort_values("received_time_utc")
+            except Exception:
+                # Fall-through if cache does not exist
+                pass
+        for row in stored.itertuples(index=False):
+            self._ring(row.detector).append(
+                row.received_time_utc,
+                row.stamped_time_utc,
+                row.latency,
+                row.time_after_last,
+                row.status,
             )
-        except Exception:
-            # Fall-through if cache does not exist; create it
-            self.cache_df = pd.DataFrame(columns=self.column_names)
-
-        self._last_row = pd.DataFrame(
-            columns=self.column_names
+            self.detector_stats(row.detector).update(
+                row.received_time_utc, row.latency, row.time_after_last
+            )
+        # the periods in which each detector was live
+        self.uptime = UptimeIndex.from_beats(
+            stored, {detector: self._tolerance(detector) for detector in self.stats}
         )
-
-    def make_entry(self, message):
-        """Make an entry in the cache df using new message
-        # NOTE:
-        since we create last row separately, the sequence matters
+        self.uptime.tolerance = self.uptime_tolerance
+
+    def detector_stats(self, detector):
+        """Running statistics of the beats of a detector"""
+        if detector not in self.stats:
+            self.stats[detector] = DetectorStats(self.stats_alpha, self.stats_window)
+        return self.stats[detector]
+
+    def _tolerance(self, detector):
+        # live until the next beat is overdue
+        stats = self.stats.get(detector)
+        wait = None if stats is None else stats.overdue_after()
+        return self.uptime_tolerance if wait is None else wait
+
+    def reset_stats(self, detector):
+        """Start the statistics of a detector over, e.g. after a warning"""
+        self.detector_stats(detector).reset()
+
+    def _ring(self, detector):
+        if detector not in self.beats:
+            self.beats[detector] = BeatRing(self.ring_size, self.max_ring_size)
+        return self.beats[detector]
+
+    @property
+    def cache_df(self):
+        """DataFrame view of the cached beats of all detectors, sorted by received time.
+        Built on demand, and reused until the next beat.
         """
-        msg = {
-            "received_time_utc": message["received_time_utc"],
-            "detector": message["detector_name"],
-        }
-
-        msg["stamped_time_utc"] = np.datetime64(message["sent_time_utc"])
-        msg["latency"] = (
-            msg["received_time_utc"] - msg["stamped_time_utc"]
-        ).astype("timedelta64[s]").astype(int)
-
-        # check the last message of given detector
-        detector_df = self.cache_df[self.cache_df["detector"] == msg["detector"]]
-        if len(detector_df):
-            msg["time_after_last"] = (
-                msg["received_time_utc"] - detector_df["received_time_utc"].max()
-            ).total_seconds()
-        else:
-            msg["time_after_last"] = 0  # timedelta(0)
+        if self._view is None:
+            frames = [ring.frame(detector) for detector, ring in self.beats.items() if len(ring)]
+            if frames:
+                self._view = pd.concat(frames, ignore_index=True)
+                self._view.sort_values("received_time_utc", inplace=True, ignore_index=True)
+            else:
+                self._view = pd.DataFrame(columns=self.column_names)
+        return self._view
 
-        msg["status"] = message["detector_status"]
-        self._last_row = pd.DataFrame([msg])
-        # add this new entry to cache
-        if len(self.cache_df) == 0:
-            self.cache_df = self._last_row
+    def make_entry(self, message):
+        """Make an entry in the cache using new message"""
+        received_time = np.datetime64(message["received_time_utc"], "ns")
+        stamped_time = np.datetime64(message["sent_time_utc"], "ns")
+        latency = int((received_time - stamped_time) // np.timedelta64(1, "s"))
+        ring = self._ring(message["detector_name"])
+        # seconds since the last beat of this detector
+        if len(ring):
+            time_after_last = (received_time - ring.last_received) / np.timedelta64(1, "s")
         else:
-            self.cache_df = pd.concat(
-                [self.cache_df, self._last_row], ignore_index=True
+            time_after_last = 0.0
+        status = message["detector_status"]
+        ring.append(received_time, stamped_time, latency, time_after_last, status)
+        if self.shared is not None:
+            self.shared.write(
+                message["detector_name"],
+                received_time,
+                stamped_time,
+                latency,
+                time_after_last,
+                status,
             )
+        self.detector_stats(message["detector_name"]).update(
+            received_time, latency, time_after_last
+        )
+        self.uptime.add(
+            message["detector_name"],
+            received_time,
+            status,
+            self._tolerance(message["detector_name"]),
+        )
+        self._view = None
+        self._pending.append(
+            (
+                pd.Timestamp(received_time).strftime(heartbeat_time_format),
+                message["detector_name"],
+                pd.Timestamp(stamped_time).strftime(heartbeat_time_format),
+                latency,
+                float(time_after_last),
+                status,
+            )
+        )
 
     def drop_old_messages(self):
         """Keep the heartbeats for a time period delta.
-        Drop the earlier messages from cache
+        Drop the earlier messages from cache, at most once every `prune_interval` seconds
         """
-        delta = f"{self.delete_after} day"
-
-        curr_time = np.datetime64(
-            datetime.utcnow().isoformat()
-        )  # pd.to_datetime('now', utc=True)
-        delta_t = curr_time - pd.to_datetime(self.cache_df["received_time_utc"])
-        select = delta_t < pd.Timedelta(delta)
-
-        self.cache_df = self.cache_df[select]
-        self.cache_df.sort_values(by=["received_time_utc"], inplace=True)
+        curr_time = self.clock()
+        cutoff = curr_time - np.timedelta64(int(self.delete_after * 86400e9), "ns")
+        if self._last_prune is not None and curr_time - self._last_prune < np.timedelta64(
+            int(self.prune_interval * 1e9), "ns"
+        ):
+            return
+        self._last_prune = curr_time
+        # the beats of a detector are in order, only the expired ones are touched
+        for ring in self.beats.values():
+            if ring.drop_before(cutoff):
+                self._view = None
+        # the same for the database, with a range delete on the indexed received time,
+        # the deleted beats are kept in the minute, hour and day rollups
+        self._write("drop_old_heartbeats", cutoff)
+
+    def _write(self, method, *args):
+        if self.archive is not None:
+            self.archive.submit(method, *args)
+        else:
+            getattr(self.storage, method)(*args)
 
     def update_cache(self):
-        """Update the alert cache with whatever we decided to keep."""
-        self.cache_df.to_sql(
-            "cached_heartbeats", self.cache_engine, if_exists="replace", index=False
-        )
+        """Append the new heartbeats to the database, in one batch"""
+        rows, self._pending = self._pending, []
+        if rows:
+            self._write("insert_heartbeats", rows)
 
     def display_table(self):
         """When printed out, these table can be read from the purdue servers
@@ -187,9 +513,7 @@ class HeartBeat:
 
     def electrocardiogram(self, message):
         try:
-            message["received_time_utc"] = np.datetime64(
-                datetime.now(UTC).isoformat()
-            )  # pd.to_datetime('now', utc=True)
+            message["received_time_utc"] = self.clock()
             if sanity_checks(message):
                 self.make_entry(message)
                 self.update_cache()
@@ -1,21 +1,40 @@
-import inspect
 import os
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
 
-from . import cs_utils
-from .database import Database
+from . import cs_rollup, cs_utils
+from .core.logging import getLogger
+from .database import Database, database_path
 
-# Get the directory of the script
-current_script_directory = os.path.dirname(
-    os.path.abspath(inspect.getfile(inspect.currentframe()))
-)
+log = getLogger(__name__)
 
-# Go back one level to the parent directory
-parent_directory = os.path.join(current_script_directory, os.pardir)
+# archive table of each tier
+tier_tables = {
+    "SIG": "sig_tier_archive",
+    "TIME": "time_tier_archive",
+    "COINC": "coincidence_tier_archive",
+}
+
+# columns of cached_heartbeats written by the server, and the format of their times
+# (the format pandas uses for datetime columns in SQLite)
+heartbeat_columns = [
+    "received_time_utc",
+    "detector",
+    "stamped_time_utc",
+    "latency",
+    "time_after_last",
+    "status",
+]
+heartbeat_time_format = "%Y-%m-%d %H:%M:%S.%f"
+
+
+def time_string(time):
+    """ISO string (ns precision) of a time, comparable with the time columns of the tables"""
+    return np.datetime_as_string(np.datetime64(time, "ns"), unit="ns")
 
 
 class Storage:
@@ -35,10 +54,10 @@ class Storage:
         cs_utils.set_env(env)
         self.mgs_expiration = int(os.getenv("MSG_EXPIRATION"))
         self.coinc_threshold = int(os.getenv("COINCIDENCE_THRESHOLD"))
-        self.db_path = os.path.join(parent_directory, "snews_cs.db")
+        self.db_path = database_path()
         self.db = Database(db_file_path=self.db_path)
-        self.conn = self.db.connection
-        self.cursor = self.db.cursor
+        # inside `batch` the commits are deferred to the end of the batch
+        self._in_batch = False
 
         if drop_db:
             self.db.drop_tables(
@@ -47,10 +66,62 @@ class Storage:
                     "sig_tier_archive",
                     "time_tier_archive",
                     "coincidence_tier_archive",
+                    "coincidence_tier_cache",
                     "coincidence_tier_alerts",
                 ]
             )
-            self.db.initialize_database(sql_schema_path=Path(__file__).parent / "db_schema.sql")
+        self._upgrade_heartbeat_table()
+        # creates the missing tables and indexes
+        self.db.initialize_database(sql_schema_path=Path(__file__).parent / "db_schema.sql")
+
+    @property
+    def conn(self):
+        """Connection of the calling thread"""
+        return self.db.connection
+
+    @property
+    def cursor(self):
+        """Cursor of the calling thread"""
+        return self.db.cursor
+
+    def _upgrade_heartbeat_table(self):
+        """
+        Older servers replaced cached_heartbeats with a DataFrame on every beat, which
+        dropped its id column. Move the rows of such a table into the schema's table.
+        """
+        columns = [column[1] for column in self.db.get_table_schema("cached_heartbeats")]
+        if not columns or "id" in columns:
+            return
+        log.info("\t> Upgrading the cached_heartbeats table")
+        self.cursor.execute("""ALTER TABLE cached_heartbeats RENAME TO cached_heartbeats_old""")
+        self.db.initialize_database(sql_schema_path=Path(__file__).parent / "db_schema.sql")
+        self.cursor.execute(
+            f"""INSERT INTO cached_heartbeats ({", ".join(heartbeat_columns)})
+            SELECT {", ".join(heartbeat_columns)} FROM cached_heartbeats_old
+            ORDER BY received_time_utc"""
+        )
+        self.cursor.execute("""DROP TABLE cached_heartbeats_old""")
+        self.conn.commit()
+
+    def _commit(self):
+        if not self._in_batch:
+            self.conn.commit()
+
+    @contextmanager
+    def batch(self):
+        """
+        Runs all the writes in the block as a single transaction, committed at the end
+        (or rolled back if the block raises).
+        """
+        self._in_batch = True
+        try:
+            yield self
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            self._in_batch = False
 
     def insert_mgs(self, mgs, tier):
         """
@@ -70,13 +141,18 @@ class Storage:
         # expiration = np.datetime64(mgs['received_time'][0]) + np.timedelta64(48, 'h')
         # expiration = np.datetime_as_string(expiration, unit='ns')
 
+        insert_all = """INSERT INTO all_mgs (
+                message_id, received_time, message_type, message, expiration
+            ) VALUES (?, ?, ?, ?, ?)"""
         if tier == "SIG":
             self.cursor.execute(
-                """INSERT INTO all_mgs VALUES (?, ?, ?, ?, ?)""",
-                (mgs["id"], mgs["received_time"], "SIG", str(mgs), expiration),
+                insert_all, (mgs["id"], mgs["received_time"], "SIG", str(mgs), expiration)
             )
             self.cursor.execute(
-                """INSERT INTO sig_tier_archive VALUES (?, ?, ?,  ?, ?, ?, ?, ?, ?)""",
+                """INSERT INTO sig_tier_archive (
+                    message_id, schema_version, detector_name, p_vals, t_bin_width_sec,
+                    sent_time_utc, machine_time_utc, meta, expiration
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
                 (
                     mgs["id"],
                     mgs["schema_version"],
@@ -89,15 +165,17 @@ class Storage:
                     expiration,
                 ),
             )
-            self.conn.commit()
+            self._commit()
 
         elif tier == "TIME":
             self.cursor.execute(
-                """INSERT INTO all_mgs VALUES (?, ?, ?, ?, ?)""",
-                (mgs["id"], mgs["received_time"], "TIME", str(mgs), expiration),
+                insert_all, (mgs["id"], mgs["received_time"], "TIME", str(mgs), expiration)
             )
             self.cursor.execute(
-                """INSERT INTO time_tier_archive VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                """INSERT INTO time_tier_archive (
+                    message_id, schema_version, detector_name, p_val, t_bin_width_sec,
+                    timing_series, sent_time_utc, machine_time_utc, meta, expiration
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
                 (
                     mgs["id"],
                     mgs["schema_version"],
@@ -111,15 +189,17 @@ class Storage:
                     expiration,
                 ),
             )
-            self.conn.commit()
+            self._commit()
 
         elif tier == "COINC":
             self.cursor.execute(
-                """INSERT INTO all_mgs VALUES (?, ?, ?, ?, ?)""",
-                (mgs["id"], mgs["received_time"], "COINC", str(mgs), expiration),
+                insert_all, (mgs["id"], mgs["received_time"], "COINC", str(mgs), expiration)
             )
             self.cursor.execute(
-                """INSERT INTO coincidence_tier_archive VALUES (?,  ?, ?, ?, ?, ?, ?, ?, ?)""",
+                """INSERT INTO coincidence_tier_archive (
+                    message_id, schema_version, detector_name, p_val, neutrino_time_utc,
+                    sent_time_utc, machine_time_utc, meta, expiration
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
                 (
                     mgs["id"],
                     mgs["schema_version"],
@@ -132,27 +212,40 @@ class Storage:
                     expiration,
                 ),
             )
-            self.conn.commit()
+            self._commit()
 
     def insert_alert(self, alert, tier):
+        """
+        Inserts an alert into the alerts table of its tier.
+
+        Parameters
+        ----------
+        alert : `dict`
+            the published alert, see `CoincidenceTierAlert.get_cs_alert_schema`
+        tier : `str`
+            "COINC", "SIG" or "TIME"
 
+        """
         if tier == "COINC":
             self.cursor.execute(
-                """INSERT INTO coincidence_tier_alerts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                """INSERT INTO coincidence_tier_alerts (
+                    message_id, alert_type, server_tag, false_alarm_prob, detector_names,
+                    sent_time_utc, p_vals, neutrino_times, p_vals_average, sub_list_number
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
                 (
                     alert["id"],
                     alert["alert_type"],
                     alert["server_tag"],
-                    alert["false_alarm_prob"],
+                    str(alert["False Alarm Prob"]),
                     str(alert["detector_names"]),
-                    alert["sent_time_utc"],
-                    str(alert["p_vals"]),
+                    alert["sent_time"],
+                    str(alert["p_values"]),
                     str(alert["neutrino_times"]),
-                    alert["p_vals_average"],
-                    alert["sub_list_number"],
+                    str(alert["p_values average"]),
+                    alert["sub list number"],
                 ),
             )
-            self.conn.commit()
+            self._commit()
 
         elif tier == "SIG":
             pass
@@ -180,7 +273,7 @@ class Storage:
             """DELETE FROM coincidence_tier_archive WHERE expiration < ?""",
             (datetime.now().isoformat(),),
         )
-        self.conn.commit()
+        self._commit()
 
     def get_all_messages(self, sort_order="ASC"):
         """
@@ -248,6 +341,171 @@ class Storage:
 
         return table
 
+    def _paginate(self, table, order_column, sort_order="ASC", chunk_size=1000, as_dataframe=False):
+        """
+        Yields the rows of a table sorted by a column, one page at a time.
+        The pages are read with keyset pagination on (order_column, id); each page starts
+        after the last row of the previous one, so no page costs more than the one before,
+        and only one page is held in memory. SQLite sorts NULL first in ASC and last in
+        DESC order, rows with a NULL order_column are paged by id at that end.
+
+        Parameters
+        ----------
+        table : `str`
+            table name
+        order_column : `str`
+            column to sort by
+        sort_order : `str`
+            "ASC" or "DESC"
+        chunk_size : `int`
+            number of rows per page
+        as_dataframe : `bool`
+            yield a DataFrame per page instead of the rows
+
+        """
+        sort_order = sort_order.upper()
+        if sort_order not in ("ASC", "DESC"):
+            raise ValueError(f"sort_order must be ASC or DESC, not {sort_order}")
+        compare = ">" if sort_order == "ASC" else "<"
+        order = f"ORDER BY {order_column} {sort_order}, id {sort_order} LIMIT ?"
+        first_page = f"SELECT * FROM {table} {order}"
+        # a row value comparison is never true for NULL, those rows need their own branch
+        after_key = f"({order_column}, id) {compare} (?, ?)"
+        nulls = f"{order_column} IS NULL"
+        if sort_order == "ASC":
+            # the NULL rows come first, the rows after them are all the others
+            after_null = f"({nulls} AND id > ?) OR {order_column} IS NOT NULL"
+        else:
+            # the NULL rows come last
+            after_key = f"{after_key} OR {nulls}"
+            after_null = f"{nulls} AND id < ?"
+        next_page = f"SELECT * FROM {table} WHERE {after_key} {order}"
+        next_null_page = f"SELECT * FROM {table} WHERE {after_null} {order}"
+        id_index, key_index, columns = None, None, None
+        key = None
+        while True:
+            cursor = self.conn.cursor()
+            if key is None:
+                cursor.execute(first_page, (chunk_size,))
+            elif key[0] is None:
+                cursor.execute(next_null_page, (key[1], chunk_size))
+            else:
+                cursor.execute(next_page, (*key, chunk_size))
+            rows = cursor.fetchall()
+            if columns is None:
+                columns = [description[0] for description in cursor.description]
+                id_index, key_index = columns.index("id"), columns.index(order_column)
+            cursor.close()
+            if not rows:
+                return
+            if as_dataframe:
+                yield pd.DataFrame(rows, columns=columns)
+            else:
+                yield from rows
+            if len(rows) < chunk_size:
+                return
+            key = (rows[-1][key_index], rows[-1][id_index])
+
+    def iter_all_messages(self, sort_order="ASC", chunk_size=1000, as_dataframe=False):
+        """
+        Yields all messages in the all_mgs table, see `_paginate`.
+        """
+        return self._paginate("all_mgs", "received_time", sort_order, chunk_size, as_dataframe)
+
+    def iter_all_coinc_alerts(self, sort_order="ASC", chunk_size=1000, as_dataframe=False):
+        """
+        Yields all alerts in the coincidence_tier_alerts table, see `_paginate`.
+        """
+        return self._paginate(
+            "coincidence_tier_alerts", "sent_time_utc", sort_order, chunk_size, as_dataframe
+        )
+
+    def iter_all_sig_messages(self, sort_order="ASC", chunk_size=1000, as_dataframe=False):
+        """
+        Yields all messages in the sig_tier_archive table, see `_paginate`.
+        """
+        return self._paginate(
+            "sig_tier_archive", "sent_time_utc", sort_order, chunk_size, as_dataframe
+        )
+
+    def iter_all_time_messages(self, sort_order="ASC", chunk_size=1000, as_dataframe=False):
+        """
+        Yields all messages in the time_tier_archive table, see `_paginate`.
+        """
+        return self._paginate(
+            "time_tier_archive", "sent_time_utc", sort_order, chunk_size, as_dataframe
+        )
+
+    def iter_all_coinc_messages(self, sort_order="ASC", chunk_size=1000, as_dataframe=False):
+        """
+        Yields all messages in the coincidence_tier_archive table, see `_paginate`.
+        """
+        return self._paginate(
+            "coincidence_tier_archive", "sent_time_utc", sort_order, chunk_size, as_dataframe
+        )
+
+    def _stream(self, query, params=(), chunk_size=1000):
+        """
+        Runs a query and yields its rows, fetching `chunk_size` rows at a time.
+        Uses its own cursor, so other queries can run while the results are consumed.
+        """
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            cursor.close()
+
+    def get_messages_between(self, start, end, detector_name=None, tier="COINC"):
+        """
+        Yields the archived messages of a tier sent between two times.
+
+        Parameters
+        ----------
+        start, end : `str` or `datetime` or `np.datetime64`
+            the sent time range (inclusive)
+        detector_name : `str`, optional
+            only the messages of this detector
+        tier : `str`
+            "COINC", "SIG" or "TIME"
+
+        """
+        table = tier_tables[tier]
+        query = f"""SELECT * FROM {table} WHERE sent_time_utc BETWEEN ? AND ?"""
+        params = [time_string(start), time_string(end)]
+        if detector_name is not None:
+            query += " AND detector_name = ?"
+            params.append(detector_name)
+        return self._stream(query + " ORDER BY sent_time_utc", params)
+
+    def get_alerts_since(self, since):
+        """
+        Yields the coincidence alerts sent at or after the given time.
+        """
+        return self._stream(
+            """SELECT * FROM coincidence_tier_alerts WHERE sent_time_utc >= ?
+            ORDER BY sent_time_utc""",
+            (time_string(since),),
+        )
+
+    def get_observations_near(self, neutrino_time, delta_sec=None):
+        """
+        Yields the archived coincidence tier observations whose neutrino time is within
+        `delta_sec` seconds (defaults to the coincidence threshold) of the given time.
+        """
+        delta_sec = self.coinc_threshold if delta_sec is None else delta_sec
+        center = np.datetime64(time_string(neutrino_time), "ns")
+        delta = np.timedelta64(int(delta_sec * 1e9), "ns")
+        return self._stream(
+            """SELECT * FROM coincidence_tier_archive WHERE neutrino_time_utc BETWEEN ? AND ?
+            ORDER BY neutrino_time_utc""",
+            (time_string(center - delta), time_string(center + delta)),
+        )
+
     def retract_message(self, message_id, tier):
         """
         Retracts a message from the all_mgs table.
@@ -275,7 +533,7 @@ class Storage:
                 """DELETE FROM coincidence_tier_archive WHERE message_id = ?""",
                 (message_id,),
             )
-        self.conn.commit()
+        self._commit()
 
     def update_message(self, message, tier):
         """
@@ -341,7 +599,7 @@ class Storage:
                     message["id"],
                 ),
             )
-        self.conn.commit()
+        self._commit()
 
     def show_tables(self):
         """
@@ -365,63 +623,235 @@ class Storage:
 
         return schema
 
-    def insert_coinc_cache(self, cache):
+    def update_coinc_cache(self, changes):
         """
-        Inserts coincidence cache dataframe into the coincidence_tier_archive table.
+        Applies the changes of the coincidence cache to the coincidence_tier_cache table.
+        Only the new and changed messages are (re)written, and only the messages that left
+        the cache are deleted.
 
         Parameters
         ----------
-        cache : dataframe
-            dictionary of the SNEWS message
+        changes : `dict`
+            message id -> cached message, or None if the message left the cache
+            (see `ObservationStore.take_changes`)
 
         """
-        # to sent time datetime string and expiration datetime string
-        expiration = np.datetime64(cache["sent_time_utc"][0]) + np.timedelta64(48, "h")
-        expiration = np.datetime_as_string(expiration, unit="ns")
-
-        # expiration = datetime.fromisoformat(cache['sent_time'][0]) + timedelta(hours=48)
-        # expiration = expiration.isoformat()
-
-        # coincidence_tier_archive is not empty delete all rows
-        self.cursor.execute("""DELETE FROM coincidence_tier_archive""")
-
-        # insert dataframe into table
+        if not changes:
+            return
         insert_query = """
-                INSERT INTO coincidence_tier_archive (
+                INSERT INTO coincidence_tier_cache (
                     message_id, schema_version, detector_name, p_val,
                     neutrino_time_utc, sent_time_utc, machine_time_utc, meta, expiration
                 ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
             """
-
-        try:
-            for index, row in cache.iterrows():
-                self.cursor.execute(
-                    insert_query,
-                    (
-                        row["id"],
-                        row["schema_version"],
-                        row["detector_name"],
-                        row["p_val"],
-                        row["neutrino_time_utc"],
-                        row["sent_time_utc"],
-                        row["machine_time_utc"],
-                        str(row["meta"]),
-                        expiration,
-                    ),
+        rows = []
+        for message in changes.values():
+            if message is None:
+                continue
+            # expires 48h after it was sent
+            expiration = np.datetime64(message["sent_time_utc"]) + np.timedelta64(48, "h")
+            rows.append(
+                (
+                    message["id"],
+                    message.get("schema_version"),
+                    message["detector_name"],
+                    message.get("p_val"),
+                    message["neutrino_time_utc"],
+                    message["sent_time_utc"],
+                    message.get("machine_time_utc"),
+                    str(message.get("meta")),
+                    np.datetime_as_string(expiration, unit="ns"),
                 )
-
-            self.conn.commit()
+            )
+        try:
+            # an upsert is a delete and an insert, message_id is not unique in the table
+            self.cursor.executemany(
+                """DELETE FROM coincidence_tier_cache WHERE message_id = ?""",
+                [(message_id,) for message_id in changes],
+            )
+            self.cursor.executemany(insert_query, rows)
+            self._commit()
         except Exception as e:
-            # Log the error and rollback the transaction if needed
-            print(f"Error inserting data: {e}")
-            self.conn.rollback()
+            # the archive writer retries, or counts the failure
+            log.error(f"\t> Could not update the coincidence cache table: {e}")
+            if not self._in_batch:
+                self.conn.rollback()
+            raise
+
+    def clear_coinc_cache(self):
+        """
+        Deletes all rows of the coincidence_tier_cache table.
+        """
+        self.cursor.execute("""DELETE FROM coincidence_tier_cache""")
+        self._commit()
+
+    def insert_heartbeats(self, rows):
+        """
+        Appends heartbeats to the cached_heartbeats table.
+
+        Parameters
+        ----------
+        rows : `list`
+            tuples of the `heartbeat_columns` values, times as `heartbeat_time_format` strings
+
+        """
+        if rows:
+            self.cursor.executemany(
+                f"""INSERT INTO cached_heartbeats ({", ".join(heartbeat_columns)})
+                VALUES (?, ?, ?, ?, ?, ?)""",
+                rows,
+            )
+            self._commit()
+
+    def drop_old_heartbeats(self, before, rollup=True):
+        """
+        Deletes the heartbeats received before the given time from cached_heartbeats,
+        after adding them to the rollup tables (unless `rollup` is False), and the
+        rollups that are past their retention.
+        """
+        if not self._in_batch:
+            with self.batch():
+                return self.drop_old_heartbeats(before, rollup)
+        if rollup:
+            self.rollup_heartbeats(before)
+            self.prune_rollups(before)
+        before = pd.Timestamp(before).strftime(heartbeat_time_format)
+        self.cursor.execute(
+            """DELETE FROM cached_heartbeats WHERE received_time_utc < ?""", (before,)
+        )
+        self._commit()
+
+    def _read_heartbeats(self, query, params):
+        return pd.read_sql_query(
+            f"""SELECT {", ".join(heartbeat_columns)} FROM cached_heartbeats WHERE {query}""",
+            self.conn,
+            params=params,
+        )
+
+    def rollup_heartbeats(self, before):
+        """
+        Adds the heartbeats received before the given time to the minute, hour and day
+        rollup tables, merging them with the buckets that are already stored.
+        Returns the number of heartbeats rolled up.
+        """
+        before = pd.Timestamp(before).strftime(heartbeat_time_format)
+        beats = self._read_heartbeats("received_time_utc < ?", (before,))
+        if not len(beats):
+            return 0
+        columns = ", ".join(cs_rollup.rollup_columns)
+        for resolution, table in cs_rollup.rollup_tables.items():
+            rolled = cs_rollup.aggregate(beats, resolution)
+            # the buckets that may already have a part stored
+            first, last = (
+                t.strftime(heartbeat_time_format)
+                for t in (rolled["bucket_start"].min(), rolled["bucket_start"].max())
+            )
+            stored = self.cursor.execute(
+                f"""SELECT {columns} FROM {table} WHERE bucket_start BETWEEN ? AND ?""",
+                (first, last),
+            ).fetchall()
+            if stored:
+                rolled = cs_rollup.combine(cs_rollup.from_rows(stored), rolled)
+            self.cursor.executemany(
+                f"""INSERT OR REPLACE INTO {table} ({columns})
+                VALUES ({", ".join("?" * len(cs_rollup.rollup_columns))})""",
+                cs_rollup.to_rows(rolled, heartbeat_time_format),
+            )
+        self._commit()
+        return len(beats)
+
+    def prune_rollups(self, before):
+        """
+        Deletes the minute and hour buckets that start more than their retention
+        (see `cs_rollup.retention`) before the given time. They are already part of the
+        coarser buckets. Returns the number of buckets deleted.
+        """
+        deleted = 0
+        for resolution, days in cs_rollup.retention().items():
+            cutoff = pd.Timestamp(before) - pd.Timedelta(days=days)
+            self.cursor.execute(
+                f"""DELETE FROM {cs_rollup.rollup_tables[resolution]} WHERE bucket_start < ?""",
+                (cutoff.strftime(heartbeat_time_format),),
+            )
+            deleted += self.cursor.rowcount
+        self._commit()
+        return deleted
+
+    def _rollup_reaches(self, resolution, start):
+        oldest = self.cursor.execute(
+            f"""SELECT MIN(bucket_start) FROM {cs_rollup.rollup_tables[resolution]}"""
+        ).fetchone()[0]
+        return oldest is None or pd.Timestamp(oldest) <= pd.Timestamp(start)
+
+    def get_heartbeat_history(
+        self, start=None, end=None, detector_name=None, resolution="auto", include_recent=True
+    ):
+        """
+        Returns the heartbeat statistics of the detectors per time bucket, for plotting
+        long periods cheaply.
+
+        Parameters
+        ----------
+        start, end : `str` or `datetime` or `np.datetime64`, optional
+            the time range, open ended if not given
+        detector_name : `str`, optional
+            only the buckets of this detector
+        resolution : `str`
+            "minute", "hour" or "day", or "auto" for the finest one that keeps the number
+            of buckets of a detector reasonable, and still has buckets back to `start`
+        include_recent : `bool`
+            also aggregate the beats still in cached_heartbeats, which are not rolled up yet
+
+        Returns
+        -------
+        pd.DataFrame
+            one row per detector and bucket, see `cs_rollup.summarize`
+
+        """
+        if resolution == "auto":
+            resolution = cs_rollup.pick_resolution(start, end)
+            # the finer buckets are pruned after a while, a coarser one may go further back
+            while (
+                start is not None
+                and resolution != "day"
+                and not self._rollup_reaches(resolution, start)
+            ):
+                resolution = cs_rollup.resolutions[cs_rollup.resolutions.index(resolution) + 1]
+        table = cs_rollup.rollup_tables[resolution]
+        conditions, params = [], []
+        if start is not None:
+            start = pd.Timestamp(start).floor(cs_rollup.bucket_frequency[resolution])
+            conditions.append("{time} >= ?")
+            params.append(start.strftime(heartbeat_time_format))
+        if end is not None:
+            conditions.append("{time} <= ?")
+            params.append(pd.Timestamp(end).strftime(heartbeat_time_format))
+        if detector_name is not None:
+            conditions.append("detector = ?")
+            params.append(detector_name)
+        where = " AND ".join(conditions) or "1"
+        rows = self.cursor.execute(
+            f"""SELECT {", ".join(cs_rollup.rollup_columns)} FROM {table}
+            WHERE {where.format(time="bucket_start")}""",
+            params,
+        ).fetchall()
+        rolled = cs_rollup.from_rows(rows)
+        if include_recent:
+            beats = self._read_heartbeats(where.format(time="received_time_utc"), params)
+            recent = cs_rollup.aggregate(beats, resolution)
+            rolled = cs_rollup.combine(rolled, recent)
+        history = cs_rollup.summarize(rolled)
+        return history.sort_values(["detector", "bucket_start"], ignore_index=True)
 
     def retrieve_coinc_cache(self):
         """
-        Returns coincidence cache dataframe from the coincidence_tier_archive table and saves it
+        Returns coincidence cache dataframe from the coincidence_tier_cache table and saves it
         as a dataframe.
         """
-        self.cursor.execute("""SELECT * FROM coincidence_tier_archive""")
+        self.cursor.execute(
+            """SELECT message_id, schema_version, detector_name, p_val, neutrino_time_utc,
+               sent_time_utc, machine_time_utc, meta, expiration FROM coincidence_tier_cache"""
+        )
         table = self.cursor.fetchall()
         return pd.DataFrame(
             table,
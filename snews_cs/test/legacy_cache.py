@@ -0,0 +1,401 @@
+"""
+The sub grouping of the pandas based CacheManager of snews_cs 3.0.1, kept as a reference
+for the differential tests of the coincidence cache.
+
+The logging and printing are left out, and the first delta is 0.0 like the others (an int
+gave the delta column an int dtype). There are two fixes: new sub group tags are taken
+from a counter, the original `len(sub_group_tags)` could give a tag that is already in
+use after a redundant sub group is skipped, which merges unrelated sub groups. And a
+retraction resets the index of the cache with `drop=True`, the original added an index
+column each time, and failed once both `index` and `level_0` were taken.
+"""
+import numpy as np
+import pandas as pd
+
+
+def np_datetime_delta_sec(t_1, t_2):
+    """Return the time difference between two numpy datetime64 objects in seconds
+    Returns: float (seconds)
+    Notes
+    -----
+    t_1 is expected to be the earlier time (no absolute value is taken)
+    """
+    total_seconds = (t_2 - t_1) / np.timedelta64(1, "s")  # Convert to seconds
+    return total_seconds
+
+
+class LegacyCacheManager:
+    """
+    This class handles all the incoming data to the SNEWS CS Cache,
+    adding messages and organizing sub-groups
+    """
+
+    def __init__(self):
+        # define the col names of the cache df
+        self.cache = pd.DataFrame(
+            columns=[
+                "id",
+                "detector_name",
+                "received_time",
+                "machine_time_utc",
+                "neutrino_time_utc",
+                "neutrino_time_as_datetime",
+                "p_val",
+                "meta",
+                "sub_group",
+                "neutrino_time_delta",
+            ]
+        )
+        # keep track of updated sub groups
+        self.updated = []
+        # this dict is used to store the current state of each sub group in the cache,
+        # UPDATE, COINCIDENT, None, RETRACTION.
+        self.sub_group_state = {}
+        # sub group tags are taken from a counter, see the module docstring
+        self._next_tag = 1
+
+    def add_to_cache(self, message):
+        """
+        Takes in SNEWS message and checks if it is a retraction, update or new addition to cache.
+        Parameters
+        ----------
+        message : dict
+            SNEWS Message, must be PT valid
+
+        """
+        # retraction
+        if "retract_latest" in message.keys():
+            self.cache_retraction(retraction_message=message)
+            return None  # break if message is meant for retraction
+        message["neutrino_time_as_datetime"] = np.datetime64(
+            message["neutrino_time_utc"]
+        )
+        # update
+        if message["detector_name"] in self.cache["detector_name"].to_list():
+            self._update_message(message)
+        # regular add
+        else:
+            self._manage_cache(message)
+            self.cache = self.cache.sort_values(
+                by=["sub_group", "neutrino_time_delta"], ignore_index=True
+            )
+            self.cache = self.cache.reset_index(drop=True)
+
+    def _manage_cache(self, message):
+        """
+        This method will add a new message to cache, checks if:
+
+            A)It is an initial message (to the entire cache) or if it:
+            B)Forms a new sub-group (sends message to _check_coinc_in_subgroups)
+            C)Is confident to a sub-group (sends message to _check_coinc_in_subgroups)
+
+        Parameters
+        ----------
+        message
+
+        """
+
+        # if the cache is empty add the message to cache, declare state of sub group 0 as INITIAL
+        if len(self.cache) == 0:
+            message["neutrino_time_delta"] = 0.0
+            message["sub_group"] = 0
+            self.sub_group_state[0] = "INITIAL"
+            self.cache = pd.DataFrame([message])
+        # if the cache is not empty, check if the message is coincident with other sub groups
+        else:
+            self._check_coinc_in_subgroups(message)
+
+    def _check_coinc_in_subgroups(self, message):
+        """This method either:
+
+            A)Adds Message to an existing sub-group, if coincident with the initial signal
+
+
+            B) If NOT coincident with any sub groups it creates two new sub groups,
+            setting the message as their initial time.
+            The new groups consist of coincident signals with earlier arrival time and
+            later arrival times, respectively.
+            Once created the new groups are checked to see if they are redundant,
+            and if so then they are not added to the main cache.
+
+        Parameters
+        ----------
+        message : dict
+            SNEWS message
+
+        """
+        # grab the current sub group tags
+        sub_group_tags = self.cache["sub_group"].unique()
+        #  this boolean declares whether if the message is not coincident
+        is_coinc = False
+        for tag in sub_group_tags:
+
+            # query the cache, select the current sub group
+            sub_cache = self.cache.query("sub_group==@tag")
+            #  reset the index, for the sake of keeping things organized
+            sub_cache = sub_cache.reset_index(drop=True)
+            # select the initial nu time of the sub group
+            sub_ini_t = sub_cache["neutrino_time_as_datetime"].min()
+            #  make the nu time delta series
+            delta = np_datetime_delta_sec(
+                t_2=message["neutrino_time_as_datetime"], t_1=sub_ini_t
+            )
+            #  if the message's nu time is within the coincidence window
+            if 0 < delta <= 10.0:
+                # to the message add the corresponding sub group and nu time delta
+                message["sub_group"] = tag
+                message["neutrino_time_delta"] = delta
+                # turn the message into a pd df, this is for concatenating it to the cache
+                temp = pd.DataFrame([message])
+                # concat the message df to the cahce
+                self.cache = pd.concat([self.cache, temp], ignore_index=True)
+                #  set the message as coinc
+                is_coinc = True
+                #  declare the state the sub group to COINC_MSG
+                self.sub_group_state[tag] = "COINC_MSG"
+
+        # if the message is not coincident with any of the sub groups create a new sub group
+        if not is_coinc:
+            # set the message's nu time, as the initial nu time
+            new_ini_t = message["neutrino_time_as_datetime"]
+            # create the sub group tag
+            new_sub_tag = self._next_tag
+            self._next_tag += 2
+            #  turn the message into a df
+            message_as_cache = pd.DataFrame([message])
+            #  create a temp cache concat the message
+            temp_cache = pd.concat([self.cache, message_as_cache], ignore_index=True)
+            #  drop dublicates of detector name and nu time
+            temp_cache = temp_cache.drop_duplicates(
+                subset=["detector_name", "neutrino_time_utc"]
+            )
+            # create  a new time delta
+            temp_cache["neutrino_time_delta"] = np_datetime_delta_sec(
+                t_1=new_ini_t, t_2=temp_cache["neutrino_time_as_datetime"]
+            )
+            # Make two subgroup one for early signal and post
+            new_sub_group_early = temp_cache.query("-10 <= neutrino_time_delta <= 0")
+            new_sub_group_post = temp_cache.query("0 <= neutrino_time_delta <= 10.0")
+            # drop old sub-group col or pandas will scream at you
+            new_sub_group_post = new_sub_group_post.drop(columns="sub_group", axis=0)
+            new_sub_group_early = new_sub_group_early.drop(columns="sub_group", axis=0)
+            # make new sub-group tag
+            new_sub_group_early["sub_group"] = new_sub_tag
+            new_sub_group_post["sub_group"] = int(new_sub_tag + 1)
+            # sort sub-group by nu time
+            new_sub_group_early = new_sub_group_early.sort_values(
+                by="neutrino_time_as_datetime"
+            )
+            new_sub_group_post = new_sub_group_post.sort_values(
+                by="neutrino_time_as_datetime"
+            )
+            # check if new sub groups are the same:
+            # if so, drop the later one
+            if (
+                new_sub_group_early["id"].to_list()
+                == new_sub_group_post["id"].to_list()
+            ):
+                new_sub_group_post = new_sub_group_post.drop(
+                    columns="sub_group", axis=0
+                )
+                new_sub_group_post["sub_group"] = new_sub_tag
+                self._organize_cache(sub_cache=new_sub_group_post)
+            #  organize the cache
+            else:
+                self._organize_cache(sub_cache=new_sub_group_post)
+                self._organize_cache(sub_cache=new_sub_group_early)
+
+    def _check_for_redundancies(self, sub_cache):
+        """Checks if sub cache is redundant
+        Parameters
+        ----------
+        sub_cache : dataframe
+            New sub group
+
+        Returns
+        -------
+        bool
+            True if sub group is redundant
+            False if sub cache is unique
+
+        """
+        # create a series of the ids in the sub group
+        ids = sub_cache["id"]
+
+        # if this sub group only contains a single message and the detector name is already
+        # present in the cache return True
+        if (
+            len(sub_cache) == 1
+            and sub_cache["id"].to_list()[0] in self.cache["id"].to_list()
+        ):
+            return True
+        #  loop through the other sub group tags
+        for sub_tag in self.cache["sub_group"].unique():
+            # save the other sub groups as a df
+            other_sub = self.cache.query("sub_group == @sub_tag")
+            # check if the current sub group's ids are in the other sub group
+            check_ids = ids.isin(other_sub["id"])
+            # if the ids are in the other sub group, return True
+            if check_ids.eq(True).all():
+                return True
+        return False
+
+    def _organize_cache(self, sub_cache):
+        """
+        This method makes sure that the nu_delta_times are not negative,
+        recalculates new deltas using the proper initial time
+
+        Parameters
+        ----------
+        sub_cache : dataframe
+            Sub group
+
+        """
+        #  if the sub is redundant then return out of the
+        if self._check_for_redundancies(sub_cache):
+            return
+        # for the sake of keeping things organized reset the index of the sub group
+        sub_cache = sub_cache.reset_index(drop=True)
+        # if the initial nu time is negative then fix it by passing the sub group to fix_deltas
+        if sub_cache["neutrino_time_delta"][0] < 0:
+            sub_cache = self._fix_deltas(sub_df=sub_cache)
+        if len(sub_cache) > 1:
+            #  set the state of the sub group to COINC_MSG_STAGGERED
+            self.sub_group_state[sub_cache["sub_group"][0]] = "COINC_MSG_STAGGERED"
+        else:
+            self.sub_group_state[sub_cache["sub_group"][0]] = None
+        # concat to the cache
+        self.cache = pd.concat([self.cache, sub_cache], ignore_index=True)
+        #  sort the values of the cache by their sub group and nu time ( ascending order)
+        self.cache = self.cache.sort_values(
+            by=["sub_group", "neutrino_time_as_datetime"]
+        ).reset_index(drop=True)
+
+    def _fix_deltas(self, sub_df):
+        """
+        This method fixes the deltas of the sub group by resetting the initial nu time
+        Parameters
+        ----------
+        sub_df : Dataframe
+            Sub cache
+
+        Returns
+        -------
+        sub_df : Dataframe
+            Sub cache with fixed nu time deltas
+
+        """
+        #  find the new initial nu time
+        initial_time = sub_df["neutrino_time_as_datetime"].min()
+        #  drop the old delta col
+        sub_df = sub_df.drop(columns="neutrino_time_delta", axis=0)
+        #  make the new delta col
+        sub_df["neutrino_time_delta"] = np_datetime_delta_sec(
+            t_1=initial_time, t_2=sub_df["neutrino_time_as_datetime"]
+        )
+        #  sort the nu times by ascending order
+        sub_df = sub_df.sort_values(by=["neutrino_time_as_datetime"])
+        return sub_df
+
+    def _update_message(self, message):
+        """If triggered this method updates the p_val and neutrino time of a detector in cache.
+
+        Parameters
+        ----------
+        message : dict
+            SNEWS message
+
+        """
+        # declare the name of the detector that will be updated
+        update_detector = message["detector_name"]
+        # get indices of where the detector name is present
+        detector_ind = self.cache.query(
+            "detector_name==@update_detector"
+        ).index.to_list()
+        #  loop through the indices
+        for ind in detector_ind:
+            # get the sub tag
+            sub_tag = self.cache["sub_group"][ind]
+            #  declare the state of the sub group as UPDATE
+            self.sub_group_state[sub_tag] = "UPDATE"
+            #  get the initial nu time of the sub group
+            initial_time = self.cache.query("sub_group==@sub_tag")[
+                "neutrino_time_as_datetime"
+            ].min()
+            # ignore update if the updated message is outside the coincident window
+            if (
+                abs(
+                    np_datetime_delta_sec(
+                        t_2=message["neutrino_time_as_datetime"], t_1=initial_time
+                    )
+                )
+                > 10.0
+            ):
+                continue
+            # update the message if it is coincident with the current sub group
+            else:
+                #  find the ind to be updated and replace its contents with
+                for key in message.keys():
+                    self.cache.at[ind, key] = message[key]
+                self.cache.at[ind, "neutrino_time_delta"] = np_datetime_delta_sec(
+                    t_2=message["neutrino_time_as_datetime"], t_1=initial_time
+                )
+                # append the updated list
+                self.updated.append(self.cache["sub_group"][ind])
+
+        # if there are any updated sub groups reorganize them
+        if len(self.updated) != 0:
+            # loop through updated sub group list
+            for sub_tag in self.updated:
+                #  make a sub group df
+                sub_df = self.cache.query("sub_group == @sub_tag")
+                # dump the unorganized subgroup
+                self.cache = self.cache.query("sub_group != @sub_tag")
+                # fix deltas of updated sub group
+                sub_df = self._fix_deltas(sub_df)
+                # concat the organized sub group with the rest of the cache
+                self.cache = pd.concat([self.cache, sub_df], ignore_index=True)
+                #  sort the values of the cache by sub group nu time
+                self.cache = self.cache.sort_values(
+                    by=["sub_group", "neutrino_time_as_datetime"]
+                ).reset_index(drop=True)
+
+    def cache_retraction(self, retraction_message):
+        """
+        This method handles message retraction by parsing the cache and dumping any instance
+        of the target detector
+
+        Parameters
+        ----------
+        retraction_message : dict
+            SNEWS retraction message
+
+        """
+        retracted_name = retraction_message["detector_name"]
+        self.cache = self.cache.query("detector_name!=@retracted_name")
+        # in case retracted message was an initial
+        if len(self.cache) == 0:
+            return 0
+        for sub_tag in self.cache["sub_group"].unique():
+            self.sub_group_state[sub_tag] = "RETRACTION"
+            other_sub = self.cache.query("sub_group == @sub_tag")
+            if other_sub["neutrino_time_delta"].min() != 0.0:
+                if len(other_sub) == 1:
+                    other_sub = other_sub.drop(columns=["neutrino_time_delta"])
+                    other_sub["neutrino_time_delta"] = [0]
+
+                else:
+                    # set new initial nu time
+                    new_initial_time = other_sub["neutrino_time_as_datetime"].min()
+                    # drop the old delta
+                    other_sub = other_sub.drop(columns=["neutrino_time_delta"])
+                    #  make new delta
+                    other_sub["neutrino_time_delta"] = np_datetime_delta_sec(
+                        t_2=other_sub["neutrino_time_as_datetime"], t_1=new_initial_time
+                    )
+                # concat retracted sub group to the cache
+                self.cache = self.cache.query("sub_group!=@sub_tag")
+                self.cache = pd.concat([self.cache, other_sub], ignore_index=True)
+                self.cache = self.cache.sort_values(by="neutrino_time_utc").reset_index(
+                    drop=True
+                )
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""Unit tests for the coincidence cache
+"""
+import random
+import unittest
+
+import numpy as np
+
+from snews_cs.cs_cache import ObservationStore, detector_bits, detector_code
+from snews_cs.snews_coinc import CacheManager
+
+from .legacy_cache import LegacyCacheManager
+
+base_time = np.datetime64("2024-01-01T00:00:00", "ns")
+
+
+def coinc_message(detector_name, seconds, p_val=0.5):
+    nu_time = base_time + np.timedelta64(int(seconds * 1e9), "ns")
+    return {
+        "id": f"{detector_name}_CoincidenceTier_{seconds}",
+        "detector_name": detector_name,
+        "neutrino_time_utc": np.datetime_as_string(nu_time, unit="ns"),
+        "p_val": p_val,
+        "machine_time_utc": "2024-01-01T00:00:00",
+        "sent_time_utc": "2024-01-01T00:00:00",
+        "received_time": "2024-01-01T00:00:00",
+        "schema_version": "1.0",
+        "meta": {},
+    }
+
+
+detectors = ["Super-K", "SNO+", "KamLAND", "LVD", "IceCube", "Borexino", "HALO", "NOvA",
+             "KM3NeT", "Baksan", "JUNO", "DUNE"]
+
+
+def group_members(cache):
+    return {
+        tag: [cache.store.records[slot]["detector_name"] for slot in slots]
+        for tag, slots in cache.sub_groups.items()
+    }
+
+
+class TestObservationStore(unittest.TestCase):
+    def test_add_remove_and_grow(self):
+        store = ObservationStore(capacity=2)
+        slots = [store.add(coinc_message(d, i)) for i, d in enumerate(["JUNO", "LVD", "NOvA"])]
+        self.assertEqual(len(store), 3)
+        self.assertEqual(store.detector[slots[0]], detector_code("JUNO"))
+        self.assertEqual(store.nu_time[slots[2]] - store.nu_time[slots[0]], 2_000_000_000)
+        store.remove(slots[1])
+        self.assertNotIn("LVD", store)
+        # freed slots are reused
+        self.assertEqual(store.add(coinc_message("SNO+", 5)), slots[1])
+
+    def test_changes(self):
+        store = ObservationStore(track_changes=True)
+        slot = store.add(coinc_message("JUNO", 0))
+        store.add(coinc_message("LVD", 1))
+        self.assertEqual(list(store.take_changes()), ["JUNO_CoincidenceTier_0", "LVD_CoincidenceTier_1"])
+        self.assertEqual(store.take_changes(), {})
+        store.remove(slot)
+        store.remove(store.slot_of["LVD"])
+        store.add(coinc_message("JUNO", 3))
+        changes = store.take_changes()
+        self.assertIsNone(changes["JUNO_CoincidenceTier_0"])
+        self.assertIsNone(changes["LVD_CoincidenceTier_1"])
+        self.assertEqual(changes["JUNO_CoincidenceTier_3"]["p_val"], 0.5)
+        # nothing is kept if the changes are not tracked
+        self.assertIsNone(ObservationStore().changes)
+
+
+class TestCacheManager(unittest.TestCase):
+    def test_initial_and_coincident(self):
+        cache = CacheManager()
+        cache.add_to_cache(coinc_message("JUNO", 0))
+        self.assertEqual(cache.sub_group_state, {0: "INITIAL"})
+        cache.add_to_cache(coinc_message("LVD", 4))
+        self.assertEqual(group_members(cache), {0: ["JUNO", "LVD"]})
+        self.assertEqual(cache.sub_group_state[0], "COINC_MSG")
+
+    def test_new_sub_groups(self):
+        cache = CacheManager()
+        for detector, seconds in [("JUNO", 0), ("LVD", 5), ("NOvA", 12)]:
+            cache.add_to_cache(coinc_message(detector, seconds))
+        # NOvA is more than a window after JUNO, it starts the sub groups before and after it
+        self.assertEqual(
+            group_members(cache), {0: ["JUNO", "LVD"], 1: ["LVD", "NOvA"], 2: ["NOvA"]}
+        )
+        self.assertEqual(cache.sub_group_state, {0: "COINC_MSG", 1: "COINC_MSG_STAGGERED", 2: None})
+
+    def test_update_and_retraction(self):
+        cache = CacheManager()
+        cache.add_to_cache(coinc_message("JUNO", 0))
+        cache.add_to_cache(coinc_message("LVD", 4))
+        cache.add_to_cache(coinc_message("LVD", 3, p_val=0.1))
+        self.assertEqual(cache.sub_group_state[0], "UPDATE")
+        self.assertEqual(len(cache.store), 2)
+        self.assertEqual(list(cache.cache["p_val"]), [0.5, 0.1])
+
+        cache.add_to_cache({"detector_name": "LVD", "retract_latest": 1})
+        self.assertEqual(group_members(cache), {0: ["JUNO"]})
+        self.assertEqual(cache.sub_group_state[0], "RETRACTION")
+        self.assertEqual(cache.sub_group_mask[0], 1 << detector_code("JUNO"))
+        self.assertFalse(cache.detector_groups[detector_code("LVD")])
+
+    def test_changed_groups(self):
+        cache = CacheManager()
+        for detector, seconds in [("JUNO", 0), ("LVD", 4), ("NOvA", 30)]:
+            cache.add_to_cache(coinc_message(detector, seconds))
+        # only the new sub group of NOvA changed
+        self.assertEqual(cache.changed_groups, {1: 1})
+        cache.add_to_cache(coinc_message("DUNE", 2))
+        self.assertEqual(cache.changed_groups, {0: 3})
+        cache.add_to_cache({"detector_name": "NOvA", "retract_latest": 1})
+        self.assertEqual(cache.changed_groups, {1: 0})
+        self.assertNotIn(1, cache.sub_group_state)
+
+    def test_dataframe_view(self):
+        cache = CacheManager()
+        cache.add_to_cache(coinc_message("LVD", 4))
+        cache.add_to_cache(coinc_message("JUNO", 0))
+        df = cache.cache
+        self.assertTrue({"sub_group", "neutrino_time_delta", "schema_version"} <= set(df.columns))
+        # sorted by sub group and nu time, deltas relative to the first message
+        self.assertEqual(list(df["sub_group"]), [0, 2, 2])
+        jn = df.query("sub_group == 2")
+        self.assertEqual(list(jn["detector_name"]), ["JUNO", "LVD"])
+        self.assertEqual(list(jn["neutrino_time_delta"]), [0.0, 4.0])
+        # the view is reused until the cache changes
+        self.assertIs(df, cache.cache)
+
+    def test_expire(self):
+        cache = CacheManager()
+        for detector, seconds in [("JUNO", 0), ("LVD", 4), ("NOvA", 30)]:
+            cache.add_to_cache(coinc_message(detector, seconds))
+        cutoff = int(base_time.astype(np.int64))
+        self.assertEqual(cache.expire(cutoff), 0)
+        # JUNO expires, what is left of its sub group keeps the tag but gets no state
+        self.assertEqual(cache.expire(cutoff + 2_000_000_000), 1)
+        self.assertEqual(group_members(cache), {0: ["LVD"], 1: ["NOvA"]})
+        self.assertEqual(cache.changed_groups, {0: 1})
+        self.assertIsNone(cache.sub_group_state[0])
+        self.assertEqual(cache.expire(cutoff + 20_000_000_000), 1)
+        self.assertEqual(group_members(cache), {1: ["NOvA"]})
+        self.assertEqual(cache.changed_groups, {0: 0})
+        self.assertEqual((cache.expired_messages, cache.expired_sub_groups), (2, 1))
+        self.assertEqual(list(cache.cache["detector_name"]), ["NOvA"])
+        check_membership_index(self, cache)
+
+    def test_update_outside_a_window(self):
+        cache = CacheManager()
+        for detector, seconds in [("JUNO", 0), ("LVD", 8), ("NOvA", 14)]:
+            cache.add_to_cache(coinc_message(detector, seconds))
+        self.assertEqual(group_members(cache), {0: ["JUNO", "LVD"], 1: ["LVD", "NOvA"], 2: ["NOvA"]})
+        # more than a window after JUNO, sub group 0 keeps the earlier LVD message
+        cache.add_to_cache(coinc_message("LVD", 12, p_val=0.1))
+        self.assertEqual(cache.changed_groups, {0: 2, 1: 2})
+        self.assertEqual(cache.sub_group_state, {0: "UPDATE", 1: "UPDATE", 2: None})
+        self.assertEqual(list(cache.sub_group_frame(0)["p_val"]), [0.5, 0.5])
+        self.assertEqual(list(cache.sub_group_frame(1)["p_val"]), [0.1, 0.5])
+        self.assertEqual(len(cache.store), 3)
+        check_membership_index(self, cache)
+        # a retraction takes out both
+        cache.add_to_cache({"detector_name": "LVD", "retract_latest": 1})
+        self.assertEqual(group_members(cache), {0: ["JUNO"], 1: ["NOvA"], 2: ["NOvA"]})
+        self.assertEqual(len(cache.store.records) - len(cache.store._free), 2)
+
+
+def check_membership_index(test, cache):
+    for tag, slots in cache.sub_groups.items():
+        names = [cache.store.records[slot]["detector_name"] for slot in slots]
+        test.assertEqual(
+            sorted(detector_bits(cache.sub_group_mask[tag])),
+            sorted(detector_code(name) for name in names),
+        )
+    index = {(code, tag) for code, tags in cache.detector_groups.items() for tag in tags}
+    test.assertEqual(
+        index,
+        {(code, tag) for tag, mask in cache.sub_group_mask.items() for code in detector_bits(mask)},
+    )
+
+
+def legacy_groups(legacy):
+    if not len(legacy.cache):
+        return {}
+    return {
+        int(tag): sorted(zip(sub["detector_name"], sub["neutrino_time_utc"], sub["p_val"]))
+        for tag, sub in legacy.cache.groupby("sub_group")
+    }
+
+
+def cache_groups(cache):
+    return {
+        tag: sorted(
+            (record["detector_name"], record["neutrino_time_utc"], record["p_val"])
+            for record in (cache.store.records[slot] for slot in slots)
+        )
+        for tag, slots in cache.sub_groups.items()
+    }
+
+
+class TestAgainstLegacy(unittest.TestCase):
+    def check_sequence(self, messages):
+        """Run the messages through both caches, after each one they must have the same
+        sub groups, and the sub groups that changed the same states"""
+        cache, legacy = CacheManager(), LegacyCacheManager()
+        for message in messages:
+            cache.add_to_cache(dict(message))
+            legacy.add_to_cache(dict(message))
+            self.assertEqual(cache_groups(cache), legacy_groups(legacy))
+            for tag in cache.changed_groups:
+                if tag in cache.sub_groups:
+                    self.assertEqual(
+                        cache.sub_group_state[tag], legacy.sub_group_state[tag]
+                    )
+            self.assertEqual(set(cache.sub_group_state), set(cache.sub_groups))
+            check_membership_index(self, cache)
+
+    def test_separate_bursts(self):
+        rnd = random.Random(3)
+        for _ in range(25):
+            bursts = rnd.randint(1, 3)
+            messages = [
+                coinc_message(detector, round(40 * (i % bursts) + rnd.uniform(0, 10), 3))
+                for i, detector in enumerate(rnd.sample(detectors, rnd.randint(2, 10)))
+            ]
+            rnd.shuffle(messages)
+            self.check_sequence(messages)
+
+    def test_overlapping_windows(self):
+        rnd = random.Random(7)
+        for _ in range(25):
+            self.check_sequence(
+                coinc_message(detector, round(rnd.uniform(0, 40), 3))
+                for detector in rnd.sample(detectors, rnd.randint(2, 10))
+            )
+
+    def test_updates_and_retractions(self):
+        rnd = random.Random(11)
+        for _ in range(25):
+            messages, present = [], set()
+            for _ in range(rnd.randint(2, 15)):
+                detector = rnd.choice(detectors[:6])
+                if detector in present and rnd.random() < 0.2:
+                    messages.append({"detector_name": detector, "retract_latest": 1})
+                    present.discard(detector)
+                else:
+                    # whole seconds, so that equal times and window edges are common
+                    messages.append(
+                        coinc_message(detector, rnd.randint(0, 40), round(rnd.random(), 3))
+                    )
+                    present.add(detector)
+            self.check_sequence(messages)
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""Unit tests for the SQL archive
+"""
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from snews_cs.cs_archive import ArchiveWriter
+from snews_cs.database import Database, database_path
+from snews_cs.snews_sql import Storage
+
+db_directory = None
+
+
+def setUpModule():
+    # the tests drop tables, they never touch the real database
+    global db_directory
+    db_directory = tempfile.TemporaryDirectory()
+    os.environ["SNEWS_DB_FILE"] = os.path.join(db_directory.name, "snews_cs.db")
+
+
+def tearDownModule():
+    del os.environ["SNEWS_DB_FILE"]
+    db_directory.cleanup()
+
+
+def coinc_message(detector_name, seconds):
+    return {
+        "id": f"{detector_name}_CoincidenceTier_{seconds}",
+        "schema_version": "1.0",
+        "detector_name": detector_name,
+        "p_val": 0.5,
+        "neutrino_time_utc": f"2024-01-01T00:00:{seconds:02d}.000000000",
+        "sent_time_utc": "2024-01-01T00:01:00.000000000",
+        "machine_time_utc": "2024-01-01T00:01:00.000000000",
+        "received_time": "2024-01-01T00:01:01.000000000",
+        "meta": {},
+    }
+
+
+alert = {
+    "id": "SNEWS_Coincidence_ALERT 2024-01-01T00:01:01.000000",
+    "alert_type": "INITIAL",
+    "server_tag": "test",
+    "False Alarm Prob": "0.1%",
+    "detector_names": ["JUNO", "LVD"],
+    "sent_time": "2024-01-01T00:01:01.000000",
+    "p_values": [0.5, 0.5],
+    "neutrino_times": ["2024-01-01T00:00:00", "2024-01-01T00:00:04"],
+    "p_values average": 0.5,
+    "sub list number": 0,
+}
+
+
+class TestArchiveWriter(unittest.TestCase):
+    def setUp(self):
+        self.storage = Storage(drop_db=True)
+
+    def test_write_behind(self):
+        juno, lvd = coinc_message("JUNO", 0), coinc_message("LVD", 4)
+        with ArchiveWriter(flush_interval=60, flush_size=2) as archive:
+            archive.archive_message(juno, "COINC")
+            archive.archive_message(lvd, "COINC")
+            archive.archive_coinc_cache({juno["id"]: juno, lvd["id"]: lvd})
+            archive.archive_coinc_cache({lvd["id"]: None})
+            archive.archive_alert(alert, "COINC")
+        # everything is written on close, in order
+        self.assertEqual((archive.written, archive.failed), (5, 0))
+        self.assertEqual(len(self.storage.get_all_messages()), 2)
+        # the archive keeps every message, the cache table only what is still cached
+        coinc = self.storage.get_all_coinc_messages()
+        self.assertEqual([row[1] for row in coinc], [juno["id"], lvd["id"]])
+        self.assertEqual(list(self.storage.retrieve_coinc_cache()["message_id"]), [juno["id"]])
+        with ArchiveWriter(flush_interval=60) as archive:
+            archive.submit("clear_coinc_cache")
+        self.assertTrue(self.storage.retrieve_coinc_cache().empty)
+        self.assertEqual(len(self.storage.get_all_coinc_messages()), 2)
+        self.assertEqual(self.storage.get_all_coinc_alerts()[0][1], alert["id"])
+
+    def test_bad_write_is_skipped(self):
+        with ArchiveWriter(flush_interval=60) as archive:
+            archive.archive_message({"id": "broken"}, "COINC")
+            archive.archive_message(coinc_message("JUNO", 0), "COINC")
+        self.assertEqual((archive.written, archive.failed), (1, 1))
+        self.assertEqual(len(self.storage.get_all_messages()), 1)
+
+    def test_bad_cache_update_is_counted(self):
+        broken = coinc_message("LVD", 4)
+        broken["p_val"] = {"not": "a number"}
+        with self.assertRaises(sqlite3.Error):
+            self.storage.update_coinc_cache({broken["id"]: broken})
+        with ArchiveWriter(flush_interval=60) as archive:
+            archive.archive_coinc_cache({broken["id"]: broken})
+        self.assertEqual((archive.written, archive.failed), (0, 1))
+        self.assertTrue(self.storage.retrieve_coinc_cache().empty)
+
+    def test_full_queue_does_not_block(self):
+        archive = ArchiveWriter(max_queue=2)
+        for seconds in range(3):
+            archive.archive_message(coinc_message("JUNO", seconds), "COINC")
+        self.assertEqual((archive.queue.qsize(), archive.dropped), (2, 1))
+
+    def test_database_does_not_open(self):
+        with mock.patch("snews_cs.cs_archive.Storage", side_effect=sqlite3.OperationalError("unable to open")):
+            archive = ArchiveWriter(max_queue=1).start()
+            archive._thread.join(5)
+        self.assertIsInstance(archive.error, sqlite3.OperationalError)
+        # the writes are dropped instead of waiting for a writer that is gone
+        archive.archive_message(coinc_message("JUNO", 0), "COINC")
+        archive.archive_message(coinc_message("LVD", 4), "COINC")
+        self.assertEqual(archive.dropped, 2)
+        archive.close()
+
+
+class TestQueries(unittest.TestCase):
+    def setUp(self):
+        self.storage = Storage(drop_db=True)
+        for detector, seconds in [("JUNO", 0), ("LVD", 4), ("JUNO", 30), ("NOvA", 50)]:
+            message = coinc_message(detector, seconds)
+            message["sent_time_utc"] = message["neutrino_time_utc"]
+            self.storage.insert_mgs(message, "COINC")
+        self.storage.insert_alert(alert, "COINC")
+
+    def test_time_ranges(self):
+        rows = self.storage.get_messages_between(
+            "2024-01-01T00:00:00", "2024-01-01T00:00:40", detector_name="JUNO"
+        )
+        self.assertEqual([row[1] for row in rows], ["JUNO_CoincidenceTier_0", "JUNO_CoincidenceTier_30"])
+        near = self.storage.get_observations_near("2024-01-01T00:00:05")
+        self.assertEqual([row[3] for row in near], ["JUNO", "LVD"])
+        self.assertEqual(len(list(self.storage.get_alerts_since("2024-01-01T00:01:00"))), 1)
+        self.assertEqual(len(list(self.storage.get_alerts_since("2024-01-02"))), 0)
+
+    def test_pagination(self):
+        rows = list(self.storage.iter_all_coinc_messages(chunk_size=3))
+        self.assertEqual(rows, self.storage.get_all_coinc_messages())
+        rows = list(self.storage.iter_all_messages(sort_order="DESC", chunk_size=1))
+        self.assertEqual([row[0] for row in rows], [4, 3, 2, 1])
+        chunks = list(self.storage.iter_all_coinc_messages(chunk_size=3, as_dataframe=True))
+        self.assertEqual([len(chunk) for chunk in chunks], [3, 1])
+        self.assertEqual(list(chunks[1]["detector_name"]), ["NOvA"])
+
+    def test_pagination_with_null_times(self):
+        self.storage.cursor.execute("UPDATE all_mgs SET received_time = NULL WHERE id IN (2, 3)")
+        self.storage.conn.commit()
+        for sort_order, ids in [("ASC", [2, 3, 1, 4]), ("DESC", [4, 1, 3, 2])]:
+            for chunk_size in (1, 2, 3):
+                rows = list(self.storage.iter_all_messages(sort_order=sort_order, chunk_size=chunk_size))
+                self.assertEqual([row[0] for row in rows], ids)
+
+    def test_indexes_are_used(self):
+        def plan(query):
+            return str(self.storage.cursor.execute("EXPLAIN QUERY PLAN " + query, ("x",)).fetchall())
+
+        self.assertIn("idx_coinc_tier_message_id",
+                      plan("DELETE FROM coincidence_tier_archive WHERE message_id = ?"))
+        self.assertIn("idx_all_mgs_expiration", plan("SELECT * FROM all_mgs WHERE expiration < ?"))
+        self.assertIn("idx_coinc_tier_neutrino_time", plan(
+            "SELECT * FROM coincidence_tier_archive WHERE neutrino_time_utc > ?"))
+
+
+class TestDatabase(unittest.TestCase):
+    def test_shared_file_and_thread_connections(self):
+        db, other = Database(database_path()), Database(str(database_path()))
+        self.assertIs(db.engine, other.engine)
+        self.assertIs(db.connection, other.connection)
+        self.assertEqual(db.cursor.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+        connections = []
+        thread = threading.Thread(target=lambda: connections.append(db.connection))
+        thread.start()
+        thread.join()
+        self.assertIsNot(connections[0], db.connection)
+
+    def test_retry_when_locked(self):
+        calls = []
+
+        def write():
+            calls.append(1)
+            if len(calls) < 3:
+                raise sqlite3.OperationalError("database is locked")
+            return "done"
+
+        self.assertEqual(Database(database_path()).retry(write), "done")
+        self.assertEqual(len(calls), 3)
+        calls.clear()
+        with self.assertRaises(sqlite3.OperationalError):
+            Database(database_path()).retry(write, retries=0)
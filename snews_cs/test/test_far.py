@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""Unit tests for the false alarm rate tables
+"""
+import math
+import os
+import threading
+import unittest
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+from snews_cs.cs_far import FalseAlarmTable, MonteCarloFar, seconds_week, seconds_year
+from snews_cs.cs_replay import ReplayDistributor
+from snews_cs.cs_stats import cache_false_alarm_rate
+from snews_cs.cs_uptime import UptimeIndex
+from snews_cs.snews_coinc import CoincidenceDistributor
+
+
+def legacy_years(n, r, window=10.0):
+    """The formula of the original cache_false_alarm_rate (with a float window, the
+    integer power overflowed from 20 detectors on)
+    """
+    combinations = math.comb(n, r) if n >= r else 0
+    frequency = (combinations + 1) * np.power(1 / seconds_week, r) * np.power(window, r - 1)
+    return 1 / (frequency / seconds_year)
+
+
+class TestFalseAlarmTable(unittest.TestCase):
+    def test_matches_the_formula(self):
+        table = FalseAlarmTable()
+        for n in range(1, 25):
+            for r in range(1, n + 1):
+                online = [f"D{i}" for i in range(n)]
+                years = table.years_between(online, online[:r], 10)
+                self.assertAlmostEqual(years / legacy_years(n, r), 1, places=9)
+        # windows that were not tabulated are added when first used
+        self.assertAlmostEqual(
+            table.years_between(["A", "B", "C"], ["A", "B"], 4.5) / legacy_years(3, 2, 4.5), 1
+        )
+
+    def test_per_detector_rates(self):
+        online = ["JUNO", "LVD", "NOvA", "IceCube"]
+        # the same rate given per detector is the uniform table
+        same = FalseAlarmTable(rates={"JUNO": 1 / seconds_week})
+        uniform = FalseAlarmTable()
+        self.assertAlmostEqual(
+            same.log_frequency_of(online, ["JUNO", "LVD"]),
+            uniform.log_frequency_of(online, ["JUNO", "LVD"]),
+        )
+        # a noisier detector makes false alarms more frequent
+        noisy = FalseAlarmTable(rates={"JUNO": 10 / seconds_week})
+        self.assertLess(noisy.years_between(online, ["JUNO", "LVD"]),
+                        uniform.years_between(online, ["JUNO", "LVD"]))
+
+    def test_no_overflow(self):
+        table = FalseAlarmTable(max_detectors=10)
+        log_frequency = table.log_frequency(200, 150)
+        self.assertTrue(np.isfinite(log_frequency))
+        self.assertEqual(table.years_between([str(i) for i in range(200)], [str(i) for i in range(150)]),
+                         math.inf)
+
+
+class TestMonteCarloFar(unittest.TestCase):
+    now = np.datetime64("2024-01-08T00:00:00", "ns")
+
+    def uptime(self, detectors, down=()):
+        """Detectors live for the last 7 days, except those in `down` the last 3.5 days"""
+        index = UptimeIndex()
+        start = self.now - np.timedelta64(7, "D")
+        for detector in detectors:
+            index.add(detector, start, "ON", tolerance=7 * 86400)
+            if detector in down:
+                index.add(detector, start + np.timedelta64(84, "h"), "OFF")
+        return index
+
+    def test_always_live_matches_the_table(self):
+        detectors = [f"D{i}" for i in range(8)]
+        estimator = MonteCarloFar(self.uptime(detectors), table=FalseAlarmTable(), trials=20000)
+        self.assertIsNone(estimator.years_between(2))
+        years = estimator.estimate(self.now, seed=1)
+        for r in range(2, 6):
+            # the table adds one to the number of combinations
+            n_comb = math.comb(8, r)
+            expected = FalseAlarmTable().years_between(detectors, detectors[:r]) * (n_comb + 1) / n_comb
+            self.assertAlmostEqual(years[r] / expected, 1, delta=1e-3)
+        self.assertIsNone(estimator.years_between(9))
+
+    def test_uptime_and_workers(self):
+        detectors = ["JUNO", "LVD", "NOvA"]
+        # correlated downtime: JUNO and LVD are down together half of the time
+        index = self.uptime(detectors, down=["JUNO", "LVD"])
+        single = MonteCarloFar(index, table=FalseAlarmTable(), trials=100000)
+        pooled = MonteCarloFar(index, table=FalseAlarmTable(), trials=100000, workers=2)
+        p = -math.expm1(-10 / seconds_week)
+        # three-fold coincidences only happen in the first half
+        expected = seconds_year / (0.5 * p**3 / 10)
+        for estimator in [single, pooled]:
+            years = estimator.estimate(self.now, seed=2)
+            self.assertAlmostEqual(years[3] / expected, 1, delta=0.02)
+        sub_group = pd.DataFrame(
+            {"detector_name": ["JUNO", "LVD", "NOvA"],
+             "neutrino_time_utc": [str(self.now)] * 3}
+        )
+        self.assertEqual(cache_false_alarm_rate(sub_group, index, monte_carlo=pooled), pooled.years[3])
+        # another window, or a detector that was not sampled, falls back to the table
+        table = FalseAlarmTable()
+        self.assertEqual(
+            cache_false_alarm_rate(sub_group, index, time_window=5, table=table, monte_carlo=pooled),
+            cache_false_alarm_rate(sub_group, index, time_window=5, table=table),
+        )
+        self.assertIsNone(pooled.years_between(2, 10, ["JUNO", "IceCube"]))
+        self.assertEqual(pooled.years_between(2, 10, ["JUNO", "LVD"]), pooled.years[2])
+
+    def test_snapshot_while_beating(self):
+        index = self.uptime(["JUNO"])
+        beating = threading.Event()
+
+        def beat():
+            t = self.now
+            while not beating.is_set():
+                t += np.timedelta64(600, "s")
+                index.add("JUNO", t, "ON", tolerance=60)
+                index.add("LVD", t, "ON", tolerance=60)
+
+        thread = threading.Thread(target=beat)
+        thread.start()
+        try:
+            for _ in range(200):
+                for starts, ends in index.snapshot().values():
+                    self.assertEqual(len(starts), len(ends))
+        finally:
+            beating.set()
+            thread.join()
+
+    def test_background_refresh(self):
+        estimator = MonteCarloFar(self.uptime(["JUNO", "LVD"]), trials=1000, refresh=3600)
+        estimator.start()
+        estimator.close()
+        self.assertIsNotNone(estimator.updated)
+        self.assertIsNone(MonteCarloFar(UptimeIndex(), trials=1000).estimate())
+
+    def test_off_unless_configured(self):
+        with mock.patch.dict(os.environ):
+            os.environ.pop("FAR_MC_TRIALS", None)
+            self.assertEqual(MonteCarloFar(UptimeIndex()).trials, 0)
+        # the server refreshes the estimates from run_coincidence, not when it is built
+        far = CoincidenceDistributor.make_far(ReplayDistributor())
+        self.assertIsNone(far._thread)
@@ -0,0 +1,452 @@
+# -*- coding: utf-8 -*-
+"""Unit tests for the heartbeat cache
+"""
+import os
+import random
+import tempfile
+import unittest
+from unittest import mock
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from snews_cs.cs_rollup import rollup_tables
+from snews_cs.cs_shared_beats import SharedBeats
+from snews_cs.cs_stats import cache_false_alarm_rate
+from snews_cs.cs_uptime import UptimeIndex
+from snews_cs.heartbeat_feedbacks import DeadlineScheduler, FeedBack, recent_beats
+from snews_cs.snews_hb import BeatRing, HeartBeat, RunningStats
+from snews_cs.snews_sql import Storage, heartbeat_time_format
+
+run_directory = None
+
+
+def setUpModule():
+    # the shared beats and the database of the tests stay out of the real ones
+    global run_directory
+    run_directory = tempfile.TemporaryDirectory()
+    os.environ["SNEWS_RUN_DIR"] = run_directory.name
+    os.environ["SNEWS_DB_FILE"] = os.path.join(run_directory.name, "snews_cs.db")
+
+
+def tearDownModule():
+    del os.environ["SNEWS_RUN_DIR"]
+    del os.environ["SNEWS_DB_FILE"]
+    run_directory.cleanup()
+
+
+def beat(detector_name, status="ON"):
+    return {
+        "detector_name": detector_name,
+        "detector_status": status,
+        "sent_time_utc": (datetime.utcnow() - timedelta(seconds=1)).isoformat(),
+    }
+
+
+class TestBeatRing(unittest.TestCase):
+    def test_wraps_around(self):
+        ring = BeatRing(2, max_capacity=3)
+        t0 = np.datetime64("2024-01-01T00:00:00", "ns")
+        for i in range(5):
+            t = t0 + np.timedelta64(i, "s")
+            ring.append(t, t, 0, 1.0, "ON")
+        self.assertEqual(len(ring), 3)
+        self.assertEqual(ring.last_received, t0 + np.timedelta64(4, "s"))
+        df = ring.frame("JUNO")
+        self.assertEqual(list(df["received_time_utc"]), [t0 + np.timedelta64(i, "s") for i in (2, 3, 4)])
+        self.assertEqual(ring.drop_before(t0 + np.timedelta64(4, "s")), 2)
+        self.assertEqual(list(ring.frame("JUNO")["detector"]), ["JUNO"])
+
+    def test_grows(self):
+        ring = BeatRing(2)
+        t0 = np.datetime64("2024-01-01T00:00:00", "ns")
+        for i in range(7):
+            t = t0 + np.timedelta64(i, "s")
+            ring.append(t, t, i, 1.0, "ON")
+            if i == 2:
+                ring.drop_before(t0 + np.timedelta64(1, "s"))
+        # the beats stay in order when the ring grows from a wrapped position
+        self.assertEqual((len(ring), ring.capacity), (6, 8))
+        self.assertEqual(list(ring.frame("JUNO")["latency"]), [1, 2, 3, 4, 5, 6])
+
+
+class TestHeartBeatStore(unittest.TestCase):
+    def setUp(self):
+        self.storage = Storage(drop_db=False)
+        self.storage.db.drop_tables(["cached_heartbeats", *rollup_tables.values()])
+        self.storage = Storage(drop_db=False)
+
+    def rows(self):
+        return self.storage.cursor.execute(
+            "SELECT id, detector, status FROM cached_heartbeats ORDER BY id"
+        ).fetchall()
+
+    def test_append_only(self):
+        hb = HeartBeat()
+        for detector in ["JUNO", "LVD", "JUNO"]:
+            self.assertTrue(hb.electrocardiogram(beat(detector)))
+        self.assertEqual(self.rows(), [(1, "JUNO", "ON"), (2, "LVD", "ON"), (3, "JUNO", "ON")])
+        # a new instance starts from the stored beats and keeps appending
+        hb = HeartBeat()
+        self.assertEqual(len(hb.cache_df), 3)
+        hb.electrocardiogram(beat("LVD", "OFF"))
+        self.assertEqual(self.rows()[-1], (4, "LVD", "OFF"))
+        self.assertGreater(hb.cache_df["time_after_last"].iloc[-1], 0)
+
+    def test_old_beats_are_deleted(self):
+        hb = HeartBeat()
+        hb.electrocardiogram(beat("JUNO"))
+        hb.delete_after = 0.0
+        hb._last_prune = None
+        hb.electrocardiogram(beat("LVD"))
+        self.assertEqual(self.rows(), [])
+
+    def test_retention_holds_more_beats_than_the_ring(self):
+        hb = HeartBeat()
+        hb.ring_size = 4
+        for _ in range(10):
+            hb.electrocardiogram(beat("JUNO"))
+        # every beat of the retention window is kept, the ring grew
+        self.assertEqual(len(hb.cache_df), 10)
+        self.assertEqual(len(hb.beats["JUNO"]), len(self.rows()))
+
+    def test_rollups(self):
+        t0 = pd.Timestamp("2024-01-01 00:00:00")
+        rows = [
+            ((t0 + pd.Timedelta(seconds=20 * i)).strftime(heartbeat_time_format), "JUNO",
+             t0.strftime(heartbeat_time_format), i % 4, 20.0, "OFF" if i == 5 else "ON")
+            for i in range(12)
+        ]
+        self.storage.insert_heartbeats(rows)
+        whole = self.storage.get_heartbeat_history(resolution="minute")
+        # rolled up in two parts, the second minute straddles the first cut
+        self.storage.drop_old_heartbeats(t0 + pd.Timedelta(seconds=90))
+        self.assertEqual(len(self.rows()), 7)
+        self.storage.drop_old_heartbeats(t0 + pd.Timedelta(hours=1))
+        self.assertEqual(self.rows(), [])
+        minutes = self.storage.get_heartbeat_history(resolution="minute")
+        pd.testing.assert_frame_equal(minutes, whole)
+        self.assertEqual(list(minutes["count"]), [3, 3, 3, 3])
+        self.assertAlmostEqual(minutes["on_fraction"][1], 2 / 3)
+        self.assertEqual(list(minutes["latency_p95"]), [2, 3, 3, 3])
+        day = self.storage.get_heartbeat_history(t0, t0 + pd.Timedelta(days=400), detector_name="JUNO")
+        self.assertEqual(len(day), 1)
+        self.assertEqual(day["count"][0], 12)
+        self.assertEqual(day["latency_mean"][0], 1.5)
+        self.assertEqual(day["interval_std"][0], 0)
+        self.assertEqual(len(self.storage.get_heartbeat_history(detector_name="LVD")), 0)
+
+    def test_rollup_retention(self):
+        t0 = pd.Timestamp("2024-01-01 00:00:00")
+        rows = [
+            ((t0 + pd.Timedelta(days=day, seconds=20 * i)).strftime(heartbeat_time_format), "JUNO",
+             t0.strftime(heartbeat_time_format), 1, 20.0, "ON")
+            for day in [0, 2, 4] for i in range(3)
+        ]
+        self.storage.insert_heartbeats(rows)
+        with mock.patch.dict(os.environ, {"HB_ROLLUP_MINUTE_DAYS": "1", "HB_ROLLUP_HOUR_DAYS": "2"}):
+            self.storage.drop_old_heartbeats(t0 + pd.Timedelta(days=5))
+        # the minute and hour buckets before their retention are gone, the days stay
+        counts = [
+            self.storage.cursor.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            for table in rollup_tables.values()
+        ]
+        self.assertEqual(counts, [1, 1, 3])
+        # an old range is read from the coarser buckets that still cover it
+        history = self.storage.get_heartbeat_history(t0, t0 + pd.Timedelta(hours=1))
+        self.assertEqual(list(history["count"]), [3])
+        self.assertEqual(history["bucket_start"][0], t0)
+
+    def test_feedback_report_covers_a_day(self):
+        now = pd.Timestamp.utcnow().tz_localize(None)
+        rows = [
+            ((now - pd.Timedelta(hours=hours)).strftime(heartbeat_time_format), detector,
+             now.strftime(heartbeat_time_format), 1, 60.0, "ON")
+            for hours, detector in [(30, "JUNO"), (2, "JUNO"), (1, "LVD"), (1, "JUNO")]
+        ]
+        self.storage.insert_heartbeats(rows)
+        df = recent_beats("JUNO", now=now.to_datetime64())
+        self.assertEqual(len(df), 2)
+        self.assertTrue(df["received_time_utc"].is_monotonic_increasing)
+
+    def test_legacy_table_is_upgraded(self):
+        self.storage.db.drop_tables(["cached_heartbeats"])
+        self.storage.cursor.execute(
+            "CREATE TABLE cached_heartbeats (received_time_utc DATETIME, detector TEXT, "
+            "stamped_time_utc DATETIME, latency BIGINT, time_after_last FLOAT, status TEXT)"
+        )
+        self.storage.cursor.execute(
+            "INSERT INTO cached_heartbeats VALUES "
+            "('2024-01-01 00:00:00.000000', 'JUNO', '2024-01-01 00:00:00.000000', 0, 0, 'ON')"
+        )
+        self.storage.conn.commit()
+        Storage(drop_db=False)
+        self.assertEqual(self.rows(), [(1, "JUNO", "ON")])
+
+
+class TestRunningStats(unittest.TestCase):
+    def test_matches_batch_statistics(self):
+        values = np.random.default_rng(1).normal(60, 5, 1000)
+        stats = RunningStats(alpha=0.2, window=100)
+        for value in values:
+            stats.update(value)
+        # the old values aged out
+        self.assertEqual(stats.count, 1000)
+        self.assertAlmostEqual(stats.mean, values[-100:].mean())
+        self.assertAlmostEqual(stats.std(), values[-100:].std(ddof=1))
+        self.assertAlmostEqual(stats.std(ddof=0), values[-100:].std())
+        self.assertAlmostEqual(stats.quantile(0.5), np.median(values[-100:]))
+        ewma = values[0]
+        for value in values[1:]:
+            ewma += 0.2 * (value - ewma)
+        self.assertAlmostEqual(stats.ewma, ewma)
+        stats.reset()
+        self.assertEqual(stats.count, 0)
+        self.assertTrue(np.isnan(stats.std()))
+
+    def test_update_many(self):
+        values = np.random.default_rng(2).exponential(30, 500)
+        one, many = RunningStats(alpha=0.3, window=50), RunningStats(alpha=0.3, window=50)
+        for value in values:
+            one.update(value)
+        for chunk in np.array_split(values, 7):
+            many.update_many(chunk)
+        self.assertEqual(one.count, many.count)
+        for attribute in ["mean", "ewma"]:
+            self.assertAlmostEqual(getattr(one, attribute), getattr(many, attribute))
+        self.assertAlmostEqual(one.std(), many.std())
+        self.assertEqual(list(one.recent), list(many.recent))
+
+    def test_cadence_change_ages_out(self):
+        stats = RunningStats(window=50)
+        stats.update_many(np.full(1000, 10.0))
+        for _ in range(50):
+            stats.update(60.0)
+        # a day at the old cadence no longer holds the mean down
+        self.assertAlmostEqual(stats.mean, 60.0)
+        self.assertAlmostEqual(stats.std(), 0.0)
+
+    def test_heartbeat_keeps_stats(self):
+        Storage(drop_db=False).db.drop_tables(["cached_heartbeats"])
+        Storage(drop_db=False)
+        hb = HeartBeat()
+        for _ in range(3):
+            hb.electrocardiogram(beat("JUNO"))
+        stats = hb.stats["JUNO"]
+        self.assertEqual(stats.count, 3)
+        self.assertAlmostEqual(stats.interval.mean, hb.cache_df["time_after_last"].mean())
+        self.assertEqual(stats.last_received, hb.beats["JUNO"].last_received)
+        hb.reset_stats("JUNO")
+        self.assertEqual(stats.count, 0)
+        self.assertIsNotNone(stats.last_received)
+
+
+class TestDeadlineScheduler(unittest.TestCase):
+    def test_earliest_first(self):
+        scheduler = DeadlineScheduler()
+        scheduler.schedule("JUNO", 30)
+        scheduler.schedule("LVD", 10)
+        scheduler.schedule("NOvA", 20)
+        # rescheduling replaces the previous deadline
+        scheduler.schedule("LVD", 40)
+        scheduler.cancel("NOvA")
+        self.assertEqual(scheduler.next_deadline(), 30)
+        self.assertEqual(scheduler.pop_due(35), ["JUNO"])
+        self.assertEqual(scheduler.pop_due(35), [])
+        self.assertEqual(scheduler.pop_due(40), ["LVD"])
+        self.assertIsNone(scheduler.next_deadline())
+
+    def test_feedback_checks_the_due_detector(self):
+        warned = []
+        feedback = FeedBack()
+        feedback.check_missed_beats = lambda stats, detector: warned.append(detector)
+        now = np.datetime64("now", "us")
+        rows = [
+            dict(received_time_utc=now - np.timedelta64(600 - 60 * i, "s"), detector=detector,
+                 stamped_time_utc=now, latency=1, time_after_last=60.0 + i % 2, status="ON")
+            for i in range(10) for detector in ["JUNO", "LVD"]
+        ]
+        feedback.update_schedule(feedback.ingest(pd.DataFrame(rows)))
+        deadline = feedback.scheduler.next_deadline()
+        self.assertGreater(deadline, now - np.timedelta64(60, "s"))
+        self.assertEqual(len(feedback.scheduler), 2)
+        feedback.check_due(now - np.timedelta64(60, "s"))
+        self.assertEqual(warned, [])
+        feedback.check_due(deadline)
+        self.assertEqual(sorted(warned), ["JUNO", "LVD"])
+
+    def test_deadline_follows_the_recent_cadence(self):
+        feedback = FeedBack()
+        feedback.stats_window = 20
+        now = np.datetime64("now", "us")
+        # a day at a 10 s cadence, then the detector slowed down to a beat a minute
+        intervals = [10.0] * 8640 + [60.0] * 20
+        received = now - np.timedelta64(1, "s") * np.cumsum(intervals[::-1])[::-1].astype(int)
+        feedback.ingest(pd.DataFrame(dict(
+            received_time_utc=received, detector="JUNO", stamped_time_utc=received,
+            latency=1, time_after_last=intervals, status="ON")))
+        feedback.update_schedule(["JUNO"])
+        stats = feedback.stats["JUNO"]
+        # the scheduler waits as long as the warning does, a minute after the last beat
+        self.assertEqual(stats.overdue_after(), 60.0)
+        self.assertEqual(feedback.scheduler.next_deadline(),
+                         stats.last_received + np.timedelta64(60, "s"))
+
+    def test_only_the_overdue_detectors_are_warned(self):
+        warned = []
+        feedback = FeedBack()
+        feedback.check_missed_beats = lambda stats, detector: warned.append(detector)
+        now = np.datetime64("now", "us")
+        # JUNO beats every minute but stopped 5 minutes ago, LVD is on time, NOvA is new
+        rows = [
+            dict(received_time_utc=now - np.timedelta64(offset + 60 * i, "s"), detector=detector,
+                 stamped_time_utc=now, latency=1, time_after_last=60.0 + i % 2, status="ON")
+            for detector, offset, beats in [("JUNO", 300, 10), ("LVD", 30, 10), ("NOvA", 30, 3)]
+            for i in range(beats)
+        ]
+        feedback.update_schedule(feedback.ingest(pd.DataFrame(rows)))
+        feedback.check_due(now)
+        self.assertEqual(warned, ["JUNO"])
+        self.assertEqual(feedback.stats["NOvA"].count, 3)
+        # the beats are only counted once
+        feedback.update_schedule(feedback.ingest(pd.DataFrame(rows)))
+        self.assertEqual(feedback.stats["JUNO"].count, 10)
+
+    def test_watermark_reads(self):
+        storage = Storage(drop_db=False)
+        storage.db.drop_tables(["cached_heartbeats"])
+        Storage(drop_db=False)
+        hb, feedback = HeartBeat(), FeedBack()
+        for detector in ["JUNO", "LVD"]:
+            hb.electrocardiogram(beat(detector))
+        self.assertEqual(list(feedback.new_beats()["detector"]), ["JUNO", "LVD"])
+        self.assertEqual(len(feedback.new_beats()), 0)
+        hb.electrocardiogram(beat("NOvA"))
+        df = feedback.new_beats()
+        self.assertEqual(list(df["detector"]), ["NOvA"])
+        self.assertEqual(df["received_time_utc"].dtype.kind, "M")
+        # a rebuilt table is read from the start
+        storage.db.drop_tables(["cached_heartbeats"])
+        Storage(drop_db=False)
+        HeartBeat().electrocardiogram(beat("JUNO"))
+        self.assertEqual(list(feedback.new_beats()["id"]), [1])
+
+
+class TestSharedBeats(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "beats.ring")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_single_writer_many_readers(self):
+        writer = SharedBeats.writer(self.path, slots=4, capacity=3)
+        self.assertIsNone(SharedBeats.reader(self.path + ".missing"))
+        first, second = SharedBeats.reader(self.path), SharedBeats.reader(self.path)
+        t0 = np.datetime64("2024-01-01T00:00:00", "ns")
+        for i, detector in enumerate(["JUNO", "LVD", "JUNO"]):
+            t = t0 + np.timedelta64(i, "s")
+            writer.write(detector, t, t, 1, float(i), "ON")
+        df = first.read_new()
+        self.assertEqual(sorted(df["detector"]), ["JUNO", "JUNO", "LVD"])
+        self.assertEqual(list(df.query("detector == 'JUNO'")["time_after_last"]), [0.0, 2.0])
+        self.assertEqual(df["received_time_utc"].dtype, "datetime64[ns]")
+        self.assertFalse(first.changed())
+        self.assertEqual(len(first.read_new()), 0)
+        # each reader follows the beats on its own
+        self.assertEqual(len(second.read_new()), 3)
+        # a reader that fell behind gets the beats that are still in the ring
+        for i in range(5):
+            writer.write("LVD", t0, t0, 1, 1.0, "OFF")
+        self.assertTrue(first.changed())
+        self.assertEqual(list(first.read_new()["status"]), ["OFF"] * 3)
+
+    def test_reopened_by_a_new_writer(self):
+        writer = SharedBeats.writer(self.path, slots=4, capacity=3)
+        writer.write("JUNO", np.datetime64("2024-01-01"), np.datetime64("2024-01-01"), 1, 0.0, "ON")
+        reader = SharedBeats.reader(self.path)
+        # the same layout is kept, a different one replaces the file
+        SharedBeats.writer(self.path, slots=4, capacity=3).write(
+            "LVD", np.datetime64("2024-01-01"), np.datetime64("2024-01-01"), 1, 0.0, "ON"
+        )
+        self.assertFalse(reader.stale())
+        self.assertEqual(sorted(reader.read_new()["detector"]), ["JUNO", "LVD"])
+        SharedBeats.writer(self.path, slots=8, capacity=3)
+        self.assertTrue(reader.stale())
+        self.assertEqual(SharedBeats.reader(self.path).slots, 8)
+
+    def test_feedback_reads_the_shared_beats(self):
+        os.environ["HB_SHARED_BEATS"] = self.path
+        try:
+            storage = Storage(drop_db=False)
+            storage.db.drop_tables(["cached_heartbeats"])
+            Storage(drop_db=False)
+            hb, feedback = HeartBeat(share=True), FeedBack()
+            hb.electrocardiogram(beat("JUNO"))
+            self.assertEqual(list(feedback.read_beats()["detector"]), ["JUNO"])
+            self.assertIsNotNone(feedback.shared)
+            self.assertIsNone(feedback.read_beats())
+            hb.electrocardiogram(beat("LVD"))
+            self.assertEqual(list(feedback.read_beats()["detector"]), ["LVD"])
+        finally:
+            del os.environ["HB_SHARED_BEATS"]
+
+    def test_sharing_is_opt_in(self):
+        hb = HeartBeat()
+        hb.electrocardiogram(beat("JUNO"))
+        # only the server shares its beats, no file is mapped for the others
+        self.assertIsNone(hb.shared)
+        self.assertFalse([name for name in os.listdir(run_directory.name) if name.endswith(".ring")])
+
+
+class TestUptimeIndex(unittest.TestCase):
+    t0 = np.datetime64("2024-01-01T00:00:00", "ns")
+
+    def at(self, seconds):
+        return self.t0 + np.timedelta64(seconds, "s")
+
+    def test_live_periods(self):
+        index = UptimeIndex(tolerance=60)
+        for seconds, status in [(0, "ON"), (30, "ON"), (200, "ON"), (220, "OFF"), (300, "ON")]:
+            index.add("JUNO", self.at(seconds), status)
+        self.assertEqual(
+            index.intervals("JUNO"),
+            [(self.at(0), self.at(90)), (self.at(200), self.at(220)), (self.at(300), self.at(360))],
+        )
+        index.add("LVD", self.at(100), "ON")
+        self.assertEqual(index.live_at(self.at(89)), ["JUNO"])
+        self.assertEqual(index.live_at(self.at(150)), ["LVD"])
+        self.assertEqual(index.live_at(self.at(220)), [])
+        self.assertEqual(sorted(index.live_during(self.at(80), self.at(100))), ["JUNO", "LVD"])
+        self.assertEqual(index.live_count(self.at(225), self.at(299)), 0)
+        self.assertEqual(index.live_count(self.at(225), self.at(300)), 1)
+
+    def test_built_at_once_or_beat_by_beat(self):
+        rnd = random.Random(3)
+        rows, incremental = [], UptimeIndex(tolerance=50)
+        for seconds in sorted(rnd.sample(range(3000), 200)):
+            detector = rnd.choice(["JUNO", "LVD", "NOvA"])
+            status = "OFF" if rnd.random() < 0.2 else "ON"
+            rows.append(dict(received_time_utc=self.at(seconds), detector=detector, status=status))
+            incremental.add(detector, self.at(seconds), status)
+        index = UptimeIndex.from_beats(pd.DataFrame(rows), tolerance=50)
+        self.assertEqual(index.starts, incremental.starts)
+        self.assertEqual(index.ends, incremental.ends)
+
+    def test_false_alarm_rate(self):
+        index = UptimeIndex(tolerance=60)
+        for detector in ["JUNO", "LVD", "NOvA", "IceCube"]:
+            index.add(detector, self.at(0), "ON")
+        sub_group = pd.DataFrame(
+            {"detector_name": ["JUNO", "LVD"],
+             "neutrino_time_utc": [str(self.at(10)), str(self.at(12))]}
+        )
+        # 4 online detectors, from the index or from the unique detectors of the beats
+        rate = cache_false_alarm_rate(sub_group, index)
+        beats = pd.DataFrame({"detector": ["JUNO", "LVD", "NOvA", "IceCube", "JUNO"]})
+        self.assertEqual(cache_false_alarm_rate(sub_group, beats), rate)
+        # nobody else is online long after, the sub group still is
+        sub_group["neutrino_time_utc"] = [str(self.at(1000))] * 2
+        self.assertGreater(cache_false_alarm_rate(sub_group, index), rate)
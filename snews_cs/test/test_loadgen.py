@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""Unit tests for the synthetic load generator
+"""
+import unittest
+
+import numpy as np
+
+from snews_cs.cs_loadgen import registered_detectors, run_load, traffic
+
+start = np.datetime64("2024-01-01T00:00:00", "ns")
+
+
+class TestLoadGenerator(unittest.TestCase):
+    def test_traffic(self):
+        events = traffic(600, burst_rate=60, command_rate=60, start=start, seed=3)
+        self.assertEqual(events, traffic(600, burst_rate=60, command_rate=60, start=start, seed=3))
+        times = [arrival for arrival, _, _ in events]
+        self.assertEqual(times, sorted(times))
+        kinds = {kind for _, kind, _ in events}
+        self.assertTrue({"heartbeat", "observation", "command"} <= kinds)
+        # every registered detector beats about every minute
+        beats = [m["detector_name"] for _, kind, m in events if kind == "heartbeat"]
+        self.assertEqual(set(beats), set(registered_detectors))
+        self.assertAlmostEqual(len(beats) / len(registered_detectors), 10, delta=1)
+        # the scale multiplies the rates
+        scaled = traffic(600, burst_rate=60, command_rate=60, scale=2, start=start, seed=3)
+        self.assertAlmostEqual(len(scaled) / len(events), 2, delta=0.2)
+        with self.assertRaises(ValueError):
+            traffic(60, detectors=len(registered_detectors) + 1)
+
+    def test_run_load(self):
+        events = traffic(
+            300, burst_rate=120, update_fraction=0.5, retraction_fraction=0.3, seed=5
+        )
+        report = run_load(events, sample_every=100)
+        self.assertEqual(report["messages"], len(events))
+        self.assertEqual(sum(report["counts"].values()), len(events))
+        self.assertEqual(report["failed"], 0)
+        self.assertGreater(report["alerts"], 0)
+        self.assertTrue(np.isfinite(report["capacity"]))
+        self.assertTrue(np.isnan(report["queueing_ms"]["p50"]))
+        self.assertGreater(report["memory_mb"]["peak"], 0)
+
+    def test_paced(self):
+        events = traffic(60, detectors=4, heartbeat_interval=10, burst_rate=0, command_rate=0, seed=1)
+        report = run_load(events, speed=600)
+        # 24 beats in 60 simulated seconds, at 600 times real time
+        self.assertAlmostEqual(report["elapsed"], report["simulated"] / 600, delta=0.05)
+        self.assertTrue(np.isfinite(report["queueing_ms"]["p99"]))
+        self.assertAlmostEqual(report["offered"], len(events) * 600 / report["simulated"])
+
+
+if __name__ == "__main__":
+    unittest.main()
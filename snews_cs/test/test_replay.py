@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""Unit tests for the replay of recorded streams
+"""
+import gzip
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from snews_cs.cs_recorder import MessageRecorder, segments
+from snews_cs.cs_replay import ReplayDistributor, read_messages, replay
+
+# recorded more than two days ago, the replay follows the recorded times
+start = np.datetime64("2024-01-01T00:00:00", "ns")
+
+
+def at(seconds):
+    return str(np.datetime_as_string(start + np.timedelta64(int(seconds * 1e9), "ns"), unit="ns"))
+
+
+def coinc_message(detector_name, seconds, delay=1.0, is_test=False):
+    return {
+        "id": f"{detector_name}_CoincidenceTier_{seconds}",
+        "tier": "CoincidenceTier",
+        "detector_name": detector_name,
+        "neutrino_time_utc": at(seconds),
+        "p_val": 0.5,
+        "machine_time_utc": at(seconds),
+        "sent_time_utc": at(seconds + delay),
+        "schema_version": "1.0",
+        "meta": {"is_test": is_test},
+    }
+
+
+def heartbeat(detector_name, seconds, status="ON"):
+    return {
+        "id": f"{detector_name}_Heartbeat_{seconds}",
+        "detector_name": detector_name,
+        "detector_status": status,
+        "sent_time_utc": at(seconds),
+        "meta": {},
+    }
+
+
+def recording():
+    messages = [heartbeat(d, 0) for d in ["JUNO", "LVD", "NOvA", "IceCube"]]
+    messages += [
+        coinc_message("JUNO", 100),
+        coinc_message("LVD", 103),
+        coinc_message("NOvA", 105),
+        coinc_message("IceCube", 500),
+        {"id": "0_test-connection", "detector_name": "JUNO", "meta": {}},
+        coinc_message("LVD", 600, is_test=True),
+        coinc_message("JUNO", 602, is_test=True),
+    ]
+    return messages
+
+
+class TestReplay(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "stream.jsonl.gz")
+        with gzip.open(self.path, "wt") as file:
+            for message in recording():
+                file.write(json.dumps(message) + "\n")
+            file.write("not a message\n")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_read_messages(self):
+        read = list(read_messages(self.path))
+        self.assertEqual(len(read), len(recording()) + 1)
+        self.assertEqual(read[0][0], np.datetime64(at(0), "ns"))
+        self.assertEqual(read[-1], (None, None))
+
+    def test_alerts(self):
+        distributor = ReplayDistributor()
+        report = replay(self.path, distributor=distributor)
+        self.assertEqual(report["messages"], len(recording()) + 1)
+        self.assertEqual(report["unreadable"], 1)
+        self.assertEqual(report["failed"], 0)
+        self.assertEqual(report["cached"], 6)
+        # a new coincident detector, then a third one, nothing for the lone IceCube
+        self.assertEqual(
+            [(a["alert_type"], a["detector_names"]) for a in report["alerts"]],
+            [("COINC_MSG", ["JUNO", "LVD"]), ("COINC_MSG", ["JUNO", "LVD", "NOvA"])],
+        )
+        self.assertEqual([a["alert_type"] for a in report["test_alerts"]], ["TEST COINC_MSG"])
+        self.assertEqual(report["emails"], 2)
+        self.assertEqual(report["commands"], 0)
+        # the test-connection message went back to the in-memory connection topic
+        reinserted = distributor.transport.pending(distributor.test_topic)
+        self.assertEqual([json.loads(m)["meta"] for m in reinserted], [{"status": "received"}])
+        # nothing went to the database, the archive writes are counted
+        self.assertEqual(report["archived"]["insert_mgs"], 4)
+        self.assertEqual(report["archived"]["insert_alert"], 2)
+        # the heartbeats follow the recorded clock
+        self.assertEqual(
+            sorted(distributor.heartbeat.uptime.live_at(np.datetime64(at(104)))),
+            ["IceCube", "JUNO", "LVD", "NOvA"],
+        )
+        self.assertEqual(len(distributor.coinc_data.sub_groups), 2)
+        self.assertTrue(np.isfinite(report["latency_ms"]["p99"]))
+
+    def test_database_is_not_opened(self):
+        closed = mock.Mock(side_effect=AssertionError("the replay opened the database"))
+        with mock.patch("snews_cs.snews_coinc.Storage", closed), \
+                mock.patch("snews_cs.snews_hb.Storage", closed):
+            report = replay(self.path, distributor=ReplayDistributor())
+        self.assertEqual(report["failed"], 0)
+        closed.assert_not_called()
+
+    def test_update_outside_the_window(self):
+        # the update of LVD is more than a window after JUNO, the sub group keeps the
+        # earlier LVD message, and the alert is sent again as an update
+        distributor = ReplayDistributor()
+        for message in [coinc_message("JUNO", 100), coinc_message("LVD", 103),
+                        coinc_message("NOvA", 108), coinc_message("LVD", 111)]:
+            distributor.clock = np.datetime64(message["sent_time_utc"], "ns")
+            self.assertTrue(distributor.handle_message(message))
+        self.assertEqual(len(distributor.coinc_data.sub_groups), 1)
+        self.assertEqual(
+            [(a["detector_names"], a["alert_type"]) for a in distributor.alerts],
+            [(["JUNO", "LVD"], "COINC_MSG"), (["JUNO", "LVD", "NOvA"], "COINC_MSG"),
+             (["JUNO", "LVD", "NOvA"], "UPDATE")],
+        )
+        self.assertEqual(distributor.alerts[-1]["neutrino_times"][1], at(103))
+
+
+class TestMessageRecorder(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_record_and_replay(self):
+        recorder = MessageRecorder(self.directory.name, max_bytes=1000, compression="gz")
+        distributor = ReplayDistributor()
+        # not started, the records wait in the queue as they would behind a slow disk
+        distributor.recorder = recorder
+        for message in recording():
+            distributor.clock = np.datetime64(message.get("sent_time_utc", at(600)), "ns")
+            self.assertEqual(distributor.receive(json.dumps(message)), message)
+        with self.assertRaises(json.JSONDecodeError):
+            distributor.receive("not a message")
+        recorder.record(b"\x80not a pickle", np.datetime64(at(700)), error="not parsable")
+        self.assertEqual(recorder.queue.qsize(), len(recording()) + 2)
+        recorder.start().close()
+        self.assertEqual(recorder.recorded, len(recording()) + 2)
+        self.assertEqual(recorder.dropped, 0)
+        # the backlog is rotated on size, and every segment was closed
+        self.assertGreater(len(recorder.closed_segments), 1)
+        for path in recorder.closed_segments:
+            with gzip.open(path, "rb") as file:
+                self.assertLessEqual(len(file.read()), 1000)
+        self.assertEqual(segments(self.directory.name), sorted(recorder.closed_segments))
+        self.assertFalse([f for f in os.listdir(self.directory.name) if f.endswith(".open")])
+        read = [r for path in segments(self.directory.name) for r in read_messages(path)]
+        self.assertEqual(read[0][0], np.datetime64(at(0), "ns"))
+        self.assertEqual([m for _, m in read[:len(recording())]], recording())
+        # the recording gives the same alerts as the messages it recorded
+        report = replay(self.directory.name)
+        self.assertEqual(report["unreadable"], 2)
+        self.assertEqual(
+            [a["detector_names"] for a in report["alerts"]],
+            [["JUNO", "LVD"], ["JUNO", "LVD", "NOvA"]],
+        )
+
+    def test_write_error(self):
+        recorder = MessageRecorder(self.directory.name, compression="none")
+
+        def full_disk():
+            raise OSError("No space left on device")
+
+        recorder._open_segment = full_disk
+        for message in recording():
+            recorder.record(json.dumps(message), np.datetime64(message.get("sent_time_utc", at(600))))
+        recorder.start().close()
+        # the records that could not be written are counted as dropped
+        self.assertEqual(recorder.recorded, 0)
+        self.assertEqual(recorder.dropped, len(recording()))
+
+
+if __name__ == "__main__":
+    unittest.main()
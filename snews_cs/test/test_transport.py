@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""Unit tests for the transports of the topics
+"""
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+import numpy as np
+
+from snews_cs.alert_pub import AlertPublisher
+from snews_cs.cs_replay import ReplayDistributor, replay
+from snews_cs.cs_transport import FileTransport, MemoryTransport, Transport, get_transport
+
+topic = "kafka://kafka.scimma.org/snews.experiments-test"
+
+
+def coinc_message(detector_name, seconds):
+    # sent now, the system clock is followed
+    time = str(np.datetime64("now", "ns") - np.timedelta64(60 - seconds, "s"))
+    return {
+        "id": f"{detector_name}_CoincidenceTier_{seconds}",
+        "tier": "CoincidenceTier",
+        "detector_name": detector_name,
+        "neutrino_time_utc": time,
+        "p_val": 0.5,
+        "machine_time_utc": time,
+        "sent_time_utc": time,
+        "schema_version": "1.0",
+        "meta": {"is_test": False},
+    }
+
+
+def messages():
+    return [coinc_message("JUNO", 0), coinc_message("LVD", 3), coinc_message("NOvA", 5)]
+
+
+class TransportDistributor(ReplayDistributor):
+    """Publishes the alerts through the transport"""
+
+    def make_publisher(self, **kwargs):
+        return AlertPublisher(transport=self.transport, verbose=False, **kwargs)
+
+
+class TestTransport(unittest.TestCase):
+    def test_memory(self):
+        transport = MemoryTransport()
+        with transport.open(topic, "w") as s:
+            for message in messages():
+                s.write(message)
+        self.assertEqual(len(transport.pending(topic)), 3)
+        with transport.open(topic, "r", until_eos=True) as s:
+            read = [json.loads(m.content) for m in s]
+        self.assertEqual(read, messages())
+        # a reader waits for the messages until the topic ends
+        received = []
+        reader = threading.Thread(
+            target=lambda: received.extend(transport.open(topic, "r"))
+        )
+        reader.start()
+        transport.open(topic, "w").write("late")
+        transport.end(topic)
+        reader.join(5)
+        self.assertFalse(reader.is_alive())
+        self.assertEqual([m.content for m in received], ["late"])
+
+    def test_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            transport = FileTransport(directory)
+            with transport.open(topic, "w") as s:
+                for message in messages():
+                    s.write(message)
+            self.assertEqual(
+                os.listdir(directory), ["snews.experiments-test.jsonl"]
+            )
+            with transport.open(topic, "r") as s:
+                self.assertEqual([json.loads(m.content) for m in s], messages())
+            # the topic is a recording
+            report = replay(transport.path(topic))
+            self.assertEqual(report["cached"], 3)
+            self.assertEqual(
+                [a["detector_names"] for a in report["alerts"]],
+                [["JUNO", "LVD"], ["JUNO", "LVD", "NOvA"]],
+            )
+
+    def test_get_transport(self):
+        self.assertIs(get_transport("memory"), get_transport("memory"))
+        self.assertIsInstance(get_transport("memory"), MemoryTransport)
+        with self.assertRaises(ValueError):
+            get_transport("carrier-pigeon")
+        # a transport has to open its topics
+        with self.assertRaises(TypeError):
+            type("Incomplete", (Transport,), {})()
+
+    def test_run_coincidence(self):
+        transport = MemoryTransport()
+        distributor = TransportDistributor(transport=transport)
+        with transport.open(distributor.observation_topic, "w") as s:
+            for message in messages():
+                s.write(message)
+        transport.end(distributor.observation_topic)
+        # the topic is read up to its end, then the system stops
+        distributor.run_coincidence()
+        alerts = transport.pending(distributor.alert.alert_topic)
+        self.assertEqual(
+            [json.loads(a)["detector_names"] for a in alerts],
+            [["JUNO", "LVD"], ["JUNO", "LVD", "NOvA"]],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()